@@ -1,8 +1,14 @@
 import java.net.SocketTimeoutException;
+import java.util.concurrent.ArrayBlockingQueue;
+import java.util.concurrent.ConcurrentHashMap;
+import java.util.concurrent.TimeUnit;
+import java.util.concurrent.locks.ReentrantLock;
 
 import org.apache.activemq.transport.stomp.Stomp.Headers.Subscribe;
 import org.apache.activemq.transport.stomp.StompConnection;
 import org.apache.activemq.transport.stomp.StompFrame;
+import org.msgpack.core.MessagePack;
+import org.msgpack.value.ValueType;
 
 public class Neuron {
     public static final Logger logging = Logger.getRootLogger();
@@ -19,12 +25,104 @@ public class Neuron {
     public static final String INPUT_DESTINATION = "/queue/neuron.operation";
 
     public static final String PARTITION_KEY = "_partition";
+    //Echoed back on replies so clients can share one reply queue
+    public static final String CORRELATION_HEADER = "correlation-id";
+
+    public static final String CONTENT_TYPE_HEADER = "content-type";
+    public static final String JSON = "application/json";
+    //Compact binary encoding of Statements and replies (wetware.neuron.NEURON_MSGPACK)
+    public static final String NEURON_MSGPACK = "application/x-neuron-msgpack";
+    //Keys of a message, its statements and their fxns (and values of 'api', 'fxn'
+    // and 'format') sent as their index in this list.
+    // Must match wetware.neuron.INTERNED, so only ever add to the end of it.
+    public static final List INTERNED = ['statements', 'fxns', 'api', 'fxn', 'args', 'name', 'properties',
+                                         'property', 'value', 'type', 'label', 'fromVertex', 'toVertex',
+                                         'geoshape', 'partition', 'neuron', 'gremlin', 'blueprints',
+                                         'addVertex', 'addEdge', 'addVertexProperty', 'getVertexProperty',
+                                         'getVerticesTypeGeoWithin', 'V', 'E', 'has', 'hasLabel', 'out',
+                                         'in', 'both', 'outE', 'inE', 'values', 'valueMap', 'count',
+                                         'limit', 'toList', 'format', 'typed', '@type', 'id', 'key',
+                                         'outV', 'inV', 'shape', 'coordinates', 'vertex', 'edge',
+                                         'page_size', 'cursor', 'cursor_topic', 'close', 'error',
+                                         'atomic', 'template', 'bindings', 'predicate', 'geo',
+                                         'traversal', 'bulkUpsert', 'vertices', 'edges', 'added',
+                                         'export', 'elements', 'offset', 'from', 'to'];
+    public static final Map INTERNED_INDEX = (0..<INTERNED.size()).collectEntries { [(INTERNED[it]): it] };
+    public static final List INTERNED_VALUES = ['api', 'fxn', 'format'];
+
+    //Neuron API functions that only write; a message made of nothing else is
+    // run in one transaction unless it says 'atomic': false
+    public static final List WRITE_FXNS = ['addVertex', 'addEdge', 'addVertexProperty', 'bulkUpsert'];
+    //Names looked up by each query of neuronBulkUpsert
+    public static final int BULK_LOOKUP_SIZE = 1000;
+
+    //Statement APIs whose result is a traversal, to be run with toList()
+    public static final List TRAVERSAL_APIS = ['gremlin', 'template'];
+
+    //A message with 'format': TYPED gets its results as toTyped() structures
+    public static final String TYPED = "typed";
+
+    //Records per page of an export that doesn't give a page_size
+    public static final int EXPORT_PAGE_SIZE = 1000;
+
+    //An idle cursor is closed after this many milliseconds
+    public static final long CURSOR_TIMEOUT = 60000;
+    //Where the rest of the pages of our cursors are asked for, since another
+    // Neuron on INPUT_DESTINATION wouldn't know them
+    public static final String CURSOR_DESTINATION = "/queue/neuron.cursor." + UUID.randomUUID().toString();
+
+    //Messages are handled by this many threads, each with its own transaction
+    public static final int NEURON_THREADS = (System.getenv("NEURON_THREADS") ?: Runtime.getRuntime().availableProcessors().toString()) as int;
+    //Messages waiting for each thread before receiving blocks
+    public static final int NEURON_QUEUE_SIZE = 100;
+    //Gremlin statement shapes whose methods are remembered; least recently used go first
+    public static final int PLAN_CACHE_SIZE = 1000;
+    //Gremlin templates kept parsed, by their text; least recently used go first
+    public static final int TEMPLATE_CACHE_SIZE = 1000;
+    //Vertex ids remembered by name (see neuronAddVertex); least recently used go first
+    public static final int VERTEX_CACHE_SIZE = 10000;
+    //Locks guarding the adding of vertices by name (see lockNames)
+    public static final int NAME_LOCK_STRIPES = 1024;
+    //Milliseconds to wait for a name another transaction is adding
+    public static final long NAME_LOCK_TIMEOUT = 5000;
+    //Where what each commit changed is published (see publishMutations); empty for nowhere
+    public static final String CDC_DESTINATION = System.getenv("NEURON_CDC_TOPIC") != null ? System.getenv("NEURON_CDC_TOPIC") : "/topic/neuron.mutations";
+    //Gremlin steps that write; a statement using any of them changes the graph
+    // in ways we can't name, so it's published as a 'graph' mutation
+    public static final List GREMLIN_WRITE_STEPS = ['addV', 'addE', 'addVertex', 'addEdge', 'property', 'drop'];
 
     public StompConnection connection;
     public graph;
     public g;
 
-    public reply_topics = [];
+    //token -> ['results': iterator, 'tx': transaction, 'typed', 'page_size', 'used']
+    public cursors = new ConcurrentHashMap();
+    //One queue per thread; see dispatch()
+    public work_queues = [];
+    //Statement shape -> the method each of its steps calls (see executeGremlinStatement)
+    public final Map plans = Collections.synchronizedMap(new LinkedHashMap(16, 0.75f, true) {
+        protected boolean removeEldestEntry(Map.Entry eldest) {
+            return size() > PLAN_CACHE_SIZE;
+        }
+    });
+    //Template text -> its steps (see executeTemplateStatement)
+    public final Map templates = Collections.synchronizedMap(new LinkedHashMap(16, 0.75f, true) {
+        protected boolean removeEldestEntry(Map.Entry eldest) {
+            return size() > TEMPLATE_CACHE_SIZE;
+        }
+    });
+    //[partition, name] -> vertex id (see neuronAddVertex)
+    public final Map vertex_ids = Collections.synchronizedMap(new LinkedHashMap(16, 0.75f, true) {
+        protected boolean removeEldestEntry(Map.Entry eldest) {
+            return size() > VERTEX_CACHE_SIZE;
+        }
+    });
+    //One lock per stripe of [partition, name] (see lockNames)
+    public final List name_locks = (0..<NAME_LOCK_STRIPES).collect { new ReentrantLock() };
+    //The name locks this thread's open transaction holds
+    public final ThreadLocal held_locks = ThreadLocal.withInitial({ new LinkedHashSet() } as java.util.function.Supplier);
+    //What this thread's open transaction has changed so far (see recordMutation)
+    public final ThreadLocal mutations = ThreadLocal.withInitial({ new LinkedHashMap() } as java.util.function.Supplier);
 
     public Neuron() { };
 
@@ -35,11 +133,15 @@ public class Neuron {
         connection.open(APOLLO_HOSTNAME, APOLLO_PORT);
         connection.connect(APOLLO_USERNAME, APOLLO_PASSWORD);
         connection.subscribe(INPUT_DESTINATION, Subscribe.AckModeValues.CLIENT);
+        connection.subscribe(CURSOR_DESTINATION, Subscribe.AckModeValues.CLIENT);
     }
 
     public executeStatement(statement, traversal) {
         def api = statement['api'];
-        if (statement['fxns'].size() < 1) {
+        if (api == "template") {
+            //a template has no fxns of its own until its bindings are filled in
+            return executeTemplateStatement(statement, traversal);
+        } else if (statement['fxns'].size() < 1) {
             logging.warn("Received Neuron statement with no function calls");
             return [];
         } else if (api == "blueprints") {
@@ -74,22 +176,51 @@ public class Neuron {
             case "getVerticesTypeGeoWithin":
                 retVal = neuronGetVerticesTypeGeoWithin(it['type'], it['property'], it['geoshape'], traversal);
                 break;
+            case "bulkUpsert":
+                retVal = neuronBulkUpsert(it['vertices'] ?: [], it['edges'] ?: [], traversal);
+                break;
             }
         }
         return retVal;
     }
 
     public neuronAddVertex(name, properties, traversal) {
-        def vertex_iter = traversal.V().has("name", name);
+    /*Finds the vertex with this name, adding it if there isn't one.  The ids
+      of vertices found or added are kept in the vertex cache, so the same
+      names (e.g. sensors sending one reading after another) are looked up by
+      id instead of through the name index.  A cached id whose vertex is gone
+      (dropped, or added in a transaction that was rolled back) is forgotten,
+      and the name looked up again.
+    */
+        def key = [partitionOf(traversal), name];
+        lockNames(key[0], [name]);
         def vertex = null;
-        if (vertex_iter) {
-            vertex = vertex_iter.next();
-        } else {
-            vertex = traversal.addV("name", name).next();
+        def added = false;
+        def id = vertex_ids.get(key);
+        if (id != null) {
+            def cached_iter = traversal.V(id);
+            if (cached_iter) {
+                vertex = cached_iter.next();
+            } else {
+                vertex_ids.remove(key);
+            }
+        }
+        if (vertex == null) {
+            def vertex_iter = traversal.V().has("name", name);
+            if (vertex_iter) {
+                vertex = vertex_iter.next();
+            } else {
+                vertex = traversal.addV("name", name).next();
+                added = true;
+            }
+            vertex_ids.put(key, vertex.id());
         }
         for (prop in properties) {
             addProperty(vertex, prop.key, prop.value, traversal);
         }
+        if (added || properties) {
+            recordMutation(['element': 'vertex', 'name': name], (properties ?: [:]).collect { it.key }, added);
+        }
         return vertex;
     }
 
@@ -97,6 +228,7 @@ public class Neuron {
     /*Just a wrapper for if you haven't grabbed the vertex yet
     */
         def vertex = neuronAddVertex(name, [], traversal);
+        recordMutation(['element': 'vertex', 'name': name], [key], false);
         return addProperty(vertex, key, value, traversal);
     }
 
@@ -155,21 +287,104 @@ public class Neuron {
 
     public neuronAddEdge(fromName, toName, label, properties, traversal) {
     //Adding an Edge will add the Vertices as well
+        //both at once, so two threads never wait on each other's second name
+        lockNames(partitionOf(traversal), [fromName, toName]);
         def fromVertex = neuronAddVertex(fromName, [], traversal);
         def toVertex = neuronAddVertex(toName, [], traversal);
         def edge_iter = traversal.V(fromVertex).out(label).has("name", toName);
         def edge = null;
-        if (edge_iter) {
-            edge = edge_iter.next();
-        } else {
+        def added = !edge_iter;
+        if (added) {
             edge = fromVertex.addEdge(label, toVertex);
+        } else {
+            edge = edge_iter.next();
         }
         for (prop in properties) {
             addProperty(edge, prop.key, prop.value, traversal);
         }
+        if (added || properties) {
+            recordMutation(['element': 'edge', 'from': fromName, 'label': label, 'to': toName],
+                           (properties ?: [:]).collect { it.key }, added);
+        }
         return edge;
     }
 
+    public neuronBulkUpsert(vertices, edges, traversal) {
+    /*Add or update many vertices and edges at once, like addVertex and
+      addEdge would one at a time.  Every name (including the ends of the
+      edges) that isn't in the vertex cache is looked up at once, with
+      BULK_LOOKUP_SIZE names per query, and only the missing ones are added.
+      An edge to or from a vertex added here can't exist yet, so it isn't
+      looked for.  Returns how many vertices and edges there were, and how
+      many of the vertices were added.
+    */
+        def partition = partitionOf(traversal);
+        def names = new LinkedHashSet();
+        vertices.each { names.add(it['name']) };
+        edges.each { names.add(it['fromVertex']); names.add(it['toVertex']) };
+        lockNames(partition, names);
+
+        def found = [:];
+        def cached = [:];
+        for (name in names) {
+            def id = vertex_ids.get([partition, name]);
+            if (id != null) {
+                cached[id] = name;
+            }
+        }
+        if (cached) {
+            //ids that are gone fall through to the name lookup below
+            traversal.V(cached.keySet() as Object[]).toList().each { found[cached[it.id()]] = it };
+        }
+        (names - found.keySet()).toList().collate(BULK_LOOKUP_SIZE).each { chunk ->
+            traversal.V().has("name", P.within(chunk)).toList().each {
+                found[it.value("name")] = it;
+            }
+        }
+        def added = new HashSet();
+        for (name in names) {
+            if (!found.containsKey(name)) {
+                found[name] = traversal.addV("name", name).next();
+                added.add(name);
+                recordMutation(['element': 'vertex', 'name': name], [], true);
+            }
+            vertex_ids.put([partition, name], found[name].id());
+        }
+
+        for (vertex in vertices) {
+            for (prop in vertex['properties']) {
+                addProperty(found[vertex['name']], prop.key, prop.value, traversal);
+            }
+            if (vertex['properties']) {
+                recordMutation(['element': 'vertex', 'name': vertex['name']],
+                               vertex['properties'].collect { it.key }, false);
+            }
+        }
+        for (edge in edges) {
+            def fromVertex = found[edge['fromVertex']];
+            def toVertex = found[edge['toVertex']];
+            def existing = null;
+            if (!added.contains(edge['fromVertex']) && !added.contains(edge['toVertex'])) {
+                def edge_iter = traversal.V(fromVertex).outE(edge['label']).as("e").inV().hasId(toVertex.id()).select("e");
+                if (edge_iter) {
+                    existing = edge_iter.next();
+                }
+            }
+            def edge_added = existing == null;
+            if (edge_added) {
+                existing = fromVertex.addEdge(edge['label'], toVertex);
+            }
+            for (prop in edge['properties']) {
+                addProperty(existing, prop.key, prop.value, traversal);
+            }
+            if (edge_added || edge['properties']) {
+                recordMutation(['element': 'edge', 'from': edge['fromVertex'], 'label': edge['label'], 'to': edge['toVertex']],
+                               (edge['properties'] ?: [:]).collect { it.key }, edge_added);
+            }
+        }
+        return ['vertices': vertices.size(), 'edges': edges.size(), 'added': added.size()];
+    }
+
     public neuronGetVerticesTypeGeoWithin(type, property, geoshape, traversal) {
         if (geoshape.size == 3) {
             return traversal.V().has("type", type).has(property, geoWithin(Geoshape.circle(geoshape[0],geoshape[1],geoshape[2]))).valueMap().toList();
@@ -187,6 +402,8 @@ public class Neuron {
             return [];
         } else {
             def fxn = fxns[0];
+            //anything may be done through the graph itself
+            recordMutation(['element': 'graph'], [], false);
             if (fxn['fxn'] == "addEdge") {
                 def fromVertex = executeGremlinStatement(fxn['fromVertex'], traversal);
                 def toVertex = executeGremlinStatement(fxn['toVertex'], traversal);
@@ -200,83 +417,861 @@ public class Neuron {
     }
 
     public executeGremlinStatement(statement, traversal) {
+    /*Apply each function of the statement in turn to the result of the last,
+      starting from the traversal source; there may be any number of them.
+
+      Working out which method a function name and its arguments mean is the
+      slow part of calling it dynamically, so the methods found for a
+      statement are kept in the plan cache, under the statement's shape: its
+      function names and the types of their arguments.  The next statement of
+      the same shape calls them directly.
+
+      Arguments are what the client sent, except for those made by toArgument().
+    */
         def fxns = statement['fxns'];
-        if (fxns.size() > 10) {
-            logging.warn("Neuron can not process Gremlin operations with greater than 10 linked calls");
-        } else if (fxns.size() == 1) {
-            return traversal."${fxns[0]['fxn']}"(*fxns[0]['args']);
-        } else if (fxns.size() == 2) {
-            return traversal."${fxns[0]['fxn']}"(*fxns[0]['args'])."${fxns[1]['fxn']}"(*fxns[1]['args']);
-        } else if (fxns.size() == 3) {
-            return traversal."${fxns[0]['fxn']}"(*fxns[0]['args'])."${fxns[1]['fxn']}"(*fxns[1]['args'])."${fxns[2]['fxn']}"(*fxns[2]['args']);
-        } else if (fxns.size() == 4) {
-            return traversal."${fxns[0]['fxn']}"(*fxns[0]['args'])."${fxns[1]['fxn']}"(*fxns[1]['args'])."${fxns[2]['fxn']}"(*fxns[2]['args'])."${fxns[3]['fxn']}"(*fxns[3]['args']);
-        } else if (fxns.size() == 5) {
-            return traversal."${fxns[0]['fxn']}"(*fxns[0]['args'])."${fxns[1]['fxn']}"(*fxns[1]['args'])."${fxns[2]['fxn']}"(*fxns[2]['args'])."${fxns[3]['fxn']}"(*fxns[3]['args'])."${fxns[4]['fxn']}"(*fxns[4]['args']);
-        } else if (fxns.size() == 6) {
-            return traversal."${fxns[0]['fxn']}"(*fxns[0]['args'])."${fxns[1]['fxn']}"(*fxns[1]['args'])."${fxns[2]['fxn']}"(*fxns[2]['args'])."${fxns[3]['fxn']}"(*fxns[3]['args'])."${fxns[4]['fxn']}"(*fxns[4]['args'])."${fxns[5]['fxn']}"(*fxns[5]['args']);
-        } else if (fxns.size() == 7) {
-            return traversal."${fxns[0]['fxn']}"(*fxns[0]['args'])."${fxns[1]['fxn']}"(*fxns[1]['args'])."${fxns[2]['fxn']}"(*fxns[2]['args'])."${fxns[3]['fxn']}"(*fxns[3]['args'])."${fxns[4]['fxn']}"(*fxns[4]['args'])."${fxns[5]['fxn']}"(*fxns[5]['args'])."${fxns[6]['fxn']}"(*fxns[6]['args']);
-        } else if (fxns.size() == 8) {
-            return traversal."${fxns[0]['fxn']}"(*fxns[0]['args'])."${fxns[1]['fxn']}"(*fxns[1]['args'])."${fxns[2]['fxn']}"(*fxns[2]['args'])."${fxns[3]['fxn']}"(*fxns[3]['args'])."${fxns[4]['fxn']}"(*fxns[4]['args'])."${fxns[5]['fxn']}"(*fxns[5]['args'])."${fxns[6]['fxn']}"(*fxns[6]['args'])."${fxns[7]['fxn']}"(*fxns[7]['args']);
-        } else if (fxns.size() == 9) {
-            return traversal."${fxns[0]['fxn']}"(*fxns[0]['args'])."${fxns[1]['fxn']}"(*fxns[1]['args'])."${fxns[2]['fxn']}"(*fxns[2]['args'])."${fxns[3]['fxn']}"(*fxns[3]['args'])."${fxns[4]['fxn']}"(*fxns[4]['args'])."${fxns[5]['fxn']}"(*fxns[5]['args'])."${fxns[6]['fxn']}"(*fxns[6]['args'])."${fxns[7]['fxn']}"(*fxns[7]['args'])."${fxns[8]['fxn']}"(*fxns[8]['args']);
-        } else if (fxns.size() == 10) {
-            return traversal."${fxns[0]['fxn']}"(*fxns[0]['args'])."${fxns[1]['fxn']}"(*fxns[1]['args'])."${fxns[2]['fxn']}"(*fxns[2]['args'])."${fxns[3]['fxn']}"(*fxns[3]['args'])."${fxns[4]['fxn']}"(*fxns[4]['args'])."${fxns[5]['fxn']}"(*fxns[5]['args'])."${fxns[6]['fxn']}"(*fxns[6]['args'])."${fxns[7]['fxn']}"(*fxns[7]['args'])."${fxns[8]['fxn']}"(*fxns[8]['args'])."${fxns[9]['fxn']}"(*fxns[9]['args']);
-        }
-    }
-
-    public void onMessage(StompFrame frame) {
-        if (frame.headers.containsKey('reply-to')) {
-            //NOTE: pop comes from the end, so we're inserting at the front
-            reply_topics.putAt(0, frame.headers['reply-to']);
+        def arguments = fxns.collect { fxn -> (fxn['args'] ?: []).collect { toArgument(it) } as Object[] };
+        def shape = [traversal.getClass()] + (0..<fxns.size()).collect { i ->
+            [fxns[i]['fxn'], arguments[i].collect { it?.getClass() }]
+        };
+        def plan = plans.get(shape);
+        def cached = plan != null;
+        if (!cached) {
+            plan = new ArrayList(Collections.nCopies(fxns.size(), null));
+        }
+        if (fxns.any { it['fxn'] == "drop" }) {
+            //we can't tell which vertices this drops, so forget them all
+            vertex_ids.clear();
+        }
+        if (fxns.any { it['fxn'] in GREMLIN_WRITE_STEPS }) {
+            recordMutation(['element': 'graph'], [], false);
+        }
+        def result = traversal;
+        fxns.eachWithIndex { fxn, i ->
+            def args = arguments[i];
+            def method = plan[i];
+            //a step may return something else than last time (e.g. null)
+            if (method == null || !method.getDeclaringClass().getTheClass().isInstance(result)) {
+                method = result.metaClass.getMetaMethod(fxn['fxn'], args);
+                plan[i] = method;
+            }
+            if (method == null) {
+                //nothing to cache (e.g. a method that is only found at call time)
+                result = result."${fxn['fxn']}"(*args);
+            } else {
+                result = method.doMethodInvoke(result, args);
+            }
         }
+        if (!cached) {
+            plans.put(shape, plan);
+        }
+        return result;
+    }
+
+    public toArgument(arg) {
+    /*Turn a typed argument of a Gremlin step (see wetware.neuron.Traversal)
+      into what the step expects: a {'@type': 'predicate'} into a P, a
+      {'@type': 'geo'} into a Geo predicate on a Geoshape, and a
+      {'@type': 'traversal'} into an anonymous traversal.  Decimals become
+      doubles, as they are stored (see addProperty).
+    */
+        if (arg instanceof BigDecimal) {
+            return arg.doubleValue();
+        } else if (!(arg instanceof Map) || !arg.containsKey('@type')) {
+            return arg;
+        }
+        def args = (arg['args'] ?: []).collect { toArgument(it) };
+        switch (arg['@type']) {
+        case "predicate":
+            return P."${arg['fxn']}"(*args);
+        case "geo":
+            return Geo."${arg['fxn']}"(toGeoshape(args[0]));
+        case "traversal":
+            return executeGremlinStatement(arg, __.start());
+        default:
+            throw new IllegalArgumentException("Unknown type of argument: " + arg['@type']);
+        }
+    }
+
+    public toGeoshape(coordinates) {
+    //The reverse of geoshapeCoordinates(), for points, circles and boxes
+        switch (coordinates.size()) {
+        case 2:
+            return Geoshape.point(coordinates[0], coordinates[1]);
+        case 3:
+            return Geoshape.circle(coordinates[0], coordinates[1], coordinates[2]);
+        case 4:
+            return Geoshape.box(coordinates[0], coordinates[1], coordinates[2], coordinates[3]);
+        default:
+            throw new IllegalArgumentException("Not a geoshape: " + coordinates);
+        }
+    }
+
+    public executeTemplateStatement(statement, traversal) {
+    /*Run a Gremlin template with its bindings.  Templates are parsed once and
+      kept in the template cache, so after the first time only the bindings
+      are new; the steps they make then hit the plan cache as well.
+    */
+        def template = statement['template'];
+        def steps = templates.get(template);
+        if (steps == null) {
+            steps = parseTemplate(template);
+            templates.put(template, steps);
+        }
+        def bindings = statement['bindings'] ?: [:];
+        def fxns = steps.collect { step ->
+            ['fxn': step['fxn'], 'args': step['args'].collect { arg ->
+                if (!arg.containsKey('binding')) {
+                    return arg['value'];
+                } else if (!bindings.containsKey(arg['binding'])) {
+                    throw new IllegalArgumentException("No binding for '" + arg['binding'] + "' in template: " + template);
+                }
+                return bindings[arg['binding']];
+            }]
+        };
+        return executeGremlinStatement(['fxns': fxns], traversal);
+    }
+
+    public parseTemplate(String text) {
+    /*Split a template like "g.V().has('name', name).out(label)" into steps.
+      Each argument is a quoted string, a number, true, false or null (kept as
+      ['value': ...]) or the name of a binding (kept as ['binding': name]).
+    */
+        def steps = [];
+        def i = skipSpaces(text, 0);
+        while (i < text.length()) {
+            def start = i;
+            while (i < text.length() && Character.isJavaIdentifierPart(text.charAt(i))) {
+                i++;
+            }
+            def name = text.substring(start, i);
+            if (!name) {
+                throw new IllegalArgumentException("Expected a step at " + start + " in template: " + text);
+            }
+            i = skipSpaces(text, i);
+            if (i < text.length() && text[i] == "(") {
+                def args = [];
+                i = skipSpaces(text, i + 1);
+                while (i < text.length() && text[i] != ")") {
+                    def parsed = parseTemplateArgument(text, i);
+                    args.add(parsed[0]);
+                    i = skipSpaces(text, parsed[1]);
+                    if (i < text.length() && text[i] == ",") {
+                        i = skipSpaces(text, i + 1);
+                    } else if (i < text.length() && text[i] != ")") {
+                        throw new IllegalArgumentException("Expected ',' or ')' at " + i + " in template: " + text);
+                    }
+                }
+                if (i >= text.length()) {
+                    throw new IllegalArgumentException("Unclosed '(' in template: " + text);
+                }
+                steps.add(['fxn': name, 'args': args]);
+                i = skipSpaces(text, i + 1);
+            } else if (!steps && (name == "g" || name == "graph")) {
+                //the traversal source is supplied by Neuron
+            } else {
+                throw new IllegalArgumentException("Expected '(' after " + name + " in template: " + text);
+            }
+            if (i < text.length()) {
+                if (text[i] != ".") {
+                    throw new IllegalArgumentException("Expected '.' at " + i + " in template: " + text);
+                }
+                i = skipSpaces(text, i + 1);
+            }
+        }
+        return steps;
+    }
+
+    public parseTemplateArgument(String text, int i) {
+    //Returns the argument starting at i, and where it ends
+        def quote = text[i];
+        if (quote == "'" || quote == '"') {
+            def value = new StringBuilder();
+            i++;
+            while (i < text.length() && text[i] != quote) {
+                if (text[i] == "\\" && i + 1 < text.length()) {
+                    i++;
+                }
+                value.append(text[i]);
+                i++;
+            }
+            if (i >= text.length()) {
+                throw new IllegalArgumentException("Unterminated string in template: " + text);
+            }
+            return [['value': value.toString()], i + 1];
+        }
+        def start = i;
+        while (i < text.length() && text[i] != "," && text[i] != ")" && !Character.isWhitespace(text.charAt(i))) {
+            i++;
+        }
+        def token = text.substring(start, i);
+        if (token == "true" || token == "false") {
+            return [['value': token.toBoolean()], i];
+        } else if (token == "null") {
+            return [['value': null], i];
+        } else if (token ==~ /-?\d+/) {
+            return [['value': token.isInteger() ? token.toInteger() : token.toLong()], i];
+        } else if (token ==~ /-?\d*\.\d+([eE][-+]?\d+)?/) {
+            return [['value': token.toBigDecimal()], i];
+        } else if (token ==~ /[A-Za-z_]\w*/) {
+            return [['binding': token], i];
+        }
+        throw new IllegalArgumentException("Can't read argument '" + token + "' in template: " + text);
+    }
+
+    public int skipSpaces(String text, int i) {
+        while (i < text.length() && Character.isWhitespace(text.charAt(i))) {
+            i++;
+        }
+        return i;
+    }
+
+    public void dispatch(StompFrame frame) {
+    /*Decode a message and queue it for one of the NEURON_THREADS threads.
+      Messages with the same orderingKey() go to the same thread, so they're
+      handled one at a time, in the order they arrived.  Blocks while that
+      thread's queue is full.
+    */
+        //replies go back in whichever encoding the request came in
+        def contentType = (frame.headers[CONTENT_TYPE_HEADER] ?: JSON).split(';')[0].trim();
+        def requester = requesterOf(frame, contentType);
+        def message;
         try {
-            connection.ack(frame);
-            def parser = new JsonSlurper();
-            def message = parser.parseText(frame.getBody());
+            if (contentType == NEURON_MSGPACK) {
+                message = unpack(frame.getContent());
+            } else {
+                def parser = new JsonSlurper();
+                message = parser.parseText(frame.getBody());
+            }
+        } catch (Exception e) {
+            logging.warn("Neuron received a message it couldn't decode as " + contentType);
+            logging.warn(e.toString());
+            if (requester) {
+                sendReply(requester, ["statements": [], "error": "Invalid message: " + e.toString()]);
+            }
+            return;
+        }
+        def key = orderingKey(frame, message);
+        work_queues[Math.floorMod(key.hashCode(), work_queues.size())].put([requester, message]);
+    }
+
+    public requesterOf(frame, contentType) {
+    /*Where the reply to a frame goes, and how: its reply-to, the correlation
+      id to echo back (if any) and the encoding to use.  Travels with the
+      message, so each reply reaches whoever asked, however many requests
+      are in flight.  null if nobody is waiting on a reply.
+    */
+        if (!frame.headers['reply-to']) {
+            return null;
+        }
+        return ['reply-to': frame.headers['reply-to'],
+                (CORRELATION_HEADER): frame.headers[CORRELATION_HEADER],
+                (CONTENT_TYPE_HEADER): contentType];
+    }
 
+    public orderingKey(frame, message) {
+    /*Pages of a cursor must be read in turn, and so must the messages of a
+      partition.  Otherwise, a requester's messages are kept in order, and
+      messages nobody waits on (which are usually writes) stay in the order
+      they were sent.
+
+      A message without a reply-to isn't ordered against ones with a
+      reply-to, even from the same client: a read sent right after a write
+      nobody waits on may run first.  To read your own writes, wait for the
+      write's reply, send both in one message, or use a partition.
+    */
+        if (message instanceof Map && message['cursor']) {
+            return "cursor:" + message['cursor'];
+        } else if (message instanceof Map && message['partition']) {
+            return "partition:" + message['partition'];
+        }
+        return frame.headers['reply-to'] ?: INPUT_DESTINATION;
+    }
+
+    public void work(queue) {
+    //Handle messages from a queue for as long as Neuron runs
+        while (true) {
+            def work = queue.take();
+            try {
+                onMessage(work[0], work[1]);
+            } catch (Exception e) {
+                e.printStackTrace();
+                logging.warn("Neuron failed to handle a message: " + e.toString());
+                g.tx().rollback();
+                releaseNames();
+                discardMutations();
+            }
+        }
+    }
+
+    public void onMessage(requester, message) {
+    /*Run a message and reply to its requester, if it has one.  Anything that
+      goes wrong is rolled back, and the requester gets an 'error' instead.
+    */
+        sweepCursors();
+        //a cursor's transaction is never committed, so nothing it did is kept
+        releaseNames();
+        discardMutations();
+        def reply;
+        try {
+            reply = execute(message);
+        } catch (Exception e) {
+            e.printStackTrace();
+            logging.warn("Neuron failed to run operation; probably invalid Gremlin");
+            g.tx().rollback();
+            releaseNames();
+            discardMutations();
+            reply = ["statements": [], "error": e.toString()];
+        }
+        if (requester) {
+            println "Sending reply:";
+            println reply;
+            sendReply(requester, reply);
+        }
+    }
+
+    public execute(message) {
+    //Run the statements of a message (or a page of a cursor) and return the reply
+        def typed = message['format'] == TYPED;
+        def reply;
+        if (message['cursor']) {
+            reply = continueCursor(message);
+        } else if (message['export']) {
+            reply = openExport(message);
+        } else if (message['page_size'] && message['statements'].size() == 1 &&
+                   message['statements'][0]['api'] in TRAVERSAL_APIS) {
+            reply = openCursor(message, typed);
+        } else {
             def traversal = g;
             if (message['partition']) {
-                def partition = message['partition'];
-                def strategy = PartitionStrategy.build().partitionKey(PARTITION_KEY).writePartition(partition).addReadPartition(partition).create();
-                traversal = GraphTraversalSource.build().with(strategy).create(graph);
+                traversal = partitionedTraversal(graph, message['partition']);
             }
 
             //return the result of each Statement (but not of each function)
-            def reply = ["statements": []];
-            for (statement in message['statements']) {
-                println statement;
-                def result;
+            reply = ["statements": []];
+            if (typed) {
+                reply["format"] = TYPED;
+            }
+            def atomic = message.containsKey('atomic') ? message['atomic'] : isPureWrite(message['statements']);
+            def results = null;
+            if (atomic) {
                 try {
-                    result = executeStatement(statement, traversal);
-                    if (statement["api"] == "gremlin"){
-                        result = result.toList();
-                    }
+                    results = executeAtomically(message['statements'], traversal, typed);
                 } catch (Exception e) {
-                    logging.warn("NeuronException executing statement: " + statement);
+                    g.tx().rollback();
+                    releaseNames();
+                    discardMutations();
+                    logging.warn("NeuronException executing statements atomically; rolled back");
                     logging.warn(e.toString());
-                    logging.warn(e.getMessage());
-                    logging.warn(e.getStackTrace());
-                    result = "";
+                    if (message['atomic']) {
+                        reply["error"] = e.toString();
+                        results = [];
+                    }
+                    //otherwise, it was only atomic to save on commits, so
+                    // let the statements that can succeed do so
                 }
-                reply["statements"].add(result.toString());
-                g.tx().commit();
-            }
-            if (reply_topics.size() > 0) {
-                //NOTE: pop comes from the end, so we're inserting at the front
-                def dest = reply_topics.pop();
-                println "Sending reply:";
-                println reply;
-                connection.send(dest, new JsonBuilder(reply).toString());
-            }
-        } catch (JsonException e) {
-            logging.warn("Neuron received invalid JSON message");
-            connection.send(dest, new JsonBuilder(reply).toString());
+            }
+            if (results == null) {
+                results = executeEach(message['statements'], traversal, typed);
+            }
+            reply["statements"].addAll(results);
+        }
+        return reply;
+    }
+
+    public executeEach(statements, traversal, typed) {
+    //Run and commit each statement on its own; one failing doesn't stop the rest
+        def results = [];
+        for (statement in statements) {
+            println statement;
+            def result;
+            try {
+                result = executeStatement(statement, traversal);
+                if (statement["api"] in TRAVERSAL_APIS) {
+                    result = result.toList();
+                }
+            } catch (Exception e) {
+                logging.warn("NeuronException executing statement: " + statement);
+                logging.warn(e.toString());
+                logging.warn(e.getMessage());
+                logging.warn(e.getStackTrace());
+                result = "";
+            }
+            results.add(typed ? toTyped(result) : result.toString());
+            g.tx().commit();
+            releaseNames();
+            publishMutations(partitionOf(traversal));
+        }
+        return results;
+    }
+
+    public executeAtomically(statements, traversal, typed) {
+    /*Run every statement in one transaction with a single commit.  Throws if
+      any of them fails, leaving the caller to roll back.
+    */
+        def results = [];
+        for (statement in statements) {
+            println statement;
+            def result = executeStatement(statement, traversal);
+            if (statement["api"] in TRAVERSAL_APIS) {
+                result = result.toList();
+            }
+            results.add(typed ? toTyped(result) : result.toString());
+        }
+        g.tx().commit();
+        releaseNames();
+        publishMutations(partitionOf(traversal));
+        return results;
+    }
+
+    public isPureWrite(statements) {
+        return statements && statements.every { statement ->
+            statement['api'] == "neuron" && statement['fxns'].every { it['fxn'] in WRITE_FXNS }
+        };
+    }
+
+    public partitionOf(traversal) {
+    //The partition a traversal from partitionedTraversal() writes to, or null
+        def strategy = traversal.getStrategies().toList().find { it instanceof PartitionStrategy };
+        return strategy?.getWritePartition();
+    }
+
+    public partitionedTraversal(source, partition) {
+    //A traversal of source (the graph, or a transaction) that only sees and writes to one partition
+        def strategy = PartitionStrategy.build().partitionKey(PARTITION_KEY).writePartition(partition).addReadPartition(partition).create();
+        return GraphTraversalSource.build().with(strategy).create(source);
+    }
+
+    public void lockNames(partition, names) {
+    /*Hold the locks of these names until this thread's transaction ends (see
+      releaseNames).  The name index isn't unique, and a vertex added by an
+      open transaction can't be seen by any other, so without them two
+      threads adding the same new name at once would both add it.
+
+      A statement takes the locks of all its names at once, in stripe order.
+      A message of several statements holds those of the earlier ones while
+      taking the next, so two such messages can wait on each other; after
+      NAME_LOCK_TIMEOUT this throws, which rolls the message back and (unless
+      it asked to be atomic) runs its statements again one at a time.
+    */
+        def held = held_locks.get();
+        def stripes = names.collect { Math.floorMod([partition, it].hashCode(), NAME_LOCK_STRIPES) }.unique().sort();
+        for (stripe in stripes) {
+            def lock = name_locks[stripe];
+            if (held.contains(lock)) {
+                continue;
+            }
+            if (!lock.tryLock(NAME_LOCK_TIMEOUT, TimeUnit.MILLISECONDS)) {
+                throw new IllegalStateException("Timed out waiting for another transaction adding " + names);
+            }
+            held.add(lock);
+        }
+    }
+
+    public void releaseNames() {
+    //Let go of the name locks of a transaction that has committed or rolled back
+        def held = held_locks.get();
+        for (lock in held) {
+            lock.unlock();
+        }
+        held.clear();
+    }
+
+    public void recordMutation(element, keys, added) {
+    /*Note a change made in this thread's open transaction, to be published
+      once it commits.  element names what changed: ['element': 'vertex',
+      'name'], ['element': 'edge', 'from', 'label', 'to'], or ['element':
+      'graph'] for changes (made by Gremlin) we can't name.  Changes to the
+      same element are merged, so it's published once per commit.
+    */
+        if (!CDC_DESTINATION) {
+            return;
+        }
+        def changes = mutations.get();
+        def mutation = changes[element];
+        if (mutation == null) {
+            mutation = new LinkedHashMap(element);
+            mutation['keys'] = new LinkedHashSet();
+            mutation['added'] = false;
+            changes[element] = mutation;
+        }
+        mutation['keys'].addAll(keys);
+        mutation['added'] = mutation['added'] || added;
+    }
+
+    public void publishMutations(partition) {
+    /*Publish what the transaction that just committed changed to
+      CDC_DESTINATION, as one message:
+        {'mutations': [...], 'partition': ..., 'committed': <epoch millis>}
+      Messages from different threads may arrive out of commit order.
+    */
+        def changes = mutations.get();
+        if (!changes) {
+            return;
+        }
+        def message = ['mutations': changes.values().collect { it + ['keys': it['keys'].toList()] },
+                       'partition': partition,
+                       'committed': System.currentTimeMillis()];
+        changes.clear();
+        def headers = new HashMap<String, String>();
+        headers.put(CONTENT_TYPE_HEADER, JSON);
+        def body = new JsonBuilder(message).toString();
+        synchronized (connection) {
+            connection.send(CDC_DESTINATION, body, null, headers);
+        }
+    }
+
+    public void discardMutations() {
+    //Forget what a transaction that was rolled back changed
+        mutations.get().clear();
+    }
+
+    public openCursor(message, typed) {
+    /*Run a paged Gremlin statement in a transaction of its own, which stays
+      open (and keeps our place in the results) until the last page is sent,
+      and reply with the first page.
+    */
+        def tx = graph.newTransaction();
+        try {
+            def traversal = message['partition'] ? partitionedTraversal(tx, message['partition']) : tx.traversal();
+            def results = executeStatement(message['statements'][0], traversal);
+            if (!(results instanceof Iterator)) {
+                results = (results == null ? [] : [results]).iterator();
+            }
+            def cursor = ['results': results, 'tx': tx, 'typed': typed, 'page_size': message['page_size']];
+            return nextPage(UUID.randomUUID().toString(), cursor);
         } catch (Exception e) {
-            e.printStackTrace();
-            logging.warn("Neuron failed to run operation; probably invalid Gremlin");
-            connection.send(dest, new JsonBuilder(reply).toString());
+            logging.warn("NeuronException opening cursor for: " + message['statements'][0]);
+            logging.warn(e.toString());
+            tx.rollback();
+            return ["statements": [], "error": e.toString()];
+        }
+    }
+
+    public openExport(message) {
+    /*Stream the vertices and then the edges of the graph (or of the message's
+      partition) through a cursor, as typed records (see toTyped()); each edge
+      also names the vertices at its ends, as 'from' and 'to'.  With a 'type',
+      only vertices of that type, and the edges out of them, are exported.
+      'offset' skips that many records, to pick up an export part way.
+    */
+        def export = message['export'];
+        def elements = export['elements'] ?: ['vertices', 'edges'];
+        def tx = graph.newTransaction();
+        try {
+            def traversal = message['partition'] ? partitionedTraversal(tx, message['partition']) : tx.traversal();
+            def vertices = {
+                export['type'] ? traversal.V().has("type", export['type']) : traversal.V()
+            };
+            def sources = [];
+            if ("vertices" in elements) {
+                sources.add(vertices);
+            }
+            if ("edges" in elements) {
+                sources.add({ vertices().outE() });
+            }
+            def results = exportRecords(sources);
+            for (long skipped = 0; skipped < (export['offset'] ?: 0) && results.hasNext(); skipped++) {
+                results.next();
+            }
+            def cursor = ['results': results, 'tx': tx, 'typed': true,
+                          'page_size': message['page_size'] ?: EXPORT_PAGE_SIZE];
+            return nextPage(UUID.randomUUID().toString(), cursor);
+        } catch (Exception e) {
+            logging.warn("NeuronException opening export: " + export);
+            logging.warn(e.toString());
+            tx.rollback();
+            return ["statements": [], "error": e.toString()];
+        }
+    }
+
+    public exportRecords(sources) {
+    //Iterate over the traversal each of sources makes, in turn, as export records
+        def remaining = new LinkedList(sources);
+        def current = null;
+        def advance = {
+            while ((current == null || !current.hasNext()) && remaining) {
+                current = remaining.removeFirst().call();
+            }
+            return current != null && current.hasNext();
+        };
+        return [hasNext: { advance() },
+                next: {
+                    advance();
+                    def element = current.next();
+                    def record = toTyped(element);
+                    if (element instanceof Edge) {
+                        record['from'] = element.outVertex().property("name").orElse(null);
+                        record['to'] = element.inVertex().property("name").orElse(null);
+                    }
+                    return record;
+                }] as Iterator;
+    }
+
+    public continueCursor(message) {
+    //Reply with the next page of a cursor, or close it if the client is done
+        def cursor = cursors.remove(message['cursor']);
+        if (cursor == null) {
+            logging.warn("Asked for unknown or expired cursor " + message['cursor']);
+            return ["statements": [], "error": "Unknown or expired cursor: " + message['cursor']];
+        }
+        if (message['close']) {
+            cursor['tx'].rollback();
+            return ["statements": []];
+        }
+        if (message['page_size']) {
+            cursor['page_size'] = message['page_size'];
+        }
+        return nextPage(message['cursor'], cursor);
+    }
+
+    public nextPage(token, cursor) {
+    /*Read up to a page of results; the reply carries the cursor's token if
+      there are more.  The results are turned into text or typed maps before
+      the transaction they were read in can be closed.
+    */
+        def page = [];
+        while (page.size() < cursor['page_size'] && cursor['results'].hasNext()) {
+            page.add(cursor['results'].next());
+        }
+        def reply = ["statements": [cursor['typed'] ? toTyped(page) : page.toString()]];
+        if (cursor['typed']) {
+            reply["format"] = TYPED;
+        }
+        if (cursor['results'].hasNext()) {
+            cursor['used'] = System.currentTimeMillis();
+            cursors[token] = cursor;
+            reply["cursor"] = token;
+            reply["cursor_topic"] = CURSOR_DESTINATION;
+        } else {
+            cursor['tx'].rollback();
+        }
+        return reply;
+    }
+
+    public void sweepCursors() {
+    /*Close cursors that haven't been read from in CURSOR_TIMEOUT.  Every
+      thread sweeps, so a cursor is only closed by whoever takes it out of
+      cursors: not one a page is being read from, nor one closed already.
+    */
+        def now = System.currentTimeMillis();
+        def expired = cursors.findAll { token, cursor -> now - cursor['used'] > CURSOR_TIMEOUT };
+        for (entry in expired) {
+            if (!cursors.remove(entry.key, entry.value)) {
+                continue;
+            }
+            logging.info("Closing idle cursor " + entry.key);
+            try {
+                entry.value['tx'].rollback();
+            } catch (Exception e) {
+                logging.warn("Neuron failed to close cursor " + entry.key + ": " + e.toString());
+            }
+        }
+    }
+
+    public toTyped(result) {
+    /*Turn a result into maps, lists, strings, numbers and booleans (GraphSON
+      style), so clients don't have to parse its toString().  Vertices, edges,
+      properties and geoshapes become maps with an '@type'.
+    */
+        if (result == null || result instanceof String || result instanceof Number || result instanceof Boolean) {
+            return result;
+        } else if (result instanceof Vertex) {
+            def properties = [:];
+            result.properties().each {
+                if (!properties.containsKey(it.key())) {
+                    properties[it.key()] = [];
+                }
+                properties[it.key()].add(toTyped(it.value()));
+            }
+            return ['@type': 'vertex', 'id': toTyped(result.id()), 'label': result.label(),
+                    'properties': properties];
+        } else if (result instanceof Edge) {
+            def properties = [:];
+            result.properties().each { properties[it.key()] = toTyped(it.value()) };
+            return ['@type': 'edge', 'id': result.id().toString(), 'label': result.label(),
+                    'outV': toTyped(result.outVertex().id()), 'inV': toTyped(result.inVertex().id()),
+                    'properties': properties];
+        } else if (result instanceof Property) {
+            return ['@type': 'property', 'key': result.key(), 'value': toTyped(result.value())];
+        } else if (result instanceof Geoshape) {
+            return ['@type': 'geoshape', 'shape': result.getType().toString().toLowerCase(),
+                    'coordinates': geoshapeCoordinates(result)];
+        } else if (result instanceof Map) {
+            return result.collectEntries { key, value -> [(key.toString()): toTyped(value)] };
+        } else if (result instanceof Iterable || result instanceof Iterator) {
+            return result.collect { toTyped(it) };
+        } else {
+            return result.toString();
+        }
+    }
+
+    public geoshapeCoordinates(shape) {
+    //The same lists clients use to describe a Geoshape (see neuronGetVerticesTypeGeoWithin)
+        switch (shape.getType()) {
+        case Geoshape.Type.POINT:
+            return [shape.getPoint().getLatitude(), shape.getPoint().getLongitude()];
+        case Geoshape.Type.CIRCLE:
+            return [shape.getPoint().getLatitude(), shape.getPoint().getLongitude(), shape.getRadius()];
+        default:
+            return (0..<shape.size()).collect {
+                [shape.getPoint(it).getLatitude(), shape.getPoint(it).getLongitude()]
+            }.flatten();
+        }
+    }
+
+    public void sendReply(requester, reply) {
+    /*Send a reply to whoever is waiting on it, echoing their correlation id
+      (if they sent one) so they can match it to their request.
+    */
+        def headers = new HashMap<String, String>();
+        if (requester[CORRELATION_HEADER]) {
+            headers.put(CORRELATION_HEADER, requester[CORRELATION_HEADER]);
+        }
+        if (requester[CONTENT_TYPE_HEADER] == NEURON_MSGPACK) {
+            headers.put(CONTENT_TYPE_HEADER, NEURON_MSGPACK);
+            sendBytes(requester['reply-to'], pack(reply), headers);
+        } else {
+            def body = new JsonBuilder(reply).toString();
+            //every thread sends on the one connection
+            synchronized (connection) {
+                connection.send(requester['reply-to'], body, null, headers);
+            }
+        }
+    }
+
+    public void sendBytes(destination, byte[] body, headers) {
+    /*StompConnection.send() only takes a String body, so write the frame
+      ourselves.  The content-length lets the body hold NUL bytes.
+    */
+        def frame = new StringBuilder("SEND\n");
+        frame.append("destination:").append(destination).append("\n");
+        for (header in headers) {
+            frame.append(header.key).append(":").append(header.value).append("\n");
+        }
+        frame.append("content-length:").append(body.length).append("\n\n");
+        //the extra (zero) byte ends the frame
+        synchronized (connection) {
+            connection.sendFrame(frame.toString(), Arrays.copyOf(body, body.length + 1));
+        }
+    }
+
+    public unpack(byte[] body) {
+    /*Decode a NEURON_MSGPACK body into the same maps, lists, Integers and
+      BigDecimals that JsonSlurper would have given us.
+    */
+        def unpacker = MessagePack.newDefaultUnpacker(body);
+        def message = toObject(unpacker.unpackValue());
+        unpacker.close();
+        return uninternStrings(message);
+    }
+
+    public uninternStrings(message) {
+    /*Undo wetware.neuron.intern_strings(): only the keys of the message, of its
+      statements and of their fxns are interned.  What's in them (properties,
+      args and bindings) is left as the client sent it.
+    */
+        if (!(message instanceof Map)) {
+            return message;
+        }
+        message = uninternKeys(message);
+        if (message.statements instanceof List) {
+            message.statements = message.statements.collect { statement ->
+                if (statement instanceof Map && statement.containsKey(INTERNED_INDEX['api'])) {
+                    statement = uninternKeys(statement);
+                    if (statement.fxns instanceof List) {
+                        statement.fxns = statement.fxns.collect { it instanceof Map ? uninternKeys(it) : it };
+                    }
+                }
+                return statement;
+            };
+        }
+        return message;
+    }
+
+    public uninternKeys(map) {
+        def uninterned = [:];
+        for (entry in map) {
+            def key = entry.key;
+            def item = entry.value;
+            if (key instanceof Integer && key >= 0 && key < INTERNED.size()) {
+                key = INTERNED[key];
+            }
+            if (key in INTERNED_VALUES && item instanceof Integer && item >= 0 && item < INTERNED.size()) {
+                item = INTERNED[item];
+            }
+            uninterned[key] = item;
+        }
+        return uninterned;
+    }
+
+    public toObject(value) {
+        switch (value.getValueType()) {
+        case ValueType.NIL:
+            return null;
+        case ValueType.BOOLEAN:
+            return value.asBooleanValue().getBoolean();
+        case ValueType.INTEGER:
+            def integer = value.asIntegerValue();
+            return integer.isInIntRange() ? integer.toInt() : integer.toLong();
+        case ValueType.FLOAT:
+            return BigDecimal.valueOf(value.asFloatValue().toDouble());
+        case ValueType.STRING:
+            return value.asStringValue().asString();
+        case ValueType.BINARY:
+            //clients send text, but some msgpack libraries pack it as bin
+            return new String(value.asBinaryValue().asByteArray(), "UTF-8");
+        case ValueType.ARRAY:
+            return value.asArrayValue().list().collect { toObject(it) };
+        case ValueType.MAP:
+            def map = [:];
+            for (entry in value.asMapValue().map()) {
+                map[toObject(entry.key)] = toObject(entry.value);
+            }
+            return map;
+        default:
+            return value.toString();
+        }
+    }
+
+    public byte[] pack(message) {
+    //Encode a reply as NEURON_MSGPACK, interning only its own keys (never the results)
+        def packer = MessagePack.newDefaultBufferPacker();
+        if (message instanceof Map) {
+            message = message.collectEntries { key, item ->
+                key = key.toString();
+                if (key in INTERNED_VALUES && INTERNED_INDEX.containsKey(item)) {
+                    item = INTERNED_INDEX[item];
+                }
+                [(INTERNED_INDEX.containsKey(key) ? INTERNED_INDEX[key] : key): item]
+            };
+        }
+        packValue(packer, message);
+        packer.close();
+        return packer.toByteArray();
+    }
+
+    public void packValue(packer, value) {
+        if (value == null) {
+            packer.packNil();
+        } else if (value instanceof Map) {
+            packer.packMapHeader(value.size());
+            for (entry in value) {
+                packValue(packer, entry.key instanceof Integer ? entry.key : entry.key.toString());
+                packValue(packer, entry.value);
+            }
+        } else if (value instanceof Collection) {
+            packer.packArrayHeader(value.size());
+            for (item in value) {
+                packValue(packer, item);
+            }
+        } else if (value instanceof Boolean) {
+            packer.packBoolean(value);
+        } else if (value instanceof Integer || value instanceof Long || value instanceof Short) {
+            packer.packLong(value);
+        } else if (value instanceof Number) {
+            packer.packDouble(value.doubleValue());
+        } else {
+            packer.packString(value.toString());
         }
     }
 
@@ -305,14 +1300,28 @@ public class Neuron {
     }
 
     public void run() {
+        for (int i = 0; i < NEURON_THREADS; i++) {
+            def queue = new ArrayBlockingQueue(NEURON_QUEUE_SIZE);
+            work_queues.add(queue);
+            Thread.start("neuron-worker-" + i) { work(queue) };
+        }
+        logging.info("Handling messages on " + NEURON_THREADS + " threads");
         while (true) {
             try {
                 StompFrame frame = connection.receive();
-                onMessage(frame);
-                //acking is done inside the above method
+                synchronized (connection) {
+                    connection.ack(frame);
+                }
+                dispatch(frame);
             } catch (SocketTimeoutException e) {
                 //timeouts are not fatal (but this will happen a lot, so let's not log it)
                 //logging.warn("Timeout on connection to Apollo.  Trying again (infinitely)...");
+                try {
+                    sweepCursors();
+                } catch (Exception sweep_e) {
+                    //nothing a cursor does should stop Neuron receiving
+                    logging.warn("Neuron failed to sweep cursors: " + sweep_e.toString());
+                }
             }
         }
     }
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 import logging
-import json
 
 from wetware.worker import Worker
 from wetware.neuron import Statements, Responses
@@ -14,7 +13,7 @@ class WetwareWorker(Worker):
     def on_message(self, frame):
         ### This header must not be modified ###
         transaction = super(WetwareWorker, self).on_message(frame)
-        message = json.loads(frame.body)
+        message = frame.message
         ############## End header ##############
 
         if frame.headers['destination'] == self.args['input_topic']:
@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 
-import json
 import logging
 import subprocess as sub
 
 from subprocess import call
 from wetware.worker import Worker
-from wetware.neuron import Statements, Responses
+from wetware.neuron import Statements, Responses, get_vertex_object
+
+CONDITIONAL_NEXT_TEMPLATE = "g.V().has('name', name).outE('next').has('Conditional', output).inV().valueMap()"
+NEXT_TEMPLATE = "g.V().has('name', name).out('next').valueMap()"
 
 class WetwareWorker(Worker):
 
@@ -19,7 +21,7 @@ class WetwareWorker(Worker):
     def on_message(self, frame):
         ### This header must not be modified ###
         transaction = super(WetwareWorker, self).on_message(frame)
-        message = json.loads(frame.body)
+        message = frame.message
         ############## End header ##############
 
         if frame.headers['destination'] == self.args['input_topic']:
@@ -31,8 +33,7 @@ class WetwareWorker(Worker):
     
     def performScript(self,name):
         ''' Get the named node's execution data (if any) and the names of its child nodes '''
-        statements = Statements()
-        statements.gremlin('g.V().has("name","'+name+'").valueMap()')
+        statements = get_vertex_object(name)
         print "starting script execution"
         self.publish(statements, callback=self.perform_callback)
 
@@ -43,7 +44,7 @@ class WetwareWorker(Worker):
         nodes = responses.get_vertex_objects()
         for n in nodes:
             print n
-            statements = Statements()
+            statements = Statements().typed()
             returnValue = ''
             output = ''
             param = ''
@@ -81,9 +82,9 @@ class WetwareWorker(Worker):
                 print "Set Parameter [%s] to [%s]" % (n['Param'], self.lastParam)
                 
             if 'Execute' in n and n['type'] == 'Execute_Branch':
-                statements.gremlin('g.V().has("name","'+n['name']+'").outE("next").has("Conditional","'+output+'").inV().valueMap()')
+                statements.gremlin_template(CONDITIONAL_NEXT_TEMPLATE, name=n['name'], output=output)
             else:
-                statements.gremlin('g.V().has("name","'+n['name']+'").out("next").valueMap()')
+                statements.gremlin_template(NEXT_TEMPLATE, name=n['name'])
                 
             self.publish(statements, callback=self.perform_callback)
 
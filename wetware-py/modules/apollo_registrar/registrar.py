@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 import logging
-import json
 
 from subprocess import call
 
@@ -12,7 +11,7 @@ class Registrar(Worker):
     def on_message(self, frame):
         ### This header must not be modified ###
         transaction = super(Registrar, self).on_message(frame)
-        message = json.loads(frame.body)
+        message = frame.message
         ############## End header ##############
 
         if 'username' and 'password' in message:
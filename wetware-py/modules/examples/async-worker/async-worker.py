@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 import logging
-import json
 import sys
 
 import time
@@ -21,7 +20,7 @@ class WetwareWorker(Worker):
     def on_message(self, frame):
         ### This header must not be modified ###
         transaction = super(WetwareWorker, self).on_message(frame)
-        message = json.loads(frame.body)
+        message = frame.message
         ############## End header ##############
 
         if frame.headers['destination'] == self.args['input_topic']:
@@ -62,7 +61,7 @@ class WetwareWorker(Worker):
 
     def handle_reply(self, frame, transaction):
         super(WetwareWorker, self).handle_reply(frame, transaction)
-        message = json.loads(frame.body)
+        message = frame.message
         print "GOT BACK THIS MESSAGE:"
         print message
 
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 import logging
-import json
 
 # these workers are designed to run with the module installed
 # don't use relative paths
@@ -61,7 +60,7 @@ class MySpecialWorker(Worker):
     def on_message(self, frame):
         ### This header should not be modified ###
         transaction = super(MySpecialWorker, self).on_message(frame)
-        message = json.loads(frame.body)
+        message = frame.message
         ############### End header ###############
 
         # Here is an example where just want to do work and publish results
@@ -174,7 +173,7 @@ class MySpecialWorker(Worker):
     def verify_frame(self, frame):
         ### This header must not be modified ###
         super(MySpecialWorker, self).verify_frame(frame)
-        message = json.loads(frame.body)
+        message = frame.message
         ############## End header ##############
 
         # Add verification steps here.  For example: this statement says,
@@ -13,7 +13,7 @@ class ListenerWorker(Worker):
     def on_message(self, frame):
         ### This header must not be modified ###
         transaction = super(ListenerWorker, self).on_message(frame)
-        message = json.loads(frame.body)
+        message = frame.message
         ############## End header ##############
         # if 'payload' in message:
         #     for evr in message['payload']:
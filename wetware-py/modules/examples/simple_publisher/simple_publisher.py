@@ -6,6 +6,7 @@ import sys
 
 from wetware.worker import Worker
 from wetware.worker import ApolloConnection
+from wetware.codec import DecodedFrame
 
 class PublisherWorker(Worker):
 
@@ -16,7 +17,7 @@ class PublisherWorker(Worker):
                 if self.args['expect_reply']:
                     self.publish(data, callback=self.print_reply)
                     while True:
-                        frame = self.apollo_conn.receiveFrame()
+                        frame = DecodedFrame.wrap(self.apollo_conn.receiveFrame())
                         logging.info("Received message: {0}".format(frame.info()))
                         self.on_message(frame)
                         break
@@ -25,7 +26,7 @@ class PublisherWorker(Worker):
                     break
 
     def print_reply(self, frame, context, transaction):
-        print json.dumps(json.loads(frame.body), sort_keys=True, indent=4, separators=(',', ': '))
+        print json.dumps(frame.message, sort_keys=True, indent=4, separators=(',', ': '))
 
 def main():
     logging.basicConfig(level=logging.DEBUG)
@@ -245,7 +245,6 @@ def post__stop(): pass
 
 ############################
 import logging
-import json
 
 # these workers are designed to run with the module installed
 # don't use relative paths
@@ -352,7 +351,7 @@ class MySpecialWorker(Worker):
     def on_message(self, frame):
         ### This header should not be modified ###
         transaction = super(MySpecialWorker, self).on_message(frame)
-        message = json.loads(frame.body)
+        message = frame.message
         ############### End header ###############
 
         # Here is an example where just want to do work and publish results
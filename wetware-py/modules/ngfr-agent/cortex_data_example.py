@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 import logging
-import json
 import sys
 import time
 import base64
@@ -89,7 +88,7 @@ class WetwareWorker(Worker):
     def verify_frame(self, frame):
         ### This header must not be modified ###
         super(WetwareWorker, self).verify_frame(frame)
-        message = json.loads(frame.body)
+        message = frame.message
         ############## End header ##############
 
         for key in ['statements']:
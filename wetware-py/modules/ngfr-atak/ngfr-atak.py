@@ -1,12 +1,16 @@
 #!/usr/bin/env python
 
 import logging
-import json
 
 from wetware.worker import Worker
 from wetware.worker import FrameException
 import wetware.neuron as Neuron
 
+RESPONDERS_TEMPLATE = "g.V().has('name', incident).in('responded_to').valueMap()"
+
+#TODO: determine an appropriate static radius for this search circle
+SEARCH_RADIUS = 500
+
 class WetwareWorker(Worker):
 
     #LONGTODO: move from incident_names and user_names as indexes to UUIDs
@@ -28,14 +32,15 @@ class WetwareWorker(Worker):
 
     def run_setup(self):
         #get all open incidents from Cortex
-        query = "g.V().has('type','ngfr:atak:incident').has('status', 'open').valueMap()"
-        self.publish(Neuron.gremlin(query), topic=Neuron.NEURON_DESTINATION, callback=self.handle_run_setup)
+        query = Neuron.g.V().has('type', 'ngfr:atak:incident').has('status', 'open').valueMap()
+        self.publish(Neuron.gremlin(query).typed(), topic=Neuron.NEURON_DESTINATION,
+                     callback=self.handle_run_setup)
 
     def handle_run_setup(self, frame, context, transaction):
         #received all open incidents
         responses = Neuron.Responses(frame)
         incidents = responses.get_vertex_objects()
-        responder_queries = []
+        statements = Neuron.Statements().typed()
         query_context = { 'query_order': []}
         for incident in incidents:
             incident_id = incident['incident_id']
@@ -43,12 +48,11 @@ class WetwareWorker(Worker):
                 self.open_incidents[incident_id] = incident
                 self.open_incidents[incident_id]['responders'] = {}
             #query for responders to this incident
-            query = "g.V().has('name','{0}').in('responded_to').valueMap()".format(incident['name'])
-            responder_queries.append(query)
+            statements.gremlin_template(RESPONDERS_TEMPLATE, incident=incident['name'])
             #keep track of the order of the queries
             query_context['query_order'].append(incident_id)
         logging.info("Open incidents: {0}".format(self.open_incidents))
-        self.publish(Neuron.gremlin(*responder_queries), topic=Neuron.NEURON_DESTINATION, \
+        self.publish(statements, topic=Neuron.NEURON_DESTINATION, \
                      callback=self.handle_responders, context=query_context)
 
     def handle_responders(self, frame, context, transaction):
@@ -69,7 +73,7 @@ class WetwareWorker(Worker):
     def on_message(self, frame):
         ### This header must not be modified ###
         transaction = super(WetwareWorker, self).on_message(frame)
-        message = json.loads(frame.body)
+        message = frame.message
         ############## End header ##############
 
         #Register incidents
@@ -122,8 +126,6 @@ class WetwareWorker(Worker):
             self.reply({'error':'Incident already exists.'})
 
     def analyze_incident(self, incident_id):
-        #TODO: determine an appropriate static radius for this search circle
-        SEARCH_RADIUS = 500
         #find the epicenter of the incident
         search_coords = []
         for coord in self.open_incidents[incident_id]['location']:
@@ -133,7 +135,7 @@ class WetwareWorker(Worker):
         search_coords.append(SEARCH_RADIUS)
         #query Cortex for sensors
         context = {'incident_id': incident_id}
-        statements = Neuron.Statements()
+        statements = Neuron.Statements().typed()
         statements.get_vertices_type_geo_within('sensor','location',search_coords)
         self.publish(statements, topic=Neuron.NEURON_DESTINATION, callback=self.handle_sensor_discovery, context=context)
         #goto: handle_sensor_discovery()
@@ -177,6 +179,46 @@ class WetwareWorker(Worker):
             self.store_in_cortex(sensor)
         return sensors
 
+    def on_mutations(self, mutations):
+        super(WetwareWorker, self).on_mutations(mutations)
+        #a sensor placed (or moved) near an open incident is worth listening to,
+        # and Neuron tells us when one is, so there's no need to search around
+        # every incident again
+        names = [vertex['name'] for vertex in mutations.vertices()
+                 if 'location' in vertex['keys']]
+        if not names or not self.open_incidents:
+            return
+        statements = Neuron.Statements().typed()
+        query_context = {'query_order': []}
+        for incident_id, incident in self.open_incidents.items():
+            search_coords = list(incident['location']) + [SEARCH_RADIUS]
+            statements.gremlin(Neuron.g.V().has('name', Neuron.P.within(names))
+                               .has('type', 'sensor')
+                               .has('location', Neuron.Geo.geoWithin(search_coords))
+                               .valueMap())
+            query_context['query_order'].append(incident_id)
+        self.publish(statements, topic=Neuron.NEURON_DESTINATION,
+                     callback=self.handle_new_sensors, context=query_context)
+
+    def handle_new_sensors(self, frame, context, transaction):
+        responses = Neuron.Responses(frame)
+        for index in xrange(len(responses)):
+            incident_id = context['query_order'][index]
+            #the incident may have closed in the meantime
+            if incident_id not in self.open_incidents:
+                continue
+            incident = self.open_incidents[incident_id]
+            sensors = incident.setdefault('sensors', [])
+            known = set(sensor['name'] for sensor in sensors)
+            for sensor in responses.get_vertex_objects(index):
+                if sensor['name'] in known:
+                    continue
+                logging.info("New sensor {0} near incident {1}".format(
+                    sensor['name'], incident_id))
+                sensors.append(sensor)
+                for event in self.analyze_sensor_context(sensor, incident_id):
+                    self.register_sensor_event(event, incident_id)
+
     def register_sensor_events(self, incident_id):
         if incident_id in self.open_incidents:
             for sensor in self.open_incidents[incident_id]['sensors']:
@@ -314,7 +356,7 @@ class WetwareWorker(Worker):
     def verify_frame(self, frame):
         ### This header must not be modified ###
         super(WetwareWorker, self).verify_frame(frame)
-        message = json.loads(frame.body)
+        message = frame.message
         ############## End header ##############
 
         #TODO: update this (always)
@@ -1,11 +1,11 @@
 #!/usr/bin/env python
 
 import logging
-import json
 import time
 
 from wetware.worker import Worker
 from wetware.worker import ApolloConnection
+from wetware.codec import decode
 
 class WetwareWorker(Worker):
 
@@ -37,7 +37,7 @@ class WetwareWorker(Worker):
     def wait_for_response(self):
         while True:
             frame = self.apollo_conn.receiveFrame()
-            message = json.loads(frame.body)
+            message = decode(frame)
             if 'alert_topics' in message:
                 for topic in message['alert_topics']:
                     try:
@@ -50,7 +50,7 @@ class WetwareWorker(Worker):
             break
 
     def ack(self, frame, context, transaction):
-        logging.debug(json.loads(frame.body))
+        logging.debug(frame.message)
 
 def main():
     logging.basicConfig(level=logging.INFO)
@@ -12,7 +12,7 @@ class WetwareWorker(Worker):
     def on_message(self, frame):
         ### This header must not be modified ###
         transaction = super(WetwareWorker, self).on_message(frame)
-        message = json.loads(frame.body)
+        message = frame.message
         ############## End header ##############
         print json.dumps(message, sort_keys=True, indent=4, separators=(',', ': '))
         if 'topic' in message:
@@ -31,7 +31,10 @@ class WetwareWorker(Worker):
 
     def run(self):
         with ApolloConnection(self.args) as self.apollo_conn:
-            self.mqtt_run()
+            try:
+                self.mqtt_run()
+            finally:
+                self.flush()
 
     def mqtt_on_connect(self, client, userdata, flags, rc):
         self.mqtt_client.subscribe("global/#")
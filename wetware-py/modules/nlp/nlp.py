@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 import logging
-import json
 import sys
 import base64
 
@@ -13,6 +12,14 @@ from wetware.neuron import Statements
 from wetware.neuron import Responses
 from wetware.neuron import get_vertex_object
 
+# Is obj within 1, 2 or 3 pred-edges of subj?
+DOES_TEMPLATES = [
+    "g.V().has('name', subj).both(pred).has('name', obj)",
+    "g.V().has('name', subj).both(pred).both(pred).simplePath().has('name', obj)",
+    "g.V().has('name', subj).both(pred).both(pred).both(pred).simplePath().has('name', obj)"
+]
+GENERIC_EDGE_TEMPLATE = "g.V().has('name', subj).out(pred).has('name', obj)"
+
 class WetwareWorker(Worker):
 
     def __init__(self, subclass_section):
@@ -21,7 +28,7 @@ class WetwareWorker(Worker):
     def on_message(self, frame):
         ### This header must not be modified ###
         transaction = super(WetwareWorker, self).on_message(frame)
-        message = json.loads(frame.body)
+        message = frame.message
         ############## End header ##############
 
         if frame.headers['destination'] == self.args['input_topic']:
@@ -93,22 +100,17 @@ class WetwareWorker(Worker):
         subj = words[1].strip()
         pred = words[2].strip() + 's' #add back indicative verb conj 's'
         obj = words[3].strip()[:-1] #take off the question mark
-        gremlins = [
-            'g.V().has("name","' + subj + '").both("' + pred + '").has("name","' + obj + '")',
-            'g.V().has("name","' + subj + '").both("' + pred + '").both("' + pred + '").simplePath().has("name","' + obj + '")',
-            'g.V().has("name","' + subj + '").both("' + pred + '").both("' + pred + '").both("' + pred + '").simplePath().has("name","' + obj + '")'
-        ]
         statements = Statements()
-        statements.gremlin(*gremlins)
+        for template in DOES_TEMPLATES:
+            statements.gremlin_template(template, subj=subj, pred=pred, obj=obj)
         return statements
 
     def parse_question_generic_edge(self, words):
         subj = words[0].strip()
         pred = words[1].strip()
         obj = words[2].strip()[:-1] #take off the question mark
-        gremlin = 'g.V().has("name","' + subj + '").out("' + pred + '").has("name","' + obj + '")'
         statements = Statements()
-        statements.gremlin(gremlin)
+        statements.gremlin_template(GENERIC_EDGE_TEMPLATE, subj=subj, pred=pred, obj=obj)
         return statements
 
     def parse_question_is(self, words):
@@ -135,7 +137,7 @@ class WetwareWorker(Worker):
         #3 within
         location_str = words[4].strip()[:-1]
         location = self.convert_coords_to_list(location_str)
-        statements = Statements()
+        statements = Statements().typed()
         statements.get_vertices_type_geo_within(type_name, 'location', location)
         return statements
 
@@ -300,9 +302,9 @@ class WetwareWorker(Worker):
                 for prop in vertex:
                     if prop in ('name', '_partition'):
                         continue
-                    elif vertex[prop] == "true":
+                    elif vertex[prop] in (True, "true"):
                         reply_str += "is {0}; ".format(prop)
-                    elif vertex[prop] == "false":
+                    elif vertex[prop] in (False, "false"):
                         reply_str += "is not {0}; ".format(prop)
                     else:
                         reply_str += "has {0} {1}; ".format(vertex[prop], prop)
@@ -375,7 +377,7 @@ class WetwareWorker(Worker):
     def verify_frame(self, frame):
         ### This header must not be modified ###
         super(WetwareWorker, self).verify_frame(frame)
-        message = json.loads(frame.body)
+        message = frame.message
         ############## End header ##############
 
         for key in ['statements']:
@@ -5,5 +5,8 @@ from distutils.core import setup
 setup(name='wetware-py',
       version='1.2.2',
       packages=['wetware'],
+      scripts=['bin/wetware-load', 'bin/wetware-export'],
       install_requires=['stompest>=2.1.6'],
+      extras_require={'async': ['stompest.async>=2.1.6', 'twisted'],
+                      'msgpack': ['msgpack>=0.5.2']},
 )
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import tempfile
+
+from twisted.internet import defer
+
+def make_worker(worker_class, subclass_section=None, **options):
+    """Build a Worker from a config file holding these [main] options, as
+    if it had been run with -c
+    """
+    config_file, path = tempfile.mkstemp(suffix='.config')
+    with os.fdopen(config_file, 'w') as config:
+        config.write("[main]\n")
+        for key, value in sorted(options.items()):
+            config.write("{0}={1}\n".format(key.upper(), value))
+        if subclass_section:
+            config.write("[{0}]\n".format(subclass_section))
+    argv = sys.argv
+    sys.argv = [argv[0], '-c', path]
+    try:
+        return worker_class(subclass_section)
+    finally:
+        sys.argv = argv
+        os.remove(path)
+
+class FakeConnection(object):
+    """Stands in for a stompest connection, remembering what was sent"""
+    def __init__(self, result=None):
+        self.sent = []
+        self.acked = []
+        self.subscribed = []
+        self.result = result
+
+    def send(self, destination, body='', headers=None, receipt=None):
+        self.sent.append((destination, body, dict(headers or {})))
+        return self.result
+
+    def ack(self, frame):
+        self.acked.append(frame)
+
+    def subscribe(self, destination, headers=None, listener=None):
+        self.subscribed.append(destination)
+        return defer.succeed(destination)
+
+    def unsubscribe(self, token):
+        self.subscribed.remove(token)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import json
+import unittest
+
+from twisted.internet import defer
+
+from wetware.async_worker import AsyncWorker
+from wetware.worker import CORRELATION_HEADER
+
+from support import make_worker
+from support import FakeConnection
+
+class TestReply(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = make_worker(AsyncWorker, apollo_host='127.0.0.1')
+        self.worker.apollo_conn = FakeConnection(defer.succeed(None))
+
+    def test_reply_echoes_headers(self):
+        self.worker.transactions['t'] = {'reply-to': '/queue/requester',
+                                         'headers': {CORRELATION_HEADER: 'c-1'}}
+        self.worker.reply({'answer': 42}, 't')
+        destination, body, headers = self.worker.apollo_conn.sent[0]
+        self.assertEqual(destination, '/queue/requester')
+        self.assertEqual(json.loads(body), {'answer': 42})
+        self.assertEqual(headers[CORRELATION_HEADER], 'c-1')
+        self.assertEqual(self.worker.transactions, {})
+
+    def test_publish_headers(self):
+        self.worker.publish({'x': 1}, '/queue/out', headers={'priority': '9'})
+        self.assertEqual(self.worker.apollo_conn.sent[0][2], {'priority': '9'})
+
+class TestFailedRequest(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = make_worker(AsyncWorker, apollo_host='127.0.0.1')
+        self.worker.apollo_conn = FakeConnection(defer.fail(ValueError("not sent")))
+
+    def test_transaction_forgotten(self):
+        failures = []
+        self.worker.publish({'x': 1}, '/queue/out', expect_reply=True).addErrback(failures.append)
+        failures[0].trap(ValueError)
+        self.assertEqual(self.worker.transactions, {})
+        self.assertEqual(self.worker.apollo_conn.subscribed, [])
+
+    def test_shared_reply_queue(self):
+        self.worker.args['shared_reply_queue'] = True
+        self.worker.args['reply_queue'] = '/queue/replies'
+        failures = []
+        self.worker.publish({'x': 1}, '/queue/out', expect_reply=True).addErrback(failures.append)
+        failures[0].trap(ValueError)
+        self.assertEqual(self.worker.transactions, {})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+import unittest
+
+from wetware.export import complete_lines
+
+class TestCompleteLines(unittest.TestCase):
+
+    def setUp(self):
+        records_file, self.path = tempfile.mkstemp(suffix='.ndjson')
+        os.close(records_file)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def contents(self, text=None):
+        if text is not None:
+            with open(self.path, 'wb') as records_file:
+                records_file.write(text)
+        with open(self.path, 'rb') as records_file:
+            return records_file.read()
+
+    def test_empty(self):
+        self.assertEqual(complete_lines(self.path), 0)
+
+    def test_complete(self):
+        self.contents('{"a": 1}\n{"b": 2}\n')
+        self.assertEqual(complete_lines(self.path), 2)
+        self.assertEqual(self.contents(), '{"a": 1}\n{"b": 2}\n')
+
+    def test_partial_last_line_is_cut_off(self):
+        self.contents('{"a": 1}\n{"b": 2}\n{"c"')
+        self.assertEqual(complete_lines(self.path), 2)
+        self.assertEqual(self.contents(), '{"a": 1}\n{"b": 2}\n')
+
+if __name__ == "__main__":
+    unittest.main()
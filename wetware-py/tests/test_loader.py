@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from wetware.loader import csv_value
+from wetware.loader import edge_tuple
+from wetware.loader import read_records
+from wetware.worker import WetwareException
+
+class TestCsv(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as records_file:
+            records_file.write(text)
+        return path
+
+    def test_numbers(self):
+        self.assertEqual(csv_value('3'), 3)
+        self.assertEqual(csv_value('2.5'), 2.5)
+        self.assertEqual(csv_value('site-\xc3\xa9'), u'site-\xe9')
+
+    def test_names_stay_text(self):
+        for column in ('name', 'from', 'label', 'to'):
+            self.assertEqual(csv_value('1001', column), u'1001')
+        self.assertEqual(csv_value('1001', 'reading'), 1001)
+
+    def test_numeric_edge_ends(self):
+        path = self.write('links.csv', "from,label,to,weight\n1001,feeds,1002,0.5\n")
+        records = [record for record, end in read_records(path)]
+        self.assertEqual([edge_tuple(record) for record in records],
+                         [(u'1001', u'feeds', u'1002', {'weight': 0.5})])
+
+    def test_resume_from_offset(self):
+        path = self.write('sensors.csv', "name,reading\n1,10\n2,\n3,30\n")
+        records = list(read_records(path))
+        self.assertEqual([record for record, end in records],
+                         [{'name': u'1', 'reading': 10}, {'name': u'2'},
+                          {'name': u'3', 'reading': 30}])
+        resumed = list(read_records(path, records[0][1]))
+        self.assertEqual(resumed, records[1:])
+
+    def test_edge_without_end(self):
+        self.assertRaises(WetwareException, edge_tuple, {'from': 'a', 'label': 'b'})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import unittest
+
+import msgpack
+
+from wetware.neuron import Statements
+from wetware.neuron import ReadCache
+from wetware.neuron import get_vertex_object
+from wetware.neuron import INTERNED
+from wetware.neuron import pack
+from wetware.neuron import unpack
+
+def groovy_object(value):
+    """Read an unpacked msgpack value as Neuron's toObject() does: msgpack
+    str becomes text, and a (raw=False) byte string left over was msgpack
+    bin, which Neuron would have taken as a byte[]
+    """
+    if isinstance(value, str):
+        raise AssertionError("Packed as msgpack bin: {0!r}".format(value))
+    if isinstance(value, dict):
+        return dict((groovy_object(key), groovy_object(item))
+                    for key, item in value.iteritems())
+    if isinstance(value, list):
+        return [groovy_object(item) for item in value]
+    return value
+
+class TestMsgpack(unittest.TestCase):
+
+    def test_strings_packed_as_text(self):
+        statements = Statements()
+        statements.add_vertex({'name': 'sensor-1', 'type': 'sensor', 'location': [1.0, 2.0]})
+        statements.add_edge('sensor-1', 'located_at', u'site-\xe9')
+        statements.bulk_upsert(vertices=[{'name': 'sensor-2', 'reading': 3}])
+        body = pack(statements)
+        groovy_object(msgpack.unpackb(body, raw=False))
+
+    def test_round_trip(self):
+        statements = Statements()
+        statements.add_vertex({'name': 'sensor-1', 'location': [1.0, 2.0]})
+        statements.gremlin("g.V().has('name', 'sensor-1').valueMap()")
+        self.assertEqual(unpack(pack(statements)), statements)
+
+    def test_user_data_is_not_interned(self):
+        properties = {'name': 'x', 'format': 3, 'api': 7, 'fxn': 'typed', 1: 'a'}
+        statements = Statements()
+        statements.add_vertex(properties)
+        statements.gremlin_template("g.V().has('api', api)", api=2)
+        statements['format'] = 'typed'
+        body = pack(statements)
+        self.assertEqual(unpack(body), statements)
+        message = msgpack.unpackb(body, raw=False)
+        add_vertex = message[INTERNED.index('statements')][0]
+        fxn = add_vertex[INTERNED.index('fxns')][0]
+        self.assertEqual(fxn[INTERNED.index('fxn')], INTERNED.index('addVertex'))
+        self.assertEqual(fxn[INTERNED.index('properties')],
+                         {'format': 3, 'api': 7, 'fxn': 'typed', 1: 'a'})
+        self.assertEqual(message[INTERNED.index('format')], INTERNED.index('typed'))
+
+    def test_results_are_not_interned(self):
+        reply = {'statements': [[{'format': 3, 'api': 'fxn', 1: 'a'}], 'typed'],
+                 'format': 'typed'}
+        self.assertEqual(unpack(pack(reply)), reply)
+        message = msgpack.unpackb(pack(reply), raw=False)
+        self.assertEqual(message[INTERNED.index('statements')], reply['statements'])
+
+class TestReadCache(unittest.TestCase):
+
+    def test_reply_older_than_a_write_is_not_kept(self):
+        cache = ReadCache(10, 60)
+        read = get_vertex_object('sensor-1')
+        keys = cache.keys(read)
+        generation = cache.generation
+        write = Statements()
+        write.add_vertex_property('sensor-1', 'status', 'on')
+        cache.invalidate(write)
+        cache.put(keys, {'statements': ['before the write']}, generation)
+        self.assertEqual(cache.get(keys), None)
+        cache.put(keys, {'statements': ['after the write']}, cache.generation)
+        self.assertEqual(cache.get(keys)['statements'], ['after the write'])
+
+    def test_other_vertices_are_still_kept(self):
+        cache = ReadCache(1, 60)
+        keys = cache.keys(get_vertex_object('sensor-1'))
+        generation = cache.generation
+        cache.forget('sensor-2')
+        cache.put(keys, {'statements': ['sensor-1']}, generation)
+        self.assertEqual(cache.get(keys)['statements'], ['sensor-1'])
+        # sensor-2 is no longer remembered as written to, so nothing older is kept
+        cache.forget('sensor-3')
+        cache.put(keys, {'statements': ['sensor-1']}, generation)
+        cache.clear()
+        cache.put(keys, {'statements': ['sensor-1']}, generation)
+        self.assertEqual(cache.get(keys), None)
+
+if __name__ == "__main__":
+    unittest.main()
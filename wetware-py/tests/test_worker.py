@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+import json
+import time
+import logging
+import random
+import unittest
+
+from stompest.protocol import StompFrame
+
+from wetware.worker import Worker
+from wetware.worker import Dispatcher
+from wetware.worker import PublishBatcher
+from wetware.worker import Acker
+from wetware.neuron import Statements
+
+from support import make_worker
+from support import FakeConnection
+
+def message_frame(message_id, destination='/queue/in'):
+    return StompFrame('MESSAGE', {'destination': destination, 'message-id': message_id,
+                                  'subscription': destination}, '{}')
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+class TestDispatcher(unittest.TestCase):
+
+    def test_per_key_ordering(self):
+        handled = []
+        def handle(key, number):
+            time.sleep(random.random() / 1000)
+            handled.append((key, number))
+        dispatcher = Dispatcher(4, 2)
+        for number in xrange(50):
+            for key in ('a', 'b', 'c', 'd', 'e'):
+                dispatcher.submit(key, handle, key, number)
+        dispatcher.shutdown()
+        self.assertEqual(len(handled), 250)
+        for key in ('a', 'b', 'c', 'd', 'e'):
+            self.assertEqual([number for handled_key, number in handled
+                              if handled_key == key], range(50))
+
+    def test_error_is_raised_by_check(self):
+        def fail():
+            raise ValueError("handler failed")
+        dispatcher = Dispatcher(1, 1)
+        logging.disable(logging.ERROR)
+        try:
+            dispatcher.submit('a', fail)
+            self.assertTrue(wait_for(lambda: not dispatcher.busy()))
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertRaises(ValueError, dispatcher.check)
+        dispatcher.check()
+        dispatcher.shutdown()
+
+class TestPublishBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+
+    def send(self, topic, body):
+        self.sent.append((topic, json.loads(body)))
+
+    def statements(self, name):
+        statements = Statements()
+        statements.add_vertex(name)
+        return statements
+
+    def test_flush_on_size(self):
+        batcher = PublishBatcher(self.send, 3, 1000000, 60)
+        for name in ('a', 'b'):
+            batcher.add('/queue/neuron', self.statements(name))
+        self.assertEqual(self.sent, [])
+        batcher.add('/queue/neuron', self.statements('c'))
+        topic, message = self.sent[0]
+        self.assertEqual(topic, '/queue/neuron')
+        self.assertEqual([statement['fxns'][0]['name'] for statement in message['statements']],
+                         ['a', 'b', 'c'])
+
+    def test_flush_on_bytes(self):
+        batcher = PublishBatcher(self.send, 100, 1, 60)
+        batcher.add('/queue/neuron', self.statements('a'))
+        self.assertEqual(len(self.sent), 1)
+
+    def test_flush_on_latency(self):
+        batcher = PublishBatcher(self.send, 100, 1000000, 0.05)
+        batcher.add('/queue/neuron', self.statements('a'))
+        batcher.add('/queue/other', self.statements('b'))
+        self.assertTrue(wait_for(lambda: len(self.sent) == 2))
+        self.assertEqual(sorted(topic for topic, message in self.sent),
+                         ['/queue/neuron', '/queue/other'])
+
+    def test_flush(self):
+        batcher = PublishBatcher(self.send, 100, 1000000, 60)
+        batcher.add('/queue/neuron', self.statements('a'))
+        batcher.add('/queue/other', self.statements('b'))
+        batcher.flush('/queue/other')
+        self.assertEqual([topic for topic, message in self.sent], ['/queue/other'])
+        batcher.flush()
+        self.assertEqual([topic for topic, message in self.sent],
+                         ['/queue/other', '/queue/neuron'])
+        batcher.flush()
+        self.assertEqual(len(self.sent), 2)
+
+    def test_worker_flushes_on_shutdown(self):
+        worker = make_worker(Worker, apollo_host='127.0.0.1', publish_batch_size=10,
+                             publish_batch_latency=60)
+        worker.apollo_conn = FakeConnection()
+        worker.publish(self.statements('a'), '/queue/neuron')
+        self.assertEqual(worker.apollo_conn.sent, [])
+        worker.flush()
+        self.assertEqual(len(worker.apollo_conn.sent), 1)
+
+class TestAcker(unittest.TestCase):
+
+    def test_acks_in_arrival_order(self):
+        acked = []
+        acker = Acker(acked.append, 2)
+        frames = [message_frame(str(number)) for number in xrange(3)]
+        for frame in frames:
+            acker.received(frame)
+        acker.handled(frames[1])
+        acker.flush()
+        # the first frame isn't handled yet, so neither can be acked
+        self.assertEqual(acked, [])
+        acker.handled(frames[0])
+        self.assertEqual(acked, [frames[1]])
+        acker.handled(frames[2])
+        self.assertEqual(acked, [frames[1]])
+        acker.flush()
+        self.assertEqual(acked, [frames[1], frames[2]])
+
+    def test_worker_acks_after_handling(self):
+        acked_while_handling = []
+        class Handler(Worker):
+            def on_message(self, frame):
+                acked_while_handling.extend(self.apollo_conn.acked)
+                if frame.headers['message-id'] == 'bad':
+                    raise ValueError("not handled")
+        worker = make_worker(Handler, apollo_host='127.0.0.1', ack_mode='batch',
+                             ack_batch_size=1)
+        worker.apollo_conn = FakeConnection()
+        frame = message_frame('good')
+        worker.acker.received(frame)
+        worker.handle_frame(frame)
+        self.assertEqual(acked_while_handling, [])
+        self.assertEqual(worker.apollo_conn.acked, [frame])
+        bad_frame = message_frame('bad')
+        worker.acker.received(bad_frame)
+        self.assertRaises(ValueError, worker.handle_frame, bad_frame)
+        worker.flush()
+        self.assertEqual(worker.apollo_conn.acked, [frame])
+
+if __name__ == "__main__":
+    unittest.main()
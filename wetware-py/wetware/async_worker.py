@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+import logging
+
+from uuid import uuid4 as UUID
+
+from twisted.internet import defer, reactor, task
+from twisted.python.failure import Failure
+
+from stompest.async import Stomp
+from stompest.async.listener import SubscriptionListener
+from stompest.protocol import StompSpec
+
+from wetware.worker import Worker
+from wetware.worker import ApolloConnection
+from wetware.worker import FrameException
+from wetware.worker import WetwareException
+from wetware.worker import ConfigException
+from wetware.worker import TimeoutException
+from wetware.worker import POLL_INTERVAL
+from wetware.worker import CORRELATION_HEADER
+from wetware.worker import format_message
+from wetware.worker import metric_destination
+from wetware.worker import subscription_headers
+from wetware.codec import DecodedFrame
+from wetware.neuron import Mutations
+from wetware.codec import CONTENT_TYPE_HEADER
+
+class AsyncWorker(Worker):
+    """AsyncWorker
+
+    Worker that runs on the Twisted reactor using stompest's asynchronous
+    client, so it never blocks on a single frame.  Instead of registering a
+    callback, publish() returns a Deferred that fires with the reply frame,
+    which lets a multi-step conversation read top to bottom:
+
+        @defer.inlineCallbacks
+        def on_message(self, frame):
+            transaction = super(MyWorker, self).on_message(frame)
+            reply = yield self.publish(statements, NEURON_DESTINATION,
+                                       expect_reply=True)
+            self.reply(Responses(reply), transaction)
+
+    Any number of requests may be outstanding at once; they all share one
+    connection to Apollo.  on_message() and run_setup() may return Deferreds.
+
+    TRANSACTION_TIMEOUT and MAX_TRANSACTIONS work as they do for Worker, except
+    that a request that times out errs back with a TimeoutException, and
+    publish() waits for a free slot instead of input being held back.
+
+    ACK_MODE may be 'immediate' or 'processed'; with 'processed', a frame is
+    acked once the Deferred returned by on_message() fires.
+    """
+    def __init__(self, subclass_section=None):
+        super(AsyncWorker, self).__init__(subclass_section)
+        if self.ack_mode == 'batch':
+            raise ConfigException("AsyncWorker does not support ACK_MODE=batch;"
+                                  " use 'processed' instead")
+        self.slots = None
+        if self.max_transactions:
+            self.slots = defer.DeferredSemaphore(self.max_transactions)
+
+    def run(self):
+        """Connect to Apollo and run the Twisted reactor until disconnected"""
+        self.start().addErrback(self.__halt)
+        reactor.run()
+
+    @defer.inlineCallbacks
+    def start(self):
+        """Connect, start listening to the input topic, then run run_setup()"""
+        self.apollo_conn = Stomp(ApolloConnection(self.args).stomp_config())
+        yield self.apollo_conn.connect()
+        self.apollo_conn.disconnected.addCallbacks(self.__stopped, self.__halt)
+        if self.transaction_timeout:
+            task.LoopingCall(self.sweep_transactions).start(POLL_INTERVAL)
+        if self.args.get('shared_reply_queue'):
+            logging.info("Subscribing to {0}".format(self.args['reply_queue']))
+            yield self.apollo_conn.subscribe(
+                self.args['reply_queue'],
+                {StompSpec.ACK_HEADER: StompSpec.ACK_CLIENT_INDIVIDUAL,
+                 StompSpec.ID_HEADER: self.args['reply_queue']},
+                listener=SubscriptionListener(self.handle_reply, ack=False))
+        if self.args.get('mutation_topic'):
+            logging.info("Subscribing to {0}".format(self.args['mutation_topic']))
+            yield self.apollo_conn.subscribe(
+                self.args['mutation_topic'],
+                {StompSpec.ACK_HEADER: StompSpec.ACK_AUTO,
+                 StompSpec.ID_HEADER: self.args['mutation_topic']},
+                listener=SubscriptionListener(self.__on_mutations, ack=False))
+        if "input_topic" in self.args and self.args['input_topic']:
+            logging.info("Subscribing to {0}".format(self.args['input_topic']))
+            yield self.subscribe(self.args['input_topic'])
+        elif not self.args.get('mutation_topic'):
+            logging.warning("No input topic was specified, so unless this"
+                            " function is overridden, nothing will happen")
+        yield defer.maybeDeferred(self.run_setup)
+
+    def stop(self):
+        """Disconnect from Apollo, which stops the reactor"""
+        return self.apollo_conn.disconnect()
+
+    def publish(self, message, topic=None, expect_reply=False, content_type=None,
+                headers=None):
+        """Publish a message to a topic using your Apollo Connection
+
+        If no topic is supplied, we'll publish to OUTPUT_TOPIC, just like
+        Worker.publish().
+
+        Returns a Deferred.  If expect_reply is set, the message goes out with
+        a reply-to header and the Deferred fires with the reply frame;
+        otherwise it fires once the message has been sent.
+
+        As with Worker.publish(), 'content_type' picks a codec other than JSON,
+        any extra STOMP headers can be passed as 'headers', and with
+        READ_CACHE_SIZE set, a vertex read may be answered from the read cache
+        (the Deferred has then already fired).
+        """
+        message_str = format_message(message, content_type)
+        headers = dict(headers or {})
+        if content_type:
+            headers[CONTENT_TYPE_HEADER] = content_type
+            headers[StompSpec.CONTENT_LENGTH_HEADER] = str(len(message_str))
+        topic = self.resolve_topic(topic)
+        if not self.apollo_conn:
+            raise WetwareException("Tried to publish a message but there is no"
+                                   " Apollo connection! (Did you try to"
+                                   " publish() without calling run() in your"
+                                   " Worker?)")
+        cache_keys = None
+        if self.read_cache is not None:
+            self.read_cache.invalidate(message)
+            if expect_reply:
+                cache_keys = self.read_cache.keys(message)
+            if cache_keys:
+                reply = self.read_cache.get(cache_keys)
+                if reply is not None:
+                    self.metrics.increment('wetware_read_cache_hits_total')
+                    return defer.succeed(DecodedFrame.holding(reply))
+                self.metrics.increment('wetware_read_cache_misses_total')
+        if not expect_reply:
+            return self.__send(topic, message_str, headers)
+        deferred = self.__request(topic, message_str, headers)
+        if cache_keys:
+            # the reply is only kept if nothing it's about is written to
+            #  before it comes back
+            deferred.addCallback(self.__remember, cache_keys, self.read_cache.generation)
+        return deferred
+
+    def __remember(self, frame, cache_keys, generation):
+        try:
+            self.read_cache.put(cache_keys, frame.message, generation)
+        except ValueError:
+            # whoever is waiting on the reply will hear about it
+            pass
+        return frame
+
+    def request(self, message, topic=None, timeout=None, headers=None, content_type=None):
+        """Not available: blocking would stop the reactor.  Use
+        publish(expect_reply=True) instead.
+        """
+        raise WetwareException("AsyncWorker can't block on request();"
+                               " use publish(expect_reply=True) instead")
+
+    @defer.inlineCallbacks
+    def __request(self, topic, message_str, headers):
+        if self.slots:
+            yield self.slots.acquire()
+        try:
+            frame = yield self.__send_request(topic, message_str, headers)
+        finally:
+            if self.slots:
+                self.slots.release()
+        defer.returnValue(frame)
+
+    @defer.inlineCallbacks
+    def __send_request(self, topic, message_str, headers):
+        transaction = str(UUID())
+        self.transactions[transaction] = {'reply': defer.Deferred(), 'temp_sub': None}
+        try:
+            if self.args.get('shared_reply_queue'):
+                headers['reply-to'] = self.args['reply_queue']
+                headers[CORRELATION_HEADER] = transaction
+            else:
+                reply_to = '/temp-queue/' + transaction
+                headers['reply-to'] = reply_to
+                # the subscription id lets stompest match the reply to its listener,
+                #  since Apollo rewrites the destination of temp-queue messages
+                self.transactions[transaction]['temp_sub'] = yield self.apollo_conn.subscribe(
+                    reply_to,
+                    {StompSpec.ACK_HEADER: StompSpec.ACK_CLIENT_INDIVIDUAL,
+                     StompSpec.ID_HEADER: transaction},
+                    listener=SubscriptionListener(self.handle_reply, ack=False))
+            yield self.__send(topic, message_str, headers)
+        except Exception:
+            # no reply is coming and no timer is armed, so nothing else would
+            #  ever forget this transaction
+            failure = Failure()
+            record = self.transactions.pop(transaction)
+            if record['temp_sub']:
+                try:
+                    self.apollo_conn.unsubscribe(record['temp_sub'])
+                except Exception:
+                    logging.exception("Couldn't unsubscribe from the reply queue of"
+                                      " transaction {0}".format(transaction))
+            failure.raiseException()
+        if self.transaction_timeout:
+            self.transactions[transaction]['timer'] = reactor.callLater(
+                self.transaction_timeout, self.__expire, transaction)
+        frame = yield self.transactions[transaction]['reply']
+        defer.returnValue(frame)
+
+    def __send(self, topic, message_str, headers):
+        deferred = self.apollo_conn.send(topic, message_str, headers=headers)
+        self.metrics.increment('wetware_published_total',
+                               destination=metric_destination(topic))
+        return deferred
+
+    def handle_reply(self, connection, frame):
+        """Fire the Deferred waiting on a reply to one of our requests"""
+        connection.ack(frame)
+        frame = DecodedFrame.wrap(frame)
+        transaction = frame.headers.get(CORRELATION_HEADER,
+                                        frame.headers[StompSpec.SUBSCRIPTION_HEADER])
+        if transaction not in self.transactions:
+            logging.warning("Somehow you got a reply that you weren't keeping"
+                            " track of: {0}".format(frame.info()))
+            return
+        record = self.transactions.pop(transaction)
+        if record.get('timer') and record['timer'].active():
+            record['timer'].cancel()
+        # not waiting on this: the listener waits for this handler to finish
+        #  before it will unsubscribe
+        if record['temp_sub']:
+            connection.unsubscribe(record['temp_sub'])
+        record['reply'].callback(frame)
+
+    def __expire(self, transaction):
+        record = self.transactions.get(transaction)
+        if record is None:
+            return
+        if record['temp_sub']:
+            self.apollo_conn.unsubscribe(record['temp_sub'])
+        try:
+            self.on_timeout(transaction, None)
+        except Exception:
+            logging.exception("on_timeout() failed for transaction"
+                              " {0}".format(transaction))
+        self.transactions.pop(transaction, None)
+        record['reply'].errback(TimeoutException(
+            "No reply within {0} seconds".format(self.transaction_timeout)))
+
+    def subscribe(self, topic):
+        """Subscribe to an additional queue/topic specified by a string
+
+        Messages will be passed to on_message().  Returns a Deferred that
+        fires with the subscription token to be passed into unsubscribe().
+        """
+        headers = subscription_headers(self.args)
+        headers[StompSpec.ID_HEADER] = topic
+        # in 'processed' mode, the listener acks each frame once it's handled
+        return self.apollo_conn.subscribe(
+            topic, headers,
+            listener=SubscriptionListener(self.__on_frame,
+                                          ack=self.ack_mode != 'immediate'))
+
+    def __on_frame(self, connection, frame):
+        frame = DecodedFrame.wrap(frame)
+        logging.info("Received message: {0}".format(frame.info()))
+        deferred = defer.maybeDeferred(self.on_message, frame)
+        # skip over bad frames, but halt on other exceptions
+        deferred.addErrback(self.__skip_bad_frame)
+        return deferred
+
+    def __on_mutations(self, connection, frame):
+        # on_mutations() may return a Deferred, as on_message() may
+        return defer.maybeDeferred(self.on_mutations, Mutations(DecodedFrame.wrap(frame)))
+
+    def __skip_bad_frame(self, failure):
+        failure.trap(FrameException)
+        logging.error(failure.getErrorMessage())
+
+    def __stopped(self, result):
+        logging.info("Closing connection to {0}:{1}".format(
+            self.args['apollo_host'],
+            self.args['apollo_port']))
+        if reactor.running:
+            reactor.stop()
+
+    def __halt(self, failure):
+        logging.error("AsyncWorker halting: {0}".format(failure.getTraceback()))
+        if reactor.running:
+            reactor.stop()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import json
+
+from stompest.protocol import StompFrame
+from stompest.protocol import StompSpec
+
+# Header naming how a frame's body is encoded
+CONTENT_TYPE_HEADER = 'content-type'
+
+# What a body is assumed to be when a frame has no content-type
+DEFAULT_CONTENT_TYPE = 'application/json'
+
+# content-type -> (decode, encode)
+CODECS = {}
+
+def register_codec(content_type, decode, encode):
+    """Register functions to decode and encode bodies of a content-type
+
+    decode() takes a frame body (a str) and returns the message; encode()
+    does the reverse.  Registering a content-type again replaces its codec,
+    so a faster JSON library can be dropped in with, for example:
+
+        register_codec('application/json', ujson.loads, ujson.dumps)
+    """
+    CODECS[content_type] = (decode, encode)
+
+register_codec(DEFAULT_CONTENT_TYPE, json.loads, json.dumps)
+
+def content_type(headers):
+    """Return the content-type of a frame, without any parameters"""
+    return headers.get(CONTENT_TYPE_HEADER, DEFAULT_CONTENT_TYPE).split(';')[0].strip()
+
+def codec(content_type):
+    """Return the (decode, encode) functions for a content-type"""
+    try:
+        return CODECS[content_type]
+    except KeyError:
+        raise ValueError("No codec registered for content-type"
+                         " '{0}'".format(content_type))
+
+def decode(frame):
+    """Return the decoded body of a frame, only decoding it once if we can"""
+    if isinstance(frame, DecodedFrame):
+        return frame.message
+    return codec(content_type(frame.headers))[0](frame.body)
+
+def encode(message, content_type=DEFAULT_CONTENT_TYPE):
+    """Encode a message for the body of a frame"""
+    return codec(content_type)[1](message)
+
+class DecodedFrame(StompFrame):
+    """A StompFrame whose body is decoded the first time it's asked for
+
+    The Worker hands every frame it receives to on_message() as one of these,
+    so read the message with 'frame.message' instead of decoding frame.body
+    yourself; it will only be decoded once, however many times it's read.
+    The codec is chosen by the frame's content-type header (JSON if there
+    isn't one).  Decoding errors are raised each time, as ValueError.
+    """
+    @classmethod
+    def wrap(cls, frame):
+        """Return a DecodedFrame sharing the command, headers and body of frame"""
+        if isinstance(frame, cls):
+            return frame
+        decoded = cls.__new__(cls)
+        decoded.__dict__.update(frame.__dict__)
+        return decoded
+
+    @classmethod
+    def holding(cls, message, headers=None):
+        """Return a DecodedFrame of a message that was never encoded, like a
+        reply answered without the broker (see wetware.neuron.ReadCache)
+        """
+        frame = cls(StompSpec.MESSAGE, dict(headers or {}))
+        frame.__dict__['_message'] = message
+        return frame
+
+    @property
+    def message(self):
+        try:
+            return self.__dict__['_message']
+        except KeyError:
+            message = codec(content_type(self.headers))[0](self.body)
+            self.__dict__['_message'] = message
+            return message
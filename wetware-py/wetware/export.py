@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import logging
+
+from wetware.worker import Worker
+from wetware.worker import ApolloConnection
+from wetware.worker import WetwareException
+from wetware.neuron import Cursor
+from wetware.neuron import graph_export
+from wetware.neuron import NEURON_DESTINATION
+from wetware.neuron import NEURON_MSGPACK
+
+class Exporter(Worker):
+    """Exporter
+
+    Streams the graph out of Neuron into an NDJSON file, one vertex or edge
+    per line, as the typed records graph_export() describes:
+
+        wetware-export -c worker.config --output backup.ndjson
+
+    Neuron reads PAGE_SIZE records at a time from a transaction of its own
+    (see Cursor), and each page is written out as soon as it arrives, so
+    neither side ever holds the whole graph.  --type exports only vertices
+    of that type and the edges out of them, and --partition just one
+    partition.  Progress is logged every REPORT_INTERVAL seconds.
+
+    With --resume, an export that stopped part way carries on where the
+    file ends instead of starting over.  The graph is read in the same order
+    each time, so this is only exact if it hasn't changed in between.
+
+    wetware-load --graph reads the file back in.
+    """
+    def __init__(self, subclass_section=None):
+        super(Exporter, self).__init__(subclass_section)
+        if not self.args.get('output'):
+            raise WetwareException("Nowhere to export to: give --output")
+        self.page_size = int(self.args['page_size'])
+        self.report_interval = float(self.args['report_interval'])
+        self.content_type = NEURON_MSGPACK if self.args.get('msgpack') else None
+        self.records = 0
+        self.started = None
+        self.next_progress = 0
+
+    def add_argparse_args(self, parser):
+        super(Exporter, self).add_argparse_args(parser)
+        parser.add_argument("--output", dest="output",
+                            help="NDJSON file to write the graph to")
+        parser.add_argument("--type", dest="type",
+                            help="Only export vertices of this type (and their edges)")
+        parser.add_argument("--vertices_only", dest="vertices_only", action="store_true",
+                            help="Leave out the edges")
+        parser.add_argument("--edges_only", dest="edges_only", action="store_true",
+                            help="Leave out the vertices")
+        parser.add_argument("--partition", dest="partition",
+                            help="Only export this Neuron partition")
+        parser.add_argument("--page_size", dest="page_size",
+                            help="Records Neuron sends at a time")
+        parser.add_argument("--resume", dest="resume", action="store_true",
+                            help="Carry on from the end of an unfinished --output")
+        parser.add_argument("--msgpack", dest="msgpack", action="store_true",
+                            help="Have Neuron send pages as NEURON_MSGPACK")
+
+    def define_default_args(self):
+        defaults = super(Exporter, self).define_default_args()
+        defaults['neuron_topic'] = NEURON_DESTINATION
+        defaults['page_size'] = "1000"
+        defaults['report_interval'] = "10"
+        return defaults
+
+    def run(self):
+        """Export the graph, appending to what's already there with --resume"""
+        elements = [element for element, left_out in (('vertices', 'edges_only'),
+                                                      ('edges', 'vertices_only'))
+                    if not self.args.get(left_out)]
+        offset = 0
+        if self.args.get('resume') and os.path.exists(self.args['output']):
+            offset = complete_lines(self.args['output'])
+            logging.info("Resuming after {0} records".format(offset))
+        statements = graph_export(elements, self.args.get('type'), offset)
+        if self.args.get('partition'):
+            statements['partition'] = self.args['partition']
+        with ApolloConnection(self.args) as self.apollo_conn:
+            with open(self.args['output'], 'ab' if offset else 'wb') as output:
+                self.started = time.time()
+                cursor = Cursor(self, statements, self.page_size,
+                                topic=self.args['neuron_topic'],
+                                content_type=self.content_type)
+                for record in cursor:
+                    output.write(json.dumps(record) + '\n')
+                    self.records += 1
+                    # a whole page has been written; make sure it's on disk
+                    if self.records % self.page_size == 0:
+                        output.flush()
+                        self.report_progress()
+        self.report_progress(final=True)
+
+    def report_progress(self, final=False):
+        """Log the throughput so far, at most once per REPORT_INTERVAL"""
+        now = time.time()
+        if not final and now < self.next_progress:
+            return
+        self.next_progress = now + self.report_interval
+        elapsed = max(now - self.started, 0.001)
+        logging.info("{0}Exported {1} records in {2:.1f}s: {3:.0f} records/s".format(
+            "Done. " if final else "", self.records, elapsed, self.records / elapsed))
+
+def complete_lines(path):
+    """Count the complete lines of a file, cutting off any partial last line"""
+    lines = 0
+    end = 0
+    with open(path, 'r+b') as records_file:
+        for line in iter(records_file.readline, ''):
+            if not line.endswith('\n'):
+                break
+            lines += 1
+            end += len(line)
+        records_file.truncate(end)
+    return lines
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    Exporter().run()
+
+if __name__ == "__main__":
+    main()
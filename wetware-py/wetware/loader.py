@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+import os
+import csv
+import json
+import time
+import logging
+import collections
+
+from wetware.worker import Worker
+from wetware.worker import ApolloConnection
+from wetware.worker import WetwareException
+from wetware.neuron import Statements
+from wetware.neuron import Responses
+from wetware.neuron import typed_vertex_objects
+from wetware.neuron import NEURON_DESTINATION
+from wetware.neuron import NEURON_MSGPACK
+
+# Columns (or keys) of an edge record naming its ends and label; the rest
+#  are the edge's properties
+EDGE_FIELDS = ('from', 'label', 'to')
+
+# CSV columns that are always text, even when they look like numbers: Neuron
+#  keeps names as strings, and edges are found by their ends' names
+TEXT_COLUMNS = ('name',) + EDGE_FIELDS
+
+# Property Neuron keeps a vertex's partition in (PARTITION_KEY in neuron.groovy);
+#  left out when loading an export, so --partition decides where it goes
+PARTITION_KEY = '_partition'
+
+class Loader(Worker):
+    """Loader
+
+    Streams vertices and edges from NDJSON or CSV files into Neuron, as
+    bulk_upsert() statements of BATCH_SIZE records each:
+
+        wetware-load -c loader.config --vertices sensors.ndjson --edges links.csv
+
+    Each line of an NDJSON vertex file is a vertex as add_vertex() takes it
+    (a dict with a 'name'); each line of an edge file has 'from', 'label' and
+    'to', and any other keys are the edge's properties.  A CSV file has the
+    same names in its header row; empty cells are left out, and cells that
+    look like numbers are sent as numbers, except for name, from, label and
+    to, which are always text.  Files ending in .csv are read as
+    CSV, anything else as NDJSON.  Vertex files are loaded before edge files,
+    and files are read a record at a time, never all at once.
+
+    --graph loads a file written by wetware-export (see wetware.export),
+    vertices and edges alike.
+
+    Up to MAX_IN_FLIGHT batches are sent before waiting on Neuron's replies,
+    so the connection is never idle.  They all share one reply queue, which
+    also has Neuron upsert them in the order they were sent, so two batches
+    never race to add the same vertex.  Throughput is logged every
+    REPORT_INTERVAL seconds.
+
+    With CHECKPOINT set, the position in each file up to which every batch
+    has been loaded is saved there as it moves on.  Run the same command
+    again after a failure and the load carries on from there; delete the
+    file to start over.  Batches are upserts, so loading one twice is safe.
+    """
+    def __init__(self, subclass_section=None):
+        super(Loader, self).__init__(subclass_section)
+        self.batch_size = int(self.args['batch_size'])
+        self.max_in_flight = int(self.args['max_in_flight'])
+        self.report_interval = float(self.args['report_interval'])
+        self.content_type = NEURON_MSGPACK if self.args.get('msgpack') else None
+        # path -> byte offset every batch before which has been loaded
+        self.checkpoint = {}
+        if self.args.get('checkpoint') and os.path.exists(self.args['checkpoint']):
+            with open(self.args['checkpoint']) as checkpoint_file:
+                self.checkpoint = json.load(checkpoint_file)
+        # batch number -> [path, end offset, done], in the order they were sent
+        self.in_flight = collections.OrderedDict()
+        self.next_batch = 0
+        self.failure = None
+        self.records = 0
+        self.added = 0
+        self.started = None
+        self.next_progress = 0
+
+    def add_argparse_args(self, parser):
+        super(Loader, self).add_argparse_args(parser)
+        parser.add_argument("--vertices", dest="vertices", action="append",
+                            help="NDJSON or CSV file of vertices (may be repeated)")
+        parser.add_argument("--edges", dest="edges", action="append",
+                            help="NDJSON or CSV file of edges (may be repeated)")
+        parser.add_argument("--graph", dest="graph", action="append",
+                            help="File written by wetware-export (may be repeated)")
+        parser.add_argument("--batch_size", dest="batch_size",
+                            help="Records per bulk_upsert() statement")
+        parser.add_argument("--max_in_flight", dest="max_in_flight",
+                            help="Batches sent before waiting on a reply")
+        parser.add_argument("--checkpoint", dest="checkpoint",
+                            help="File to save (and resume from) the load's progress")
+        parser.add_argument("--partition", dest="partition",
+                            help="Load into this Neuron partition")
+        parser.add_argument("--msgpack", dest="msgpack", action="store_true",
+                            help="Send batches as NEURON_MSGPACK")
+
+    def define_default_args(self):
+        defaults = super(Loader, self).define_default_args()
+        defaults['neuron_topic'] = NEURON_DESTINATION
+        defaults['batch_size'] = "1000"
+        defaults['max_in_flight'] = "4"
+        defaults['report_interval'] = "10"
+        defaults['shared_reply_queue'] = True
+        return defaults
+
+    def run(self):
+        """Load every file, then wait for the last of the batches"""
+        files = ([(path, 'vertices') for path in self.args.get('vertices') or []] +
+                 [(path, 'edges') for path in self.args.get('edges') or []] +
+                 [(path, 'graph') for path in self.args.get('graph') or []])
+        if not files:
+            raise WetwareException("Nothing to load: give --vertices, --edges"
+                                   " and/or --graph")
+        with ApolloConnection(self.args) as self.apollo_conn:
+            self.started = time.time()
+            for path, kind in files:
+                self.load(path, kind)
+            self.wait(0)
+        self.report_progress(final=True)
+
+    def load(self, path, kind):
+        """Send the records of one file, from its checkpoint on, in batches"""
+        offset = self.checkpoint.get(path, 0)
+        logging.info("Loading {0} from {1}{2}".format(
+            kind, path, " (resuming at byte {0})".format(offset) if offset else ""))
+        batch = []
+        batch_kind = kind
+        batch_end = offset
+        for record, end in read_records(path, offset):
+            record_kind = kind
+            if kind == 'graph':
+                record_kind, record = from_export(record)
+            # a batch is all vertices or all edges, and holds records in the
+            #  order they're in the file, so the checkpoint never skips any
+            if batch and record_kind != batch_kind:
+                self.send(path, batch_kind, batch, batch_end)
+                batch = []
+            batch_kind = record_kind
+            batch.append(record)
+            batch_end = end
+            if len(batch) >= self.batch_size:
+                self.send(path, batch_kind, batch, batch_end)
+                batch = []
+        if batch:
+            self.send(path, batch_kind, batch, batch_end)
+
+    def send(self, path, kind, batch, end):
+        """Publish a batch once fewer than MAX_IN_FLIGHT are waiting on Neuron"""
+        self.wait(self.max_in_flight - 1)
+        statements = Statements().typed()
+        if kind == 'vertices':
+            statements.bulk_upsert(vertices=batch)
+        else:
+            statements.bulk_upsert(edges=[edge_tuple(record) for record in batch])
+        if self.args.get('partition'):
+            statements['partition'] = self.args['partition']
+        number = self.next_batch
+        self.next_batch += 1
+        self.in_flight[number] = [path, end, False]
+        self.publish(statements, self.args['neuron_topic'], callback=self.on_loaded,
+                     context={'batch': number, 'records': len(batch)},
+                     content_type=self.content_type)
+
+    def wait(self, limit):
+        """Handle replies until at most 'limit' batches are waiting on one"""
+        while self.waiting() > limit:
+            self.poll()
+            self.report_progress()
+            if self.failure:
+                raise WetwareException(self.failure)
+
+    def waiting(self):
+        """Return how many batches are waiting on a reply"""
+        return sum(1 for path, end, done in self.in_flight.itervalues() if not done)
+
+    def on_loaded(self, frame, context, transaction):
+        responses = Responses(frame)
+        if responses.error or not responses or not isinstance(responses[0], dict):
+            self.failure = "Batch {0} failed: {1}".format(
+                context['batch'], responses.error or list(responses))
+            return
+        self.in_flight[context['batch']][2] = True
+        self.records += context['records']
+        self.added += responses[0].get('added', 0)
+        self.metrics.increment('wetware_loader_records_total', context['records'])
+        self.advance_checkpoint()
+
+    def on_timeout(self, transaction, context):
+        super(Loader, self).on_timeout(transaction, context)
+        self.failure = "Batch {0} timed out".format(context['batch'])
+
+    def advance_checkpoint(self):
+        """Move each file's checkpoint past the batches loaded so far in order"""
+        moved = False
+        while self.in_flight:
+            number, (path, end, done) = next(self.in_flight.iteritems())
+            if not done:
+                break
+            del self.in_flight[number]
+            self.checkpoint[path] = end
+            moved = True
+        if moved and self.args.get('checkpoint'):
+            # replaced in one step, so it's never read half-written
+            temp_path = "{0}.{1}.tmp".format(self.args['checkpoint'], os.getpid())
+            with open(temp_path, 'w') as checkpoint_file:
+                json.dump(self.checkpoint, checkpoint_file)
+            os.rename(temp_path, self.args['checkpoint'])
+
+    def report_progress(self, final=False):
+        """Log the throughput so far, at most once per REPORT_INTERVAL"""
+        now = time.time()
+        if not final and now < self.next_progress:
+            return
+        self.next_progress = now + self.report_interval
+        elapsed = max(now - self.started, 0.001)
+        logging.info("{0}Loaded {1} records ({2} new vertices) in {3:.1f}s:"
+                     " {4:.0f} records/s, {5} batches in flight".format(
+                         "Done. " if final else "", self.records, self.added,
+                         elapsed, self.records / elapsed, self.waiting()))
+
+def read_records(path, offset=0):
+    """Yield each record of an NDJSON or CSV file from a byte offset on,
+    with the offset just past it
+    """
+    with open(path, 'rb') as records_file:
+        # readline() instead of iterating, so tell() is right after each record
+        if path.lower().endswith('.csv'):
+            lines = iter(records_file.readline, '')
+            header = next(csv.reader(lines))
+            if offset:
+                records_file.seek(offset)
+            for row in csv.reader(lines):
+                record = dict((column, csv_value(cell, column))
+                              for column, cell in zip(header, row) if cell != '')
+                if record:
+                    yield record, records_file.tell()
+        else:
+            records_file.seek(offset)
+            for line in iter(records_file.readline, ''):
+                if line.strip():
+                    yield json.loads(line), records_file.tell()
+
+def from_export(record):
+    """Turn a record written by wetware-export into a vertex or edge record"""
+    if record.get('@type') == 'vertex':
+        vertex = typed_vertex_objects(record)[0]
+        vertex.pop(PARTITION_KEY, None)
+        return 'vertices', vertex
+    if record.get('@type') == 'edge':
+        edge = dict((key, value) for key, value in record['properties'].iteritems()
+                    if key != PARTITION_KEY)
+        edge.update({'from': record['from'], 'label': record['label'], 'to': record['to']})
+        return 'edges', edge
+    raise WetwareException("Not a vertex or edge from wetware-export: {0}".format(record))
+
+def csv_value(cell, column=None):
+    """Read a CSV cell as an int or float if it looks like one, unless its
+    column is one of TEXT_COLUMNS"""
+    if column in TEXT_COLUMNS:
+        return cell.decode('utf-8')
+    for number in (int, float):
+        try:
+            return number(cell)
+        except ValueError:
+            pass
+    return cell.decode('utf-8')
+
+def edge_tuple(record):
+    """Turn an edge record into the tuple bulk_upsert() takes"""
+    try:
+        return (record['from'], record['label'], record['to'],
+                dict((key, value) for key, value in record.iteritems()
+                     if key not in EDGE_FIELDS))
+    except KeyError, e:
+        raise WetwareException("Edge record without {0}: {1}".format(e, record))
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    Loader().run()
+
+if __name__ == "__main__":
+    main()
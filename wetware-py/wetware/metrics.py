@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+import os
+import time
+import logging
+import threading
+import contextlib
+import BaseHTTPServer
+
+# Upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metrics(object):
+    """Counters, latency histograms and gauges for a Worker
+
+    Every counter and histogram is named, and may be split up by labels given
+    as keyword arguments, e.g. increment('frames_received_total',
+    destination='/queue/foo').  Gauges are functions, read whenever the
+    metrics are reported.  Safe to update from any thread.
+
+    The same numbers can be read as a dict (snapshot(), for a stats message)
+    or in the Prometheus text format (prometheus()).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def increment(self, name, amount=1, **labels):
+        """Add to a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        """Record how long something took in a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {'buckets': [0] * len(BUCKETS), 'count': 0, 'sum': 0.0}
+                self.histograms[key] = histogram
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+                    break
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Record how long the 'with' block takes in a histogram"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def gauge(self, name, function):
+        """Report the value of function() under name"""
+        self.gauges[name] = function
+
+    def snapshot(self):
+        """Return every metric as a JSON-friendly dict"""
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = []
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                histograms.append({'name': name,
+                                   'labels': dict(labels),
+                                   'count': histogram['count'],
+                                   'sum': histogram['sum'],
+                                   'buckets': cumulative(histogram['buckets'])})
+        gauges = [{'name': name, 'value': function()}
+                  for name, function in sorted(self.gauges.items())]
+        return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+    def prometheus(self):
+        """Return every metric in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+        for counter in snapshot['counters']:
+            if counter['name'] not in typed:
+                typed.add(counter['name'])
+                lines.append("# TYPE {0} counter".format(counter['name']))
+            lines.append("{0}{1} {2}".format(counter['name'],
+                                             format_labels(counter['labels']),
+                                             counter['value']))
+        for histogram in snapshot['histograms']:
+            name = histogram['name']
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {0} histogram".format(name))
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                labels = dict(histogram['labels'], le=repr(bound))
+                lines.append("{0}_bucket{1} {2}".format(name, format_labels(labels), count))
+            labels = dict(histogram['labels'], le="+Inf")
+            lines.append("{0}_bucket{1} {2}".format(name, format_labels(labels),
+                                                     histogram['count']))
+            labels = format_labels(histogram['labels'])
+            lines.append("{0}_sum{1} {2!r}".format(name, labels, histogram['sum']))
+            lines.append("{0}_count{1} {2}".format(name, labels, histogram['count']))
+        for gauge in snapshot['gauges']:
+            lines.append("# TYPE {0} gauge".format(gauge['name']))
+            lines.append("{0} {1}".format(gauge['name'], gauge['value']))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write prometheus() to a file, e.g. for node_exporter's textfile collector
+
+        The file is replaced in one step, so it is never read half-written.
+        """
+        temp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write(self.prometheus())
+        os.rename(temp_path, path)
+
+    def serve(self, port):
+        """Serve prometheus() over HTTP at /metrics on a background thread
+
+        Returns the server, so it can be shut down.
+        """
+        server = BaseHTTPServer.HTTPServer(('', port), MetricsHandler)
+        server.metrics = self
+        thread = threading.Thread(target=server.serve_forever,
+                                  name="wetware-metrics-http")
+        thread.daemon = True
+        thread.start()
+        logging.info("Serving metrics at http://0.0.0.0:{0}/metrics".format(port))
+        return server
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics request: " + format % args)
+
+def cumulative(buckets):
+    """Turn per-bucket counts into running totals, as Prometheus expects"""
+    total = 0
+    totals = []
+    for count in buckets:
+        total += count
+        totals.append(total)
+    return totals
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(key, escape(value))
+                          for key, value in sorted(labels.items())) + "}"
+
+def escape(value):
+    return (str(value).replace('\\', '\\\\')
+                      .replace('"', '\\"')
+                      .replace('\n', '\\n'))
@@ -5,12 +5,57 @@
 #TODO: tenancy!
 
 import logging
-import json
 import base64
 import ast
+import copy
+import time
+import threading
+import collections
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from wetware.codec import decode
+from wetware.codec import register_codec
 
 NEURON_DESTINATION = '/queue/neuron.operation'
 
+# Where Neuron publishes what each commit changed (NEURON_CDC_TOPIC; see Mutations)
+MUTATION_DESTINATION = '/topic/neuron.mutations'
+
+# Compact binary encoding of Statements and their replies (needs msgpack)
+NEURON_MSGPACK = 'application/x-neuron-msgpack'
+
+# Keys of a message, its statements and their fxns (and the values of 'api',
+#  'fxn' and 'format') that NEURON_MSGPACK sends as their index in this list
+#  instead of spelling them out.  neuron.groovy has the same list, so only
+#  ever add to the end of it.
+INTERNED = ['statements', 'fxns', 'api', 'fxn', 'args', 'name', 'properties',
+            'property', 'value', 'type', 'label', 'fromVertex', 'toVertex',
+            'geoshape', 'partition', 'neuron', 'gremlin', 'blueprints',
+            'addVertex', 'addEdge', 'addVertexProperty', 'getVertexProperty',
+            'getVerticesTypeGeoWithin', 'V', 'E', 'has', 'hasLabel', 'out',
+            'in', 'both', 'outE', 'inE', 'values', 'valueMap', 'count',
+            'limit', 'toList', 'format', 'typed', '@type', 'id', 'key',
+            'outV', 'inV', 'shape', 'coordinates', 'vertex', 'edge',
+            'page_size', 'cursor', 'cursor_topic', 'close', 'error',
+            'atomic', 'template', 'bindings', 'predicate', 'geo',
+            'traversal', 'bulkUpsert', 'vertices', 'edges', 'added',
+            'export', 'elements', 'offset', 'from', 'to']
+INTERNED_INDEX = dict((string, index) for index, string in enumerate(INTERNED))
+INTERNED_VALUES = ('api', 'fxn', 'format')
+
+# Template for a vertex and its properties (see get_vertex_object())
+VERTEX_BY_NAME = "g.V().has('name', name).valueMap()"
+
+# Ask Neuron for results as typed structures instead of toString() text
+TYPED = 'typed'
+
+# Results per page when streaming them with a Cursor
+DEFAULT_PAGE_SIZE = 500
+
 """This is just a dictionary that automatically has arrays under the keys
    'statements' and 'responses', since that's what the Neuron API dictates.
    For publishing queries, member functions add statements to 'statements', then
@@ -18,6 +63,10 @@ NEURON_DESTINATION = '/queue/neuron.operation'
 
    You can pass a string into the constructor to immediately pass in the first
    statement value.
+
+   Statements are sent as JSON unless you publish them with
+   content_type=NEURON_MSGPACK, which is smaller and quicker to encode; Neuron
+   replies in whichever one you used.
 """
 class Statements(dict):
     def __init__(self, *msg_strings):
@@ -26,8 +75,32 @@ class Statements(dict):
             for msg in msg_strings:
                 self['statements'].append(msg)
 
+    def typed(self):
+        """Ask Neuron to reply with typed results (see Responses) instead of
+        the toString() of each one.  Returns the Statements, so you can write
+        gremlin(query).typed().
+        """
+        self['format'] = TYPED
+        return self
+
+    def atomic(self, atomic=True):
+        """Ask Neuron to run all of the statements in one transaction, so
+        they're committed together or, if any of them fails, not at all (the
+        reply then has no results, and an 'error').  Returns the Statements.
+
+        Statements that only add vertices, edges and properties already get
+        one transaction, but if it fails they're retried one at a time, so
+        the rest still go in.  atomic(False) commits each statement on its
+        own, as before.
+        """
+        self['atomic'] = atomic
+        return self
+
     def add_vertices(self, *vertices):
-        """1.2.0: Simply allows creating multiple vertices in the same invocaiton"""
+        """1.2.0: Simply allows creating multiple vertices in the same invocaiton
+
+        Each is its own statement; for many vertices, bulk_upsert() is quicker.
+        """
         for vertex in vertices:
             self.add_vertex(vertex)
 
@@ -93,6 +166,38 @@ class Statements(dict):
         statement['fxns'].append(fxn)
         self['statements'].append(statement)
 
+    def bulk_upsert(self, vertices=(), edges=()):
+        """Add or update many vertices and edges in one statement
+
+        vertices are given as for add_vertex() (names or dicts), and edges as
+        (from_vertex, label, to_vertex) or (from_vertex, label, to_vertex,
+        edge_properties) tuples, as for add_edge().  The result is the same as
+        calling those for each, but Neuron looks up all of the names at once
+        and commits once, which is far quicker for thousands of them.  Its
+        response counts the 'vertices' and 'edges', and how many vertices
+        were 'added'.
+        """
+        statement = {'fxns': [], 'api': 'neuron'}
+        fxn = {'fxn': 'bulkUpsert',
+               'vertices': [],
+               'edges': []}
+        for vertex in vertices:
+            fxn['vertices'].append({'name': self.__get_name(vertex),
+                                    'properties': self.__get_properties(vertex)})
+        for edge in edges:
+            if len(edge) not in (3, 4):
+                raise NeuronException("bulk_upsert() edges are (from_vertex, label,"
+                                      " to_vertex[, edge_properties]), not"
+                                      " {0!r}".format(edge))
+            fxn['edges'].append({'fromVertex': self.__get_name(edge[0]),
+                                 'label': edge[1],
+                                 'toVertex': self.__get_name(edge[2]),
+                                 'properties': self.__get_properties(
+                                     edge[3] if len(edge) == 4 else None)})
+        statement['fxns'].append(fxn)
+        self['statements'].append(statement)
+        return self
+
     def add_vertex_property(self, name, prop_name, prop_value):
         """Add a property of the specified key and value to the Vertex with the
         "name" provided.  If the property already exists, its value will be
@@ -135,13 +240,40 @@ class Statements(dict):
     def gremlin(self, *raw_statements):
         """Composes a list Gremlin statements to run, and each will be returned as a
         reply.  Multiple statements can be passed as arguments.
+
+        Each may be a string, or a Traversal built from g (which is sent as
+        it is, without any parsing).
         """
         for raw_statement in raw_statements:
+            if isinstance(raw_statement, Traversal):
+                self['statements'].append(raw_statement.statement())
+                continue
             #no special cases for Gremlin
             statement = self.__compose_raw_statement(raw_statement)
             statement['api'] = 'gremlin'
             self['statements'].append(statement)
 
+    def gremlin_template(self, template, **bindings):
+        """Run a Gremlin statement whose arguments may be filled in per call
+
+        The template is written like any Gremlin statement, except that an
+        argument may be the name of a binding instead of a quoted value:
+
+            statements.gremlin_template("g.V().has('name', name).out(label)",
+                                        name=vertex_name, label='knows')
+
+        Neuron parses each template once and keeps it, so reuse the same
+        text for every call.  The bindings are sent as they are (numbers stay
+        numbers), and strings are never parsed, so commas, quotes or anything
+        else in them is harmless.  A binding may also be a predicate such as
+        P.gt(5) (see Traversal).  Returns self, so calls can be chained.
+        """
+        self['statements'].append({'api': 'template',
+                                   'template': template,
+                                   'bindings': dict((name, argument(value))
+                                                    for name, value in bindings.iteritems())})
+        return self
+
     #DISCOURAGED USE
     def blueprints(self, *raw_statements):
         """DISCOURAGED USE
@@ -229,18 +361,48 @@ class Statements(dict):
    object.
 
    Feel free not to use this.
+
+   Works on replies in either JSON or NEURON_MSGPACK.
+
+   If the Statements were typed(), each response is the result itself, built
+   from dicts, lists, strings, numbers and booleans.  Vertices and edges are
+   dicts with '@type' set to 'vertex' or 'edge', an 'id', a 'label' and their
+   'properties' (a vertex's are lists, since it may have several values for
+   one key); edges also have 'outV' and 'inV' ids.  Geoshapes are lists of
+   coordinates, as you'd pass them in.  Otherwise, each is a string.
+
+   If Neuron couldn't decode or run the message, 'error' says why (and there
+   are usually no responses).
 """
 class Responses(list):
 
     def __init__(self, frame):
-        if 'statements' in json.loads(frame.body):
-            list.__init__(self, json.loads(frame.body)['statements'])
+        message = decode(frame)
+        self.typed = False
+        # set on a page of results that has more after it (see Cursor)
+        self.cursor = None
+        self.cursor_topic = None
+        self.error = None
+        if isinstance(message, dict):
+            self.cursor = message.get('cursor')
+            self.cursor_topic = message.get('cursor_topic')
+            self.error = message.get('error')
+        if isinstance(message, dict) and 'statements' in message:
+            self.typed = message.get('format') == TYPED
+            if self.typed:
+                list.__init__(self, [from_typed(result) for result in message['statements']])
+            else:
+                list.__init__(self, message['statements'])
         else:
             list.__init__(self)
 
     def get_vertex_objects(self, index=0):
         """Parses the responses and returns dicts for any well-formed vertices.
 
+        With typed results, this is a dict of properties for each vertex or
+        valueMap() in the response, with single values taken out of their
+        lists.  Otherwise, the text of the response is parsed as below.
+
         This method will only look into one response at a time (defaulting to
         the first index) because we assume each response could include
         results for completely unrelated queries.
@@ -250,6 +412,8 @@ class Responses(list):
         There's no guarantee what will happen with random response text or
         otherwise formatted gremlin query.
         """
+        if self.typed:
+            return typed_vertex_objects(self[index])
         vertices = []
         #this vertex list is one Titan/Gremlin encoded string;
         # definitely not natively interpretable by Python because it has
@@ -324,6 +488,391 @@ class Responses(list):
                 vertices.append(vertex_obj)
         return vertices
 
+class Cursor(object):
+    """Lazily iterates over the results of one Gremlin query, a page at a time
+
+    Neuron reads page_size results at a time from its own transaction and
+    keeps its place, so neither side ever holds the whole result set, and the
+    first results can be used while the rest are still being read:
+
+        for vertex in Cursor(self, gremlin("g.V().has('type','sensor')")):
+            ...
+
+    Each page is fetched with Worker.request(), so this blocks (see there for
+    'timeout').  Results are typed (see Responses).  Neuron forgets a cursor
+    left idle for too long; reading on after that raises a NeuronException.
+    Stopping early is fine: close() (also run when the iteration is dropped)
+    lets Neuron know it can let go.
+
+    Instead of a query, statements may be a graph_export().
+    """
+    def __init__(self, worker, statements, page_size=DEFAULT_PAGE_SIZE,
+                 topic=NEURON_DESTINATION, timeout=None, content_type=None):
+        if 'export' not in statements and len(statements['statements']) != 1:
+            raise NeuronException("A Cursor runs exactly one statement")
+        self.worker = worker
+        self.statements = Statements()
+        self.statements.update(statements)
+        self.statements.typed()
+        self.statements['page_size'] = page_size
+        self.page_size = page_size
+        self.topic = topic
+        self.timeout = timeout
+        self.content_type = content_type
+        self.token = None
+        self.cursor_topic = None
+
+    def __iter__(self):
+        request = self.statements
+        topic = self.topic
+        try:
+            while True:
+                responses = Responses(self.worker.request(request, topic,
+                                                          timeout=self.timeout,
+                                                          content_type=self.content_type))
+                if responses.error:
+                    raise NeuronException(responses.error)
+                self.token = responses.cursor
+                # the rest of the pages come from the Neuron holding the cursor
+                self.cursor_topic = responses.cursor_topic
+                for result in (responses[0] if responses else []):
+                    yield result
+                if not self.token:
+                    return
+                request = {'cursor': self.token, 'page_size': self.page_size}
+                topic = self.cursor_topic
+        finally:
+            self.close()
+
+    def close(self):
+        """Tell Neuron we're done with the rest of the results"""
+        if self.token:
+            token, self.token = self.token, None
+            self.worker.publish({'cursor': token, 'close': True}, self.cursor_topic,
+                                content_type=self.content_type)
+
+class Mutations(list):
+    """What one of Neuron's commits changed, read from a frame it published
+    to MUTATION_DESTINATION
+
+    Each item is a dict with an 'element' of 'vertex' (with its 'name'),
+    'edge' (with its 'from', 'label' and 'to' vertex names) or 'graph' (for
+    writes made with Gremlin or Blueprints, which Neuron can't name); the
+    property 'keys' it set; and whether it was 'added'.  Only the names and
+    keys are sent, never the values, so read what you need from Neuron.
+
+    partition is the partition the commit wrote to (or None), and committed
+    is when it was made, in seconds since the epoch.  Commits made on
+    different Neuron threads may arrive out of order.
+    """
+    def __init__(self, frame):
+        message = decode(frame)
+        if not isinstance(message, dict):
+            message = {}
+        list.__init__(self, message.get('mutations') or [])
+        self.partition = message.get('partition')
+        self.committed = None
+        if message.get('committed') is not None:
+            self.committed = message['committed'] / 1000.0
+
+    @property
+    def unnamed(self):
+        """True if anything changed that isn't named (a 'graph' mutation)"""
+        return any(mutation.get('element') == 'graph' for mutation in self)
+
+    def names(self):
+        """Return the names of the vertices changed, including the ends of
+        the edges that were
+        """
+        names = []
+        for mutation in self:
+            if mutation.get('element') == 'vertex':
+                names.append(mutation['name'])
+            elif mutation.get('element') == 'edge':
+                names.extend((mutation['from'], mutation['to']))
+        return names
+
+    def vertices(self, added=False):
+        """Return the vertex mutations, or only those that added a vertex"""
+        return [mutation for mutation in self if mutation.get('element') == 'vertex'
+                and (mutation.get('added') or not added)]
+
+class ReadCache(object):
+    """Remembers Neuron's answers to vertex reads, so asking again is free
+
+    A Worker with READ_CACHE_SIZE set in its config keeps one of these as
+    self.read_cache.  Messages made only of get_vertex_property() and
+    get_vertex_object() reads are answered from it (the callback is called
+    right away, or request() returns right away) when every answer is there,
+    and sent to Neuron otherwise, remembering the answers when they come
+    back.  Each answer is kept under its partition, vertex name, property
+    (None for the whole vertex) and whether it was typed.
+
+    Anything the same Worker publishes that writes to a vertex (add_vertex(),
+    add_vertex_property(), add_edge() or bulk_upsert()) forgets what's known
+    about it first.  Writes it can't attribute to a vertex (Gremlin steps in
+    WRITE_STEPS, and Blueprints) forget everything.  Writes by anyone else
+    are only seen with MUTATION_TOPIC set (see apply()), so answers are also
+    forgotten after ttl seconds.  At most max_size answers are kept, dropping
+    the least recently used first.
+
+    A reply to a read that was sent before a write to the same vertex may
+    come back after it, holding what was there before.  So take the cache's
+    generation when sending a read, and pass it to put() with the reply:
+    answers about vertices written to since then aren't kept.
+    """
+    # Gremlin steps that may change vertices; any of them clears the cache
+    WRITE_STEPS = ('addV', 'addE', 'addVertex', 'addEdge', 'property', 'drop')
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> (answer, expiry time), least recently used first
+        self.answers = collections.OrderedDict()
+        # vertex name -> its keys
+        self.names = {}
+        # counts what's been forgotten (see put())
+        self.generation = 0
+        # vertex name -> generation it was last forgotten in, oldest first;
+        #  the max_size most recent only, so nothing older than floor is known
+        self.written = collections.OrderedDict()
+        self.floor = 0
+
+    def keys(self, message):
+        """Return the key of each statement of a message, or None unless
+        they're all reads the cache can answer
+        """
+        if (not isinstance(message, dict) or not message.get('statements') or
+            set(message) - set(['statements', 'partition', 'format'])):
+            return None
+        partition = message.get('partition')
+        typed = message.get('format') == TYPED
+        keys = []
+        for statement in message['statements']:
+            if not isinstance(statement, dict):
+                return None
+            fxns = statement.get('fxns') or []
+            if (statement.get('api') == 'neuron' and len(fxns) == 1 and
+                fxns[0].get('fxn') == 'getVertexProperty'):
+                keys.append((partition, fxns[0]['name'], fxns[0]['property'], typed))
+            elif (statement.get('api') == 'template' and
+                  statement.get('template') == VERTEX_BY_NAME):
+                keys.append((partition, statement['bindings']['name'], None, typed))
+            else:
+                return None
+        return keys
+
+    def get(self, keys):
+        """Return the reply Neuron would give for these keys, or None if any
+        of them isn't known
+        """
+        now = time.time()
+        answers = []
+        with self.lock:
+            for key in keys:
+                answer = self.answers.get(key)
+                if answer is None or answer[1] < now:
+                    return None
+                # most recently used goes to the end
+                del self.answers[key]
+                self.answers[key] = answer
+                answers.append(answer[0])
+        reply = {'statements': copy.deepcopy(answers)}
+        if keys[0][3]:
+            reply['format'] = TYPED
+        return reply
+
+    def put(self, keys, reply, generation):
+        """Remember the answers in Neuron's reply to the reads with these keys,
+        sent when the cache was at this generation, unless their vertices
+        have been forgotten since
+        """
+        if (not isinstance(reply, dict) or reply.get('error') or
+            len(reply.get('statements') or []) != len(keys)):
+            return
+        expires = time.time() + self.ttl
+        with self.lock:
+            if self.floor > generation:
+                return
+            for key, answer in zip(keys, reply['statements']):
+                if self.written.get(key[1], 0) > generation:
+                    continue
+                self.answers.pop(key, None)
+                self.answers[key] = (answer, expires)
+                self.names.setdefault(key[1], set()).add(key)
+            while len(self.answers) > self.max_size:
+                key, _ = self.answers.popitem(last=False)
+                self.__unindex(key)
+
+    def invalidate(self, message):
+        """Forget what's known about the vertices a message writes to"""
+        if not isinstance(message, dict):
+            return
+        for statement in message.get('statements') or []:
+            if not isinstance(statement, dict):
+                continue
+            api = statement.get('api')
+            if api == 'neuron':
+                for fxn in statement.get('fxns') or []:
+                    self.forget(*written_names(fxn))
+            elif api == 'blueprints' or any(fxn.get('fxn') in self.WRITE_STEPS
+                                            for fxn in statement.get('fxns') or []):
+                self.clear()
+            elif api == 'template' and any('.' + step + '(' in statement['template']
+                                           for step in self.WRITE_STEPS):
+                self.clear()
+
+    def apply(self, mutations):
+        """Forget what's known about the vertices some Mutations changed"""
+        if mutations.unnamed:
+            self.clear()
+        else:
+            self.forget(*mutations.names())
+
+    def forget(self, *names):
+        """Forget everything known about the vertices with these names"""
+        if not names:
+            return
+        with self.lock:
+            self.generation += 1
+            for name in names:
+                for key in self.names.pop(name, ()):
+                    self.answers.pop(key, None)
+                self.written.pop(name, None)
+                self.written[name] = self.generation
+            while len(self.written) > self.max_size:
+                _, self.floor = self.written.popitem(last=False)
+
+    def clear(self):
+        """Forget everything"""
+        with self.lock:
+            self.generation += 1
+            self.floor = self.generation
+            self.written.clear()
+            self.answers.clear()
+            self.names.clear()
+
+    def __unindex(self, key):
+        keys = self.names.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.names[key[1]]
+
+def written_names(fxn):
+    """Return the names of the vertices a Neuron API function writes to"""
+    if fxn.get('fxn') in ('addVertex', 'addVertexProperty'):
+        return [fxn['name']]
+    if fxn.get('fxn') == 'addEdge':
+        return [fxn['fromVertex'], fxn['toVertex']]
+    if fxn.get('fxn') == 'bulkUpsert':
+        return ([vertex['name'] for vertex in fxn.get('vertices') or []] +
+                [edge[end] for edge in fxn.get('edges') or []
+                 for end in ('fromVertex', 'toVertex')])
+    return []
+
+class Traversal(object):
+    """A Gremlin traversal, built in Python as you would write it in Groovy
+
+    Start from g (or __ for an anonymous traversal, to pass to a step like
+    where()), and call steps on it:
+
+        statements.gremlin(g.V().has('name', name).out('knows').valueMap())
+        g.V().has('age', P.gt(30)).where(__.out('knows').count().is_(P.gte(2)))
+        g.V().has('location', Geo.geoWithin([lat, lon, radius_km]))
+
+    Each step becomes one of the {'fxn', 'args'} functions of a Gremlin
+    statement, with its arguments kept as they are (numbers stay numbers,
+    lists stay lists), so nothing is parsed on either side and predicates
+    reach Titan's indexes intact.  For steps named after Python keywords
+    (in, as, is, not, and, or), add an underscore: in_('knows').
+
+    Predicates are the methods of TinkerPop's P (P.gt(5), P.within(['a',
+    'b'])) and Titan's Geo (Geo.geoWithin(shape), with the shape given as a
+    geoshape list, as for get_vertices_type_geo_within()).
+
+    A Traversal never changes, so one can be the start of several others.
+    """
+    def __init__(self, steps=()):
+        self.steps = tuple(steps)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        fxn = name[:-1] if name.endswith('_') else name
+        def step(*args):
+            return Traversal(self.steps + ({'fxn': fxn,
+                                            'args': [argument(arg) for arg in args]},))
+        return step
+
+    def statement(self):
+        """Return this traversal as a Gremlin statement"""
+        return {'api': 'gremlin', 'fxns': [dict(step) for step in self.steps]}
+
+    def __repr__(self):
+        return 'g' + ''.join('.{0}({1})'.format(step['fxn'],
+                                                ', '.join(repr(arg) for arg in step['args']))
+                             for step in self.steps)
+
+class Predicates(object):
+    """Builds predicates of one kind: P.gt(5) is {'@type': 'predicate',
+    'fxn': 'gt', 'args': [5]}, which Neuron turns into the same call
+    """
+    def __init__(self, kind):
+        self.kind = kind
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        def predicate(*args):
+            return {'@type': self.kind, 'fxn': name,
+                    'args': [argument(arg) for arg in args]}
+        return predicate
+
+# Where traversals start, and where anonymous traversals start
+g = Traversal()
+__ = Traversal()
+
+# TinkerPop's P, and Titan's geo predicates
+P = Predicates('predicate')
+Geo = Predicates('geo')
+
+def argument(value):
+    """Return a step's argument as it is sent to Neuron"""
+    if isinstance(value, Traversal):
+        return {'@type': 'traversal', 'fxns': [dict(step) for step in value.steps]}
+    if isinstance(value, tuple):
+        return [argument(item) for item in value]
+    return value
+
+def from_typed(result):
+    """Turn the typed structures in a result into Python values"""
+    if isinstance(result, dict):
+        if result.get('@type') == 'geoshape':
+            return result['coordinates']
+        return dict((key, from_typed(value)) for key, value in result.iteritems())
+    if isinstance(result, list):
+        return [from_typed(item) for item in result]
+    return result
+
+def typed_vertex_objects(result):
+    """Return a dict of properties for each vertex or property map in a result"""
+    if not isinstance(result, list):
+        result = [result]
+    vertices = []
+    for item in result:
+        if not isinstance(item, dict) or item.get('@type') in ('edge', 'property'):
+            continue
+        properties = item['properties'] if item.get('@type') == 'vertex' else item
+        vertex_obj = {}
+        for key, values in properties.iteritems():
+            if isinstance(values, list) and len(values) == 1:
+                values = values[0]
+            vertex_obj[key] = values
+        vertices.append(vertex_obj)
+    return vertices
+
 def add_vertex_object(vertex_obj):
     """Take a Python dict and make a vertex in Neuron from it.
 
@@ -354,12 +903,12 @@ def add_vertex_object(vertex_obj):
 def get_vertex_object(*vertex_names):
     """Produce a Statements query for the vertices and all of their  properties
 
-    The ultimate response from neuron will be a string, but you can use
-    Response.get_vertex_object(response) to return the dict object.
+    The results are typed, and Responses.get_vertex_objects() will return
+    the dict object.
     """
-    statements = Statements()
+    statements = Statements().typed()
     for name in vertex_names:
-        statements.gremlin("g.V().has('name','" + str(name) + "').valueMap()")
+        statements.gremlin_template(VERTEX_BY_NAME, name=str(name))
     return statements
 
 def gremlin(*gremlins):
@@ -372,5 +921,123 @@ def gremlin(*gremlins):
         statements.gremlin(gremlin)
     return statements
 
+def gremlin_template(template, **bindings):
+    """Wrapper around Statements.gremlin_template(), like gremlin()"""
+    return Statements().gremlin_template(template, **bindings)
+
+def graph_export(elements=('vertices', 'edges'), type_name=None, offset=0):
+    """Ask Neuron for the whole graph (or a partition, set with 'partition'),
+    to read with a Cursor
+
+    The results are the vertices and then the edges, typed (see Responses),
+    and each edge also has the names of the vertices at its ends as 'from'
+    and 'to'.  With a type_name, only vertices of that type, and the edges
+    out of them, are exported.  'offset' skips that many results, to carry
+    on from where an earlier export stopped.
+    """
+    statements = Statements()
+    statements['export'] = {'elements': list(elements),
+                            'type': type_name,
+                            'offset': offset}
+    return statements
+
+def decode_strings(message):
+    """Decode byte strings (keys too) as UTF-8, so they're packed as msgpack
+    str: Neuron reads msgpack bin as a byte[], not as text
+    """
+    if isinstance(message, dict):
+        return dict((decode_strings(key), decode_strings(value))
+                    for key, value in message.iteritems())
+    if isinstance(message, (list, tuple)):
+        return [decode_strings(item) for item in message]
+    if isinstance(message, str):
+        return message.decode('utf-8')
+    return message
+
+def intern_keys(message):
+    """Swap the keys of one map in INTERNED, and its 'api', 'fxn' or 'format'
+    value, for their index"""
+    interned = {}
+    for key, value in message.iteritems():
+        if (key in INTERNED_VALUES and isinstance(value, basestring) and
+            value in INTERNED_INDEX):
+            value = INTERNED_INDEX[value]
+        interned[INTERNED_INDEX.get(key, key)] = value
+    return interned
+
+def unintern_keys(message):
+    """The reverse of intern_keys()"""
+    uninterned = {}
+    for key, value in message.iteritems():
+        if isinstance(key, (int, long)) and 0 <= key < len(INTERNED):
+            key = INTERNED[key]
+        if (key in INTERNED_VALUES and isinstance(value, (int, long)) and
+            0 <= value < len(INTERNED)):
+            value = INTERNED[value]
+        uninterned[key] = value
+    return uninterned
+
+def intern_strings(message):
+    """Intern the keys of a message, of its statements and of their fxns
+
+    Only those maps are the protocol: what's in them (properties, args,
+    bindings and results) is sent as it is, so a property called 'format'
+    or an integer key comes back unchanged.  Byte strings are also decoded
+    (see decode_strings()).
+    """
+    message = decode_strings(message)
+    if not isinstance(message, dict):
+        return message
+    if isinstance(message.get('statements'), list):
+        message['statements'] = [intern_statement(statement)
+                                 for statement in message['statements']]
+    return intern_keys(message)
+
+def intern_statement(statement):
+    # results in a reply are not statements, and are left alone
+    if not isinstance(statement, dict) or 'api' not in statement:
+        return statement
+    if isinstance(statement.get('fxns'), list):
+        statement['fxns'] = [intern_keys(fxn) if isinstance(fxn, dict) else fxn
+                             for fxn in statement['fxns']]
+    return intern_keys(statement)
+
+def unintern_strings(message):
+    """The reverse of intern_strings()"""
+    if not isinstance(message, dict):
+        return message
+    message = unintern_keys(message)
+    if isinstance(message.get('statements'), list):
+        message['statements'] = [unintern_statement(statement)
+                                 for statement in message['statements']]
+    return message
+
+def unintern_statement(statement):
+    if not isinstance(statement, dict) or INTERNED_INDEX['api'] not in statement:
+        return statement
+    statement = unintern_keys(statement)
+    if isinstance(statement.get('fxns'), list):
+        statement['fxns'] = [unintern_keys(fxn) if isinstance(fxn, dict) else fxn
+                             for fxn in statement['fxns']]
+    return statement
+
+def pack(message):
+    """Encode a message as NEURON_MSGPACK"""
+    if msgpack is None:
+        raise NeuronException("Install msgpack to use {0}".format(NEURON_MSGPACK))
+    return msgpack.packb(intern_strings(message), use_bin_type=True)
+
+def unpack(body):
+    """Decode a NEURON_MSGPACK body"""
+    if msgpack is None:
+        raise NeuronException("Install msgpack to use {0}".format(NEURON_MSGPACK))
+    options = {'raw': False}
+    # msgpack 1.0 refuses integer map keys unless told otherwise
+    if msgpack.version >= (1, 0):
+        options['strict_map_key'] = False
+    return unintern_strings(msgpack.unpackb(body, **options))
+
+register_codec(NEURON_MSGPACK, unpack, pack)
+
 class NeuronException(Exception):
     pass
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+import os
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+
+# Seconds between checks on the health of the child processes
+SUPERVISE_INTERVAL = 1.0
+
+class PreforkRunner(object):
+    """PreforkRunner
+
+    Runs several copies of a Worker, each in its own process, so a CPU-bound
+    Worker can use every core instead of being held to one by the GIL:
+
+        def main():
+            logging.basicConfig(level=logging.INFO,
+                                format="%(processName)s %(levelname)s %(message)s")
+            PreforkRunner(MyWorker, "my_worker").run()
+
+    Every copy reads the same config and subscribes to the same INPUT_TOPIC.
+    For a queue, Apollo hands each message to just one of them, so they
+    share the work as competing consumers (a topic would go to all of them).
+
+    A copy that exits with an error is started again after restart_delay
+    seconds.  With METRICS_PORT set, copy number i (counting from 0) serves
+    its metrics on METRICS_PORT + i, so each can be scraped on its own; a
+    restarted copy keeps its number, and so its port.  Log records from every copy are passed back to the parent
+    process and handled by its loggers.
+
+    SIGTERM or SIGINT stops every copy with Worker.stop(): they stop taking
+    input and finish what they have started before exiting, and run()
+    returns once they all have.
+    """
+    def __init__(self, worker_class, subclass_section=None, processes=None,
+                 restart_delay=1.0):
+        self.worker_class = worker_class
+        self.subclass_section = subclass_section
+        self.processes = processes or multiprocessing.cpu_count()
+        self.restart_delay = restart_delay
+        self.children = {}
+        # index -> when its process is due to be started again
+        self.restarts = {}
+        self.stopping = False
+        self.log_queue = None
+
+    def run(self):
+        """Start the Worker processes and supervise them until stopped"""
+        self.log_queue = multiprocessing.Queue()
+        log_thread = threading.Thread(target=self.__forward_logs,
+                                      name="wetware-prefork-logs")
+        log_thread.daemon = True
+        log_thread.start()
+        signal.signal(signal.SIGTERM, self.__stop)
+        signal.signal(signal.SIGINT, self.__stop)
+        try:
+            for index in xrange(self.processes):
+                self.__start(index)
+            while not self.stopping:
+                self.__supervise()
+                time.sleep(self.__next_check())
+            for child in self.children.values():
+                child.join()
+        finally:
+            self.log_queue.put(None)
+            log_thread.join()
+
+    def stop(self):
+        """Ask every Worker process to drain and exit"""
+        self.stopping = True
+        for child in self.children.values():
+            if child.is_alive():
+                os.kill(child.pid, signal.SIGTERM)
+
+    def __stop(self, signum, frame):
+        logging.info("Stopping {0} Worker processes".format(len(self.children)))
+        self.stop()
+
+    def __start(self, index):
+        child = multiprocessing.Process(target=run_worker,
+                                        args=(self.worker_class,
+                                              self.subclass_section,
+                                              self.log_queue, index),
+                                        name="worker-{0}".format(index))
+        child.start()
+        logging.info("Started {0} (pid {1})".format(child.name, child.pid))
+        self.children[index] = child
+
+    def __supervise(self):
+        now = time.time()
+        for index, child in self.children.items():
+            if child.is_alive() or self.stopping:
+                continue
+            child.join()
+            del self.children[index]
+            if child.exitcode == 0:
+                logging.warning("{0} exited; not restarting it".format(child.name))
+                continue
+            logging.error("{0} died with exit code {1}; restarting it in"
+                          " {2} seconds".format(child.name, child.exitcode,
+                                                self.restart_delay))
+            # not waiting here, so the others are still looked after
+            self.restarts[index] = now + self.restart_delay
+        for index, due in self.restarts.items():
+            if due <= now and not self.stopping:
+                del self.restarts[index]
+                self.__start(index)
+        if not self.children and not self.restarts:
+            logging.warning("No Worker processes left running")
+            self.stopping = True
+
+    def __next_check(self):
+        # seconds until the next check, or the next restart if that's sooner
+        if not self.restarts:
+            return SUPERVISE_INTERVAL
+        return max(0, min(SUPERVISE_INTERVAL, min(self.restarts.values()) - time.time()))
+
+    def __forward_logs(self):
+        while True:
+            record = self.log_queue.get()
+            if record is None:
+                return
+            logging.getLogger(record.name).handle(record)
+
+def run_worker(worker_class, subclass_section, log_queue, index=0):
+    """Run copy number 'index' of a Worker in a child process of a PreforkRunner"""
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(log_queue)]
+    # the parent turns Ctrl-C into a SIGTERM for each child
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    worker = worker_class(subclass_section)
+    # one port per copy, since they can't all bind the same one
+    if int(worker.args.get('metrics_port') or 0):
+        worker.args['metrics_port'] = str(int(worker.args['metrics_port']) + index)
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    worker.run()
+
+class QueueHandler(logging.Handler):
+    """Logging handler that passes records to another process over a queue"""
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            # render the message and traceback here, since the arguments
+            #  and traceback may not survive being pickled
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
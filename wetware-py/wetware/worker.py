@@ -1,21 +1,50 @@
 #!/usr/bin/env python
 
 import os
+import sys
+import errno
+import select
+import socket
+import time
 import argparse
 import ConfigParser
 import logging
 import json
 import subprocess
+import threading
+import functools
+import Queue
+import collections
 
 from uuid import uuid4 as UUID
 
 from stompest.config import StompConfig
 from stompest.sync import Stomp
 from stompest.protocol import StompSpec
+from stompest.error import StompConnectionError
+
+from wetware.metrics import Metrics
+from wetware.codec import DecodedFrame
+from wetware.codec import CONTENT_TYPE_HEADER
+from wetware.codec import decode
+from wetware.codec import encode
+from wetware.neuron import ReadCache
+from wetware.neuron import Mutations
 
 # Section of the config file for base class properties
 BASE_SECTION = "main"
 
+# Seconds to wait for a frame before checking on the Worker's other duties
+POLL_INTERVAL = 1.0
+
+# Header matching replies on a shared reply queue to the request they answer
+CORRELATION_HEADER = 'correlation-id'
+
+# STOMP ack header to subscribe with for each ACK_MODE; batch acks are cumulative
+ACK_MODES = {'immediate': StompSpec.ACK_CLIENT_INDIVIDUAL,
+             'processed': StompSpec.ACK_CLIENT_INDIVIDUAL,
+             'batch': StompSpec.ACK_CLIENT}
+
 class Worker(object):
     """Worker
 
@@ -24,31 +53,355 @@ class Worker(object):
     """
     def __init__(self, subclass_section=None):
         self.args = self.__parse_all_params(subclass_section)
+        # every reply comes back to one queue per Worker, unless configured
+        if self.args.get('shared_reply_queue') and not self.args.get('reply_queue'):
+            self.args['reply_queue'] = '/temp-queue/' + str(UUID())
         self.apollo_conn = None
         self.transactions = {}
+        self.dispatcher = None
+        # seconds a transaction may stay open; 0 means forever
+        self.transaction_timeout = float(self.args.get('transaction_timeout') or 0)
+        self.next_sweep = 0
+        # stop taking new input while this many transactions are open
+        self.max_transactions = int(self.args.get('max_transactions') or 0)
+        # input held back at the cap is never acked, so Apollo's credit
+        #  (PREFETCH) is what stops it piling up here
+        if self.max_transactions and not int(self.args.get('prefetch') or 0):
+            self.args['prefetch'] = str(self.max_transactions)
+        self.held_frames = collections.deque()
+        # when input is acked: on receipt, once handled, or once handled in bulk
+        self.ack_mode = self.args.get('ack_mode') or 'immediate'
+        if self.ack_mode not in ACK_MODES:
+            raise ConfigException("Unknown ACK_MODE: {0}".format(self.ack_mode))
+        self.acker = None
+        if self.ack_mode == 'batch':
+            ack_batch_size = int(self.args['ack_batch_size'])
+            # Apollo stops delivering once PREFETCH frames are unacked, so
+            #  don't wait for more than half of them before acking
+            prefetch = int(self.args.get('prefetch') or 0)
+            if prefetch:
+                ack_batch_size = min(ack_batch_size, max(1, prefetch / 2))
+            self.acker = Acker(self.__ack, ack_batch_size)
+        # reconnect this many times after losing Apollo; -1 means forever
+        self.reconnect_attempts = int(self.args.get('reconnect_attempts') or 0)
+        # requests still waiting on a reply, to resend after reconnecting
+        self.replay_buffer = collections.OrderedDict()
+        self.replay_buffer_size = int(self.args.get('replay_buffer_size') or 0)
+        # merge Statements headed to the same destination into fewer frames
+        self.batcher = None
+        if int(self.args.get('publish_batch_size') or 0) > 1:
+            self.batcher = PublishBatcher(self.__send_batch,
+                                          int(self.args['publish_batch_size']),
+                                          int(self.args['publish_batch_bytes']),
+                                          float(self.args['publish_batch_latency']))
+        # set by stop(); input is left alone while open requests finish
+        self.stopping = False
+        # request() calls blocked on the polling thread; input waits for them
+        self.requests_waiting = 0
+        self.metrics = Metrics()
+        self.metrics.gauge('wetware_transactions_open', lambda: len(self.transactions))
+        self.metrics.gauge('wetware_frames_held', lambda: len(self.held_frames))
+        self.next_report = 0
+        # answers to vertex reads, kept if READ_CACHE_SIZE is set
+        self.read_cache = None
+        if int(self.args.get('read_cache_size') or 0):
+            self.read_cache = ReadCache(int(self.args['read_cache_size']),
+                                        float(self.args['read_cache_ttl']))
+            self.metrics.gauge('wetware_read_cache_size',
+                               lambda: len(self.read_cache.answers))
 
     def run(self):
         """Initialize Worker and loop while waiting for input.
 
         If you want to use the Worker base class without running a service,
         you'll need to override this function, but keep the first 'with' line.
+
+        If DISPATCH_THREADS is set in the config, frames are handed off to a
+        pool of that many threads instead of being handled one at a time.
+
+        If you override this and publish with PUBLISH_BATCH_SIZE set, call
+        flush() before leaving the 'with' block.
+
+        Runs until stop() is called, then waits for open requests to finish
+        (see drain()) before returning.
         """
         with ApolloConnection(self.args) as self.apollo_conn:
-            self.run_setup()
-            # subscribe to topic and handle messages;
-            #  otherwise, just end and let something override run()
-            if "input_topic" in self.args and self.args['input_topic']:
-                while True:
-                    frame = self.apollo_conn.receiveFrame()
-                    logging.info("Received message: {0}".format(frame.info()))
+            if int(self.args.get('metrics_port') or 0):
+                try:
+                    self.metrics.serve(int(self.args['metrics_port']))
+                except socket.error, e:
+                    logging.error("Can't serve metrics on port {0}: {1}".format(
+                        self.args['metrics_port'], e))
+            try:
+                self.run_setup()
+                # subscribe to topic and handle messages;
+                #  otherwise, just end and let something override run()
+                if self.args.get('input_topic') or self.args.get('mutation_topic'):
+                    dispatch_threads = int(self.args.get('dispatch_threads') or 0)
+                    if dispatch_threads > 0:
+                        self.dispatcher = Dispatcher(dispatch_threads,
+                                                     int(self.args['dispatch_queue_size']))
                     try:
-                        self.on_message(frame)
-                    # skip over bad frames, but halt on other exceptions
-                    except FrameException, e:
-                        logging.exception(e)
-            else:
-                logging.warning("No input topic was specified, so unless this"
-                                " function is overridden, nothing will happen")
+                        while not self.stopping:
+                            self.poll()
+                        self.drain()
+                    finally:
+                        if self.dispatcher:
+                            self.dispatcher.shutdown()
+                            self.dispatcher = None
+                else:
+                    logging.warning("No input topic was specified, so unless this"
+                                    " function is overridden, nothing will happen")
+            finally:
+                self.flush()
+
+    def stop(self):
+        """Stop taking new input, so that run() returns once it has drained
+
+        Safe to call from a signal handler.  Input arriving from now on is left
+        unacked, so Apollo will hand it to another consumer once we disconnect.
+        """
+        self.stopping = True
+
+    def drain(self):
+        """Keep handling replies until no requests are waiting on them
+
+        Gives up after DRAIN_TIMEOUT seconds.  Frames already handed to the
+        dispatch pool are finished first, since they may publish requests too.
+        """
+        deadline = time.time() + float(self.args['drain_timeout'])
+        while time.time() < deadline:
+            if not (self.dispatcher and self.dispatcher.busy()) and not any(
+                    'callback' in record for record in self.transactions.values()):
+                return
+            self.poll(min(POLL_INTERVAL, max(0, deadline - time.time())))
+        logging.warning("Stopped with requests still waiting on a reply")
+
+    def poll(self, timeout=POLL_INTERVAL):
+        """Wait up to 'timeout' seconds for a frame and handle it
+
+        Also takes care of the Worker's housekeeping, like expiring old
+        transactions, so call this regularly if you override run().
+
+        While MAX_TRANSACTIONS transactions are open, new input is held back
+        (unacked, and in the order it arrived) until some of them finish;
+        replies are still handled, since they are what finishes them.  After
+        stop(), new input is held back for good.
+
+        If the connection to Apollo is lost and RECONNECT_ATTEMPTS is set,
+        this reconnects (see reconnect()) instead of raising.
+        """
+        try:
+            self.__poll(timeout)
+        except StompConnectionError, e:
+            if not self.reconnect_attempts:
+                raise
+            logging.warning("Lost connection to Apollo: {0}".format(e))
+            self.reconnect()
+
+    def __poll(self, timeout):
+        # halt if a dispatched frame failed with something
+        #  other than a FrameException
+        if self.dispatcher:
+            self.dispatcher.check()
+        self.sweep_transactions()
+        self.report_metrics()
+        if self.acker:
+            self.acker.tick()
+        if (self.held_frames and not self.at_capacity() and not self.stopping and
+            not self.requests_waiting):
+            self.dispatch(self.held_frames.popleft())
+            return
+        if not self.apollo_conn.canRead(timeout):
+            return
+        frame = DecodedFrame.wrap(self.apollo_conn.receiveFrame())
+        logging.info("Received message: {0}".format(frame.info()))
+        self.metrics.increment('wetware_frames_received_total',
+                               destination=metric_destination(frame.headers['destination']))
+        if self.acker and not self.is_reply(frame) and not self.is_mutation(frame):
+            self.acker.received(frame)
+        if ((self.at_capacity() or self.stopping or self.requests_waiting) and
+            not self.is_reply(frame)):
+            self.held_frames.append(frame)
+        else:
+            self.dispatch(frame)
+
+    def reconnect(self):
+        """Reconnect to Apollo and pick up where the Worker left off
+
+        Retries with a jittered, exponential backoff, giving up (and raising)
+        after RECONNECT_ATTEMPTS failed attempts.  Every subscription, temp-queues
+        included, is made again, then requests still waiting on a reply are
+        sent again from the replay buffer.  Input that was received but not
+        yet acked will be delivered again by Apollo, so it is dropped here.
+        """
+        try:
+            self.apollo_conn.close(flush=False)
+        except StompConnectionError:
+            pass
+        self.held_frames.clear()
+        if self.acker:
+            self.acker.reset()
+        self.apollo_conn.connect()
+        logging.info("Reconnected to Apollo; resending {0} requests".format(
+            len(self.replay_buffer)))
+        self.metrics.increment('wetware_reconnects_total')
+        for topic, message_str, headers in self.replay_buffer.values():
+            self.__send(topic, message_str, headers)
+
+    def at_capacity(self):
+        """Return True if MAX_TRANSACTIONS transactions are open"""
+        return bool(self.max_transactions and
+                    len(self.transactions) >= self.max_transactions)
+
+    def sweep_transactions(self):
+        """Expire transactions that outlived TRANSACTION_TIMEOUT
+
+        Runs at most once per POLL_INTERVAL.  Each expired transaction stops
+        listening for its reply and is passed to on_timeout() before it is
+        forgotten.
+        """
+        now = time.time()
+        if not self.transaction_timeout or now < self.next_sweep:
+            return
+        self.next_sweep = now + POLL_INTERVAL
+        for transaction, record in self.transactions.items():
+            if not record.get('deadline') or record['deadline'] > now:
+                continue
+            # claim the callback, unless handle_reply() already has
+            callback = record.pop('callback', None)
+            if not callback and 'temp_sub' in record:
+                continue
+            self.replay_buffer.pop(transaction, None)
+            if record.get('temp_sub'):
+                self.apollo_conn.unsubscribe(record['temp_sub'])
+            self.metrics.increment('wetware_transactions_timed_out_total',
+                                   destination=record.get('topic', 'incoming'))
+            try:
+                self.on_timeout(transaction, record.get('context'))
+            except Exception:
+                logging.exception("on_timeout() failed for transaction"
+                                  " {0}".format(transaction))
+            self.transactions.pop(transaction, None)
+
+    def on_timeout(self, transaction, context):
+        """Handle a transaction that outlived TRANSACTION_TIMEOUT (OVERRIDE)
+
+        Called with the transaction and whatever context was given to
+        publish(), if any.  The transaction is forgotten once this returns,
+        and a reply that shows up later is dropped.  By default, this logs
+        the timeout, and replies with an error if someone was waiting on us.
+        """
+        logging.warning("Transaction {0} timed out".format(transaction))
+        if 'reply-to' in self.transactions.get(transaction, {}):
+            self.reply({'Error': 'Timed out waiting for a reply'}, transaction)
+
+    def dispatch(self, frame):
+        """Handle a frame inline, or hand it to the dispatch pool if there is one
+
+        Frames are ordered by dispatch_key(): frames sharing a key are handled
+        one at a time, in the order they arrived.
+        """
+        if self.dispatcher and not self.is_awaited(frame):
+            self.dispatcher.submit(self.dispatch_key(frame), self.handle_frame, frame)
+        else:
+            self.handle_frame(frame)
+
+    def is_awaited(self, frame):
+        """Return True if a frame is the reply some request() is blocked on
+
+        These are handled right away, since the dispatch thread they'd be
+        queued for may be the one that's waiting on them.
+        """
+        if not self.is_reply(frame):
+            return False
+        record = self.transactions.get(self.reply_transaction(frame), {})
+        return record.get('callback') == self.receive_reply
+
+    def handle_frame(self, frame):
+        """Run on_message() for a frame, skipping over bad frames
+
+        Unless ACK_MODE is 'immediate', the frame is acked here, once it has
+        been handled (or skipped).  A frame whose handling fails any other
+        way is never acked, so Apollo will deliver it again.
+        """
+        if self.is_mutation(frame):
+            # subscribed with automatic acks, so there's nothing to ack
+            self.on_mutations(Mutations(frame))
+            return
+        destination = metric_destination(frame.headers['destination'])
+        try:
+            with self.metrics.timer('wetware_on_message_seconds', destination=destination):
+                self.on_message(frame)
+        # skip over bad frames, but halt on other exceptions
+        except FrameException, e:
+            self.metrics.increment('wetware_exceptions_total', destination=destination,
+                                   exception='FrameException')
+            logging.exception(e)
+        except Exception, e:
+            self.metrics.increment('wetware_exceptions_total', destination=destination,
+                                   exception=type(e).__name__)
+            raise
+        if self.acker:
+            self.acker.handled(frame)
+        elif self.ack_mode == 'processed' and not self.is_reply(frame):
+            self.__ack(frame)
+
+    def dispatch_key(self, frame):
+        """Return the ordering key for a frame when dispatching concurrently
+
+        This method can be overridden.  Frames with the same key are never
+        handled concurrently.  By default, replies are ordered per transaction
+        and requests carrying a correlation-id are independent of each other.
+        Everything else is ordered per requester (reply-to), falling back to
+        the destination it arrived on.
+        """
+        destination = frame.headers['destination']
+        if CORRELATION_HEADER in frame.headers:
+            return frame.headers[CORRELATION_HEADER]
+        if self.is_reply(frame):
+            return destination
+        return frame.headers.get('reply-to', destination)
+
+    def reply_transaction(self, frame):
+        """Return the transaction a reply frame answers"""
+        # replies on the shared reply queue say which request they
+        #  answer; otherwise each request had its own temp-queue
+        if CORRELATION_HEADER in frame.headers:
+            return str(frame.headers[CORRELATION_HEADER])
+        # the destination we used to subscribe looks a little different
+        #  than the destination coming in this time; hence, the weird
+        #  tuple check with string concatentation below.
+        return str(frame.headers['destination'].split('.')[-1])
+
+    def is_reply(self, frame):
+        """Return True if a frame is a reply to a request this Worker made"""
+        destination = frame.headers['destination']
+        return (destination.startswith('/queue/temp') or
+                (self.args.get('shared_reply_queue') and
+                 destination == self.args.get('reply_queue')))
+
+    def is_mutation(self, frame):
+        """Return True if a frame is one of Neuron's commits, from MUTATION_TOPIC"""
+        return bool(self.args.get('mutation_topic') and
+                    frame.headers['destination'] == self.args['mutation_topic'])
+
+    def on_mutations(self, mutations):
+        """Handle what one of Neuron's commits changed (see neuron.Mutations)
+
+        With MUTATION_TOPIC set (normally to neuron.MUTATION_DESTINATION),
+        Neuron tells every Worker listening what it changes, whoever changed
+        it, and each commit comes here instead of to on_message().  By
+        default, the vertices changed are forgotten by the read cache, if
+        there is one.
+
+        This method can be overridden (call super first!) to react to
+        changes instead of asking Neuron again and again.  These are
+        notices, not requests: they're acked on receipt, and any missed
+        while disconnected are gone.
+        """
+        if self.read_cache is not None:
+            self.read_cache.apply(mutations)
 
     def run_setup(self):
         """Run any initial publish() calls as part of setting up your Worker.
@@ -81,30 +434,36 @@ class Worker(object):
         Returns a transaction so that you may modify it in the base class and
         optionally pass it into any secondary publish calls.
         """
-        # must ack to remove from queue
-        self.apollo_conn.ack(frame)
+        # must ack to remove from queue; replies always are right away, but
+        #  other frames may wait until they have been handled (see ACK_MODE)
+        if self.ack_mode == 'immediate' or self.is_reply(frame):
+            self.__ack(frame)
 
         # check if this is something you need to reply to, and create a
         #  a transaction if so; otherwise, transaction is None
         transaction_uuid = None
         if 'reply-to' in frame.headers:
             transaction_uuid = str(UUID())
-            self.transactions[transaction_uuid] = {'reply-to': frame.headers['reply-to']}
+            self.transactions[transaction_uuid] = {'reply-to': frame.headers['reply-to'],
+                                                   'headers': reply_headers(frame),
+                                                   'deadline': self.deadline()}
 
         try:
             self.verify_frame(frame)
             # check if this is a reply you're waiting for
-            if frame.headers['destination'].startswith('/queue/temp'):
-                # the destination we used to subscribe looks a little different
-                #  than the destination coming in this time; hence, the weird
-                #  tuple check with string concatentation below.
-                transaction = str(frame.headers['destination'].split('.')[-1])
-                self.handle_reply(frame, transaction)
+            if self.is_reply(frame):
+                transaction = self.reply_transaction(frame)
+                if 'callback' in self.transactions.get(transaction, {}):
+                    self.handle_reply(frame, transaction)
+                else:
+                    logging.warning("Dropping a reply for transaction {0}, which"
+                                    " timed out or was already answered".format(transaction))
         except FrameException, e:
             # Frame not verified; send an error in reply (if expected)
             #  otherwise, just skip it and continue outside loop...
             if 'reply-to' in frame.headers:
-                self.publish({ 'Error': 'Frame failed verification' }, frame.headers['reply-to'])
+                self.publish({ 'Error': 'Frame failed verification' }, frame.headers['reply-to'],
+                             headers=reply_headers(frame))
             raise
         # returning transaction ID for subclass to pass into publish/callback
         return transaction_uuid
@@ -123,33 +482,57 @@ class Worker(object):
         """
         try:
             # calling handle_reply implies there was a transaction
-            #  with a callback and a temp_sub
-            callback = self.transactions[transaction]['callback']
-            context = self.transactions[transaction]['context']
-            temp_sub = self.transactions[transaction]['temp_sub']
-            self.apollo_conn.unsubscribe(temp_sub)
+            #  with a callback and a temp_sub (None on a shared reply queue).
+            #  Popping the callback claims it, so it can't also time out.
+            record = self.transactions[transaction]
+            callback = record.pop('callback')
+            self.replay_buffer.pop(transaction, None)
+            if 'sent' in record:
+                self.metrics.observe('wetware_reply_latency_seconds',
+                                     time.time() - record['sent'],
+                                     destination=record['topic'])
+            context = record['context']
+            temp_sub = record['temp_sub']
+            if temp_sub:
+                self.apollo_conn.unsubscribe(temp_sub)
+            cache_keys = record.pop('cache_keys', None)
+            cache_generation = record.pop('cache_generation', None)
         except (KeyError, ValueError):
             logging.exception("Somehow you got a message on a temp queue that"
                               " you weren't keeping track of. You may not have"
                               " specified a callback in publish().")
             raise
 
-        if (callback
-            and hasattr(callback, '__name__')
-            and hasattr(callback, '__call__')
-            and callback.__name__ in dir(self)):
+        if cache_keys and self.read_cache is not None:
             try:
-                callback(frame, context, transaction)
-                #delete if we're done the callback, but didn't need to reply
-                if transaction in self.transactions:
-                    del self.transactions[transaction]
-            except TypeError, e:
-                logging.exception(e)
-                raise WetwareException("You implemented a callback with an invalid definition")
-        else:
-            raise WetwareException("Invalid callback provided: {0}".format(callback))
+                self.read_cache.put(cache_keys, frame.message, cache_generation)
+            except ValueError:
+                # the callback will hear about it
+                pass
 
-    def publish(self, message, topic=None, callback=None, context=None, transaction=None):
+        try:
+            if (callback
+                and hasattr(callback, '__name__')
+                and hasattr(callback, '__call__')
+                and callback.__name__ in dir(self)):
+                try:
+                    with self.metrics.timer('wetware_callback_seconds',
+                                            callback=callback.__name__):
+                        callback(frame, context, transaction)
+                except TypeError, e:
+                    logging.exception(e)
+                    raise WetwareException("You implemented a callback with an invalid definition")
+            else:
+                raise WetwareException("Invalid callback provided: {0}".format(callback))
+        finally:
+            #delete if we're done the callback, but didn't need to reply
+            # (and didn't publish again with this transaction); even if the
+            # callback failed, since nothing else would ever delete it
+            if 'callback' not in record:
+                self.transactions.pop(transaction, None)
+
+    def publish(self, message, topic=None, callback=None, context=None, transaction=None,
+                headers=None, content_type=None):
         """Publish a message to a topic using your Apollo Connection
 
         If no topic is supplied, we'll assume you want to publish output to the
@@ -177,23 +560,28 @@ class Worker(object):
         You cannot specify a transaction without a callback--that's basically
         replying to someone and asking us to infer whom it is.  Use reply() for
         that.
-        """
 
-        # If you pass a dict, we'll convert it to JSON for you
-        if isinstance(message, dict):
-            message_str = json.dumps(message)
-        # Otherwise, we'll try to cast whatever you passed as a string
-        else:
-            message_str = str(message)
+        Any extra STOMP headers for the message can be passed as 'headers'.
+
+        To encode the message with a codec other than JSON, name its
+        'content_type' (see wetware.codec); it's sent as a header too.
+
+        If SHARED_REPLY_QUEUE is set in the config, replies come back on one
+        queue per Worker instead of a new temp-queue per request, and are
+        matched to their transaction by a correlation-id header.
+
+        If PUBLISH_BATCH_SIZE is set in the config, Statements published
+        without a callback or headers are held briefly and merged with others
+        going to the same topic (see PublishBatcher).  Anything else sent to
+        that topic goes out after them, so order is kept.
+
+        If READ_CACHE_SIZE is set in the config, vertex reads may be answered
+        from the read cache without publishing anything; the callback is then
+        called before this returns (see wetware.neuron.ReadCache).
+        """
 
         try:
-            # If no topic is provided, use the output_topic from config file
-            if not topic:
-                if 'output_topic' not in self.args:
-                    raise ConfigException("Tried to publish a message but there is no"
-                                    " output_topic specified in the config!")
-                else:
-                    topic = self.args['output_topic']
+            topic = self.resolve_topic(topic)
             # Just check to see if we've specified a topic at this point.  This
             # is totally redundant, but feels safer.
             if topic:
@@ -210,24 +598,196 @@ class Worker(object):
                 if callback and not transaction:
                     transaction = str(UUID())
                     self.transactions[transaction] = {}
+                cache_keys = None
+                if self.read_cache is not None:
+                    self.read_cache.invalidate(message)
+                    if callback:
+                        cache_keys = self.read_cache.keys(message)
+                    if cache_keys:
+                        reply = self.read_cache.get(cache_keys)
+                        if reply is not None:
+                            self.__answer_from_cache(reply, callback, context, transaction)
+                            return
+                        self.metrics.increment('wetware_read_cache_misses_total')
+                if (self.batcher and not callback and not headers and
+                    not content_type and is_batchable(message)):
+                    self.batcher.add(topic, message)
+                    return
+                if self.batcher:
+                    # anything already waiting for this topic goes out first
+                    self.batcher.flush(topic)
+                message_str = format_message(message, content_type)
+                headers = dict(headers or {})
+                if content_type:
+                    headers[CONTENT_TYPE_HEADER] = content_type
+                    # a binary body may hold NUL bytes, which would otherwise
+                    #  end the frame early
+                    headers[StompSpec.CONTENT_LENGTH_HEADER] = str(len(message_str))
                 # done with checks: now send the message registering the callback
                 if callback:
                     self.transactions[transaction]['callback'] = callback
-                    temp_sub = self.apollo_conn.subscribe('/temp-queue/' + transaction,
-                                                          {StompSpec.ACK_HEADER:
-                                                           StompSpec.ACK_CLIENT_INDIVIDUAL})
+                    self.transactions[transaction]['deadline'] = self.deadline()
+                    if self.args.get('shared_reply_queue'):
+                        temp_sub = None
+                        headers['reply-to'] = self.args['reply_queue']
+                        headers[CORRELATION_HEADER] = transaction
+                    else:
+                        temp_sub = self.apollo_conn.subscribe('/temp-queue/' + transaction,
+                                                              {StompSpec.ACK_HEADER:
+                                                               StompSpec.ACK_CLIENT_INDIVIDUAL})
+                        headers['reply-to'] = '/temp-queue/' + transaction
                     self.transactions[transaction]['temp_sub'] = temp_sub
                     self.transactions[transaction]['context'] = context
-                    self.apollo_conn.send(topic, message_str,
-                                          headers={'reply-to': '/temp-queue/' + transaction})
+                    self.transactions[transaction]['topic'] = metric_destination(topic)
+                    self.transactions[transaction]['sent'] = time.time()
+                    if cache_keys:
+                        # the reply is only kept if nothing it's about is
+                        #  written to before it comes back
+                        self.transactions[transaction]['cache_keys'] = cache_keys
+                        self.transactions[transaction]['cache_generation'] = \
+                            self.read_cache.generation
+                    self.remember_request(transaction, topic, message_str, headers)
+                    self.__send(topic, message_str, headers)
                 else:
-                    self.apollo_conn.send(topic, message_str)
+                    self.__send(topic, message_str, headers)
         except AttributeError:
             raise WetwareException("Tried to publish a message but there is no"
                                    " Apollo connection! (Did you try to"
                                    " publish() without calling run() in your"
                                    " Worker?)")
 
+    def request(self, message, topic=None, timeout=None, headers=None, content_type=None):
+        """Publish a message and wait for the reply, returning the reply frame
+
+        For when a callback would only get in the way, e.g. to page through
+        results (see wetware.neuron.Cursor).  Waits up to 'timeout' seconds
+        (TRANSACTION_TIMEOUT if not given, or forever if that's 0 too), then
+        raises a TimeoutException.
+
+        While waiting, the Worker keeps polling for the reply, but new input
+        is held back until on_message() returns, so it isn't re-entered.  On
+        a dispatch thread, it just waits for the polling thread to receive the
+        reply instead.
+        """
+        context = {'reply': None, 'done': threading.Event()}
+        transaction = str(UUID())
+        self.transactions[transaction] = {}
+        self.publish(message, topic, callback=self.receive_reply, context=context,
+                     transaction=transaction, headers=headers, content_type=content_type)
+        timeout = timeout if timeout is not None else self.transaction_timeout
+        deadline = time.time() + timeout if timeout else None
+        on_dispatch_thread = (self.dispatcher and
+                              threading.current_thread() in self.dispatcher.threads)
+        if not on_dispatch_thread:
+            self.requests_waiting += 1
+        try:
+            while not context['done'].is_set():
+                remaining = deadline - time.time() if deadline else POLL_INTERVAL
+                # gone without a reply means TRANSACTION_TIMEOUT expired it
+                if remaining <= 0 or transaction not in self.transactions:
+                    break
+                if on_dispatch_thread:
+                    context['done'].wait(min(POLL_INTERVAL, remaining))
+                else:
+                    self.poll(min(POLL_INTERVAL, remaining))
+        finally:
+            if not on_dispatch_thread:
+                self.requests_waiting -= 1
+        if not context['done'].is_set():
+            record = self.transactions.pop(transaction, None)
+            self.replay_buffer.pop(transaction, None)
+            if record and record.get('temp_sub'):
+                self.apollo_conn.unsubscribe(record['temp_sub'])
+            raise TimeoutException("No reply within {0} seconds".format(timeout))
+        return context['reply']
+
+    def receive_reply(self, frame, context, transaction):
+        """Callback that hands a reply over to the request() waiting on it"""
+        context['reply'] = frame
+        context['done'].set()
+
+    def __answer_from_cache(self, reply, callback, context, transaction):
+        # as handle_reply() would, with the reply from the read cache
+        self.metrics.increment('wetware_read_cache_hits_total')
+        record = self.transactions.get(transaction, {})
+        callback(DecodedFrame.holding(reply), context, transaction)
+        if 'callback' not in record:
+            self.transactions.pop(transaction, None)
+
+    def remember_request(self, transaction, topic, message_str, headers):
+        """Keep a request in the replay buffer until its reply arrives
+
+        Only the newest REPLAY_BUFFER_SIZE requests are kept; older ones will
+        not be resent if the connection is lost.
+        """
+        if not self.reconnect_attempts or not self.replay_buffer_size:
+            return
+        self.replay_buffer[transaction] = (topic, message_str, headers)
+        while len(self.replay_buffer) > self.replay_buffer_size:
+            dropped, _ = self.replay_buffer.popitem(last=False)
+            logging.debug("Replay buffer full; won't resend {0}".format(dropped))
+
+    def flush(self):
+        """Send any batched messages and acks right away"""
+        if self.batcher:
+            self.batcher.flush()
+        if self.acker:
+            self.acker.flush()
+
+    def report_metrics(self):
+        """Report metrics, at most once per STATS_INTERVAL
+
+        Publishes them to STATS_TOPIC and writes them to METRICS_FILE (where
+        '{pid}' is replaced by the process id), if either is configured.
+        """
+        if not (self.args.get('stats_topic') or self.args.get('metrics_file')):
+            return
+        now = time.time()
+        if now < self.next_report:
+            return
+        self.next_report = now + float(self.args['stats_interval'])
+        if self.args.get('stats_topic'):
+            stats = self.metrics.snapshot()
+            stats.update({'host': socket.gethostname(),
+                          'pid': os.getpid(),
+                          'input_topic': self.args.get('input_topic'),
+                          'time': now})
+            self.publish(stats, self.args['stats_topic'])
+        if self.args.get('metrics_file'):
+            self.metrics.write(self.args['metrics_file'].format(pid=os.getpid()))
+
+    def __ack(self, frame):
+        self.apollo_conn.ack(frame)
+        self.metrics.increment('wetware_acks_sent_total',
+                               destination=metric_destination(frame.headers['destination']))
+
+    def __send(self, topic, message_str, headers=None):
+        self.apollo_conn.send(topic, message_str, headers=headers)
+        self.metrics.increment('wetware_published_total',
+                               destination=metric_destination(topic))
+
+    def __send_batch(self, topic, body):
+        self.__send(topic, body)
+        self.metrics.increment('wetware_batches_published_total',
+                               destination=metric_destination(topic))
+
+    def deadline(self):
+        """Return when a transaction opened now should time out, if ever"""
+        if self.transaction_timeout:
+            return time.time() + self.transaction_timeout
+        return None
+
+    def resolve_topic(self, topic=None):
+        """Return the topic to publish to, defaulting to OUTPUT_TOPIC"""
+        # If no topic is provided, use the output_topic from config file
+        if not topic:
+            if 'output_topic' not in self.args:
+                raise ConfigException("Tried to publish a message but there is no"
+                                      " output_topic specified in the config!")
+            else:
+                topic = self.args['output_topic']
+        return topic
+
     def reply(self, message, transaction=None):
         """Send a reply to whomever sent you a message with a reply-to.
 
@@ -239,16 +799,24 @@ class Worker(object):
         respond to something waiting for your asynchronous call to finish. It's
         really just a convenient way to pass the transaction instead of looking
         up the destination in the transactions map.
+
+        When dispatching concurrently, there may be many transactions at once,
+        so you must always pass the transaction.
         """
+        if not transaction and self.dispatcher:
+            raise WetwareException("Tried to use reply() without a transaction"
+                                   " while dispatching concurrently!")
         if transaction and 'reply-to' in self.transactions[transaction]:
-            self.publish(message, self.transactions[transaction]['reply-to'])
+            self.publish(message, self.transactions[transaction]['reply-to'],
+                         headers=self.transactions[transaction].get('headers'))
             #delete transaction now that we've replied
             del self.transactions[transaction]
         elif len(self.transactions) == 1:
             # grab the only transaction, publish to it, and delete it
             trans_id, transaction = self.transactions.items()[0]
             if 'reply-to' in transaction:
-                self.publish(message, transaction['reply-to'])
+                self.publish(message, transaction['reply-to'],
+                             headers=transaction.get('headers'))
                 #delete transaction now that we've replied
                 del self.transactions[trans_id]
             else:
@@ -265,10 +833,10 @@ class Worker(object):
 
         Returns the subscription object to be passed into unsubscribe().  Worker
         is responsible for keeping track of subscriptions.
+
+        The subscription uses the same ACK_MODE and PREFETCH as the input topic.
         """
-        return self.apollo_conn.subscribe(topic,
-                                          {StompSpec.ACK_HEADER:
-                                           StompSpec.ACK_CLIENT_INDIVIDUAL})
+        return self.apollo_conn.subscribe(topic, subscription_headers(self.args))
 
     def unsubscribe(self, subscription):
         """Unsubscribes from a topic.
@@ -282,14 +850,16 @@ class Worker(object):
     def verify_frame(self, frame):
         """Verify a frame (OVERRIDE and SUPER)
 
-        Verify that a frame is valid JSON and has the appropriate fields.
+        Verify that a frame's body can be decoded (it's JSON, unless its
+        content-type says otherwise) and has the appropriate fields.  Read the
+        message with 'frame.message', which is only decoded once.
         This function may be overrided by a subclass to add to the verification
         but it must call the SUPER() first.
 
         Raise a FrameException if frame is invalid; no need for a return value.
         """
         try:
-            message = json.loads(frame.body)
+            message = decode(frame)
             #DEPRECATED, but serves as a good example:
             # handle "operation" messages for sync and async commands
             if ('operation' in message and
@@ -306,7 +876,7 @@ class Worker(object):
                                            'body': frame.body})
         except (TypeError, ValueError):
             # raising FrameException so we can skip it--this shouldn't be fatal
-            raise FrameException({'message': "Received an invalid JSON object in message",
+            raise FrameException({'message': "Received a message body that could not be decoded",
                                    'info': frame.info(),
                                    'body': frame.body})
 
@@ -407,6 +977,26 @@ class Worker(object):
         defaults = dict()
         defaults['apollo_host'] = "127.0.0.1"
         defaults['apollo_port'] = "61613"
+        defaults['dispatch_threads'] = "0"
+        defaults['dispatch_queue_size'] = "100"
+        defaults['transaction_timeout'] = "0"
+        defaults['max_transactions'] = "0"
+        defaults['publish_batch_size'] = "0"
+        defaults['publish_batch_bytes'] = "65536"
+        defaults['publish_batch_latency'] = "0.1"
+        defaults['prefetch'] = "0"
+        defaults['ack_mode'] = "immediate"
+        defaults['ack_batch_size'] = "100"
+        defaults['reconnect_attempts'] = "0"
+        defaults['reconnect_delay'] = "0.1"
+        defaults['max_reconnect_delay'] = "30"
+        defaults['reconnect_jitter'] = "1"
+        defaults['replay_buffer_size'] = "100"
+        defaults['drain_timeout'] = "30"
+        defaults['stats_interval'] = "60"
+        defaults['metrics_port'] = "0"
+        defaults['read_cache_size'] = "0"
+        defaults['read_cache_ttl'] = "60"
         return defaults
 
     def __parse_config_file(self, config_file_path, subclass_section=None):
@@ -451,6 +1041,42 @@ class Worker(object):
                 raise
         return config_dict
 
+def format_message(message, content_type=None):
+    """Convert a message to the string we put on the wire"""
+    if content_type:
+        return encode(message, content_type)
+    # If you pass a dict, we'll convert it to JSON for you
+    if isinstance(message, dict):
+        return json.dumps(message)
+    # Otherwise, we'll try to cast whatever you passed as a string
+    else:
+        return str(message)
+
+def is_batchable(message):
+    """True if the message is only a list of Neuron statements"""
+    return (isinstance(message, dict) and message.keys() == ['statements'] and
+            isinstance(message['statements'], list))
+
+def subscription_headers(args):
+    """Headers for subscribing to input, following ACK_MODE and PREFETCH"""
+    headers = {StompSpec.ACK_HEADER: ACK_MODES[args.get('ack_mode') or 'immediate']}
+    # Apollo's credit window: how many frames it sends before waiting on acks
+    if int(args.get('prefetch') or 0):
+        headers['credit'] = str(args['prefetch'])
+    return headers
+
+def metric_destination(destination):
+    """Destination to label metrics with, lumping temp-queues together"""
+    if destination.startswith('/temp-queue/') or destination.startswith('/queue/temp.'):
+        return 'temp-queue'
+    return destination
+
+def reply_headers(frame):
+    """Headers to echo back when replying to a frame"""
+    if CORRELATION_HEADER in frame.headers:
+        return {CORRELATION_HEADER: frame.headers[CORRELATION_HEADER]}
+    return {}
+
 def check_for_bool(value):
     if value.lower() == 'true':
         return True
@@ -502,22 +1128,316 @@ def run_command(command_args, sync=False, log_file=None, cwd=None):
                      "{0}".format(pid))
         return pid
 
+class Dispatcher(object):
+    """Bounded pool of threads for handling frames concurrently
+
+    Each thread works off its own bounded queue, and work is assigned to a
+    thread by hashing its ordering key, so work sharing a key always runs in
+    the order it was submitted.  submit() blocks while that queue is full,
+    which keeps a slow consumer from buffering the whole input topic.
+    """
+    def __init__(self, num_threads, queue_size):
+        self.queues = []
+        self.threads = []
+        self.error = None
+        for index in xrange(num_threads):
+            work_queue = Queue.Queue(queue_size)
+            thread = threading.Thread(target=self.__work, args=(work_queue,),
+                                      name="wetware-dispatch-{0}".format(index))
+            thread.daemon = True
+            thread.start()
+            self.queues.append(work_queue)
+            self.threads.append(thread)
+
+    def submit(self, key, function, *args):
+        """Queue function(*args) behind any other work with the same key"""
+        self.queues[hash(key) % len(self.queues)].put((function, args))
+
+    def check(self):
+        """Re-raise the first exception that escaped a dispatched function"""
+        if self.error:
+            error_type, error, tb = self.error
+            self.error = None
+            raise error_type, error, tb
+
+    def busy(self):
+        """Return True if any submitted work hasn't finished yet"""
+        return any(work_queue.unfinished_tasks for work_queue in self.queues)
+
+    def shutdown(self):
+        """Finish all queued work, then stop the threads"""
+        for work_queue in self.queues:
+            work_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def __work(self, work_queue):
+        while True:
+            work = work_queue.get()
+            if work is None:
+                return
+            function, args = work
+            try:
+                function(*args)
+            except Exception:
+                logging.exception("Dispatched work failed")
+                if not self.error:
+                    self.error = sys.exc_info()
+            finally:
+                work_queue.task_done()
+
+class PublishBatcher(object):
+    """Merges Neuron statements bound for the same destination
+
+    Statements added for a destination are collected into one message, which
+    is sent once it holds max_messages messages or max_bytes of statements,
+    or max_latency seconds after the first of them was added, whichever comes
+    first.  Each statement is encoded once, when it is added.
+
+    A background thread sends batches whose time is up, so the Worker does
+    not need to be polling.  An exception from sending is re-raised by the
+    next call to add() or flush().
+    """
+    def __init__(self, send, max_messages, max_bytes, max_latency):
+        self.send = send
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.batches = {}
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def add(self, topic, message):
+        """Add a message's statements to the batch for topic"""
+        # strip the brackets so lists of statements can be joined as text
+        encoded = json.dumps(message['statements'])[1:-1]
+        with self.condition:
+            self.check()
+            if not self.thread:
+                self.thread = threading.Thread(target=self.__expire_batches,
+                                               name="wetware-publish-batcher")
+                self.thread.daemon = True
+                self.thread.start()
+            batch = self.batches.get(topic)
+            if batch is None:
+                batch = {'statements': [], 'count': 0, 'bytes': 0,
+                         'deadline': time.time() + self.max_latency}
+                self.batches[topic] = batch
+                self.condition.notify()
+            if encoded:
+                batch['statements'].append(encoded)
+                batch['bytes'] += len(encoded)
+            batch['count'] += 1
+            if (batch['count'] >= self.max_messages or
+                batch['bytes'] >= self.max_bytes):
+                self.__send(topic)
+
+    def flush(self, topic=None):
+        """Send the batch for topic now, or every batch if no topic is given"""
+        with self.condition:
+            self.check()
+            for batch_topic in ([topic] if topic else self.batches.keys()):
+                if batch_topic in self.batches:
+                    self.__send(batch_topic)
+
+    def check(self):
+        """Re-raise the first exception from sending a batch"""
+        if self.error:
+            error_type, error, tb = self.error
+            self.error = None
+            raise error_type, error, tb
+
+    def __send(self, topic):
+        batch = self.batches.pop(topic)
+        self.send(topic, '{"statements": [' + ', '.join(batch['statements']) + ']}')
+
+    def __expire_batches(self):
+        with self.condition:
+            while True:
+                now = time.time()
+                for topic, batch in self.batches.items():
+                    if batch['deadline'] <= now:
+                        try:
+                            self.__send(topic)
+                        except Exception:
+                            logging.exception("Failed to publish a batch to"
+                                              " {0}".format(topic))
+                            if not self.error:
+                                self.error = sys.exc_info()
+                if self.batches:
+                    self.condition.wait(min(batch['deadline'] for batch
+                                            in self.batches.values()) - now)
+                else:
+                    self.condition.wait()
+
+class Acker(object):
+    """Acknowledges handled frames in bulk with cumulative acks
+
+    Frames are tracked per subscription in the order they were received.  Once
+    every frame up to some point has been handled, one ack for the last of them
+    covers them all; that ack is sent after batch_size frames, or by the next
+    tick() at the latest.  A frame that is never handled holds back the acks
+    for everything after it on its subscription, so Apollo will redeliver
+    them all rather than lose it.
+    """
+    def __init__(self, ack, batch_size):
+        self.ack = ack
+        self.batch_size = batch_size
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+        self.next_tick = 0
+
+    def received(self, frame):
+        """Start tracking a frame; call in the order frames arrive"""
+        with self.lock:
+            subscription = self.subscriptions.setdefault(
+                self.__subscription(frame),
+                {'frames': collections.OrderedDict(), 'last': None, 'count': 0})
+            subscription['frames'][frame.headers['message-id']] = False
+
+    def handled(self, frame):
+        """Mark a frame handled, acking its batch if that completes one"""
+        with self.lock:
+            subscription = self.subscriptions.get(self.__subscription(frame))
+            message_id = frame.headers.get('message-id')
+            if not subscription or message_id not in subscription['frames']:
+                return
+            subscription['frames'][message_id] = frame
+            # advance past every frame handled so far, in arrival order
+            frames = subscription['frames']
+            while frames and frames.itervalues().next():
+                subscription['last'] = frames.popitem(last=False)[1]
+                subscription['count'] += 1
+            if subscription['count'] >= self.batch_size:
+                self.__ack(subscription)
+
+    def tick(self):
+        """Flush, at most once per POLL_INTERVAL"""
+        now = time.time()
+        if now >= self.next_tick:
+            self.next_tick = now + POLL_INTERVAL
+            self.flush()
+
+    def reset(self):
+        """Forget every frame, e.g. after reconnecting, when acks would be stale"""
+        with self.lock:
+            self.subscriptions = {}
+
+    def flush(self):
+        """Ack everything handled so far"""
+        with self.lock:
+            for subscription in self.subscriptions.values():
+                if subscription['last']:
+                    self.__ack(subscription)
+
+    def __ack(self, subscription):
+        self.ack(subscription['last'])
+        subscription['last'] = None
+        subscription['count'] = 0
+
+    def __subscription(self, frame):
+        return frame.headers.get(StompSpec.SUBSCRIPTION_HEADER,
+                                 frame.headers['destination'])
+
+def synchronized(method):
+    """Decorate a method so it holds the instance's lock while it runs"""
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+class SynchronizedStomp(Stomp):
+    """stompest Stomp client that is safe to share between threads
+
+    Every command holds a lock, so frames written by different threads are
+    never interleaved.  Only one thread should read frames; it waits on the
+    socket without holding the lock, so other threads can keep sending while
+    it is idle.
+    """
+    def __init__(self, config):
+        super(SynchronizedStomp, self).__init__(config)
+        self._lock = threading.RLock()
+
+    connect = synchronized(Stomp.connect)
+    disconnect = synchronized(Stomp.disconnect)
+    close = synchronized(Stomp.close)
+    send = synchronized(Stomp.send)
+    subscribe = synchronized(Stomp.subscribe)
+    unsubscribe = synchronized(Stomp.unsubscribe)
+    ack = synchronized(Stomp.ack)
+    nack = synchronized(Stomp.nack)
+    begin = synchronized(Stomp.begin)
+    abort = synchronized(Stomp.abort)
+    commit = synchronized(Stomp.commit)
+    beat = synchronized(Stomp.beat)
+    sendFrame = synchronized(Stomp.sendFrame)
+
+    def canRead(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self._lock:
+                if Stomp.canRead(self, 0):
+                    return True
+                transport = self._transport
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            try:
+                if not transport.canRead(remaining):
+                    return False
+            except select.error, e:
+                # a signal (say, one calling stop()) counts as a timeout
+                if e.args[0] != errno.EINTR:
+                    raise
+                return False
+
+    def receiveFrame(self):
+        if self.canRead():
+            with self._lock:
+                return self._messages.popleft()
+
 class ApolloConnection(object):
     def __init__(self, args):
         self.args = args
 
+    def stomp_config(self):
+        """Build the stompest config for the Apollo server in the Worker args
+
+        With RECONNECT_ATTEMPTS set, this is a failover URI, so that a connect()
+        after losing the connection retries with backoff (delays in seconds
+        in the config, in milliseconds in the URI).
+        """
+        uri = 'tcp://{0}:{1}'.format(self.args['apollo_host'],
+                                     self.args['apollo_port'])
+        if int(self.args.get('reconnect_attempts') or 0):
+            uri = ('failover:({0})?maxReconnectAttempts={1},'
+                   'initialReconnectDelay={2},maxReconnectDelay={3},'
+                   'reconnectDelayJitter={4}').format(
+                       uri,
+                       int(self.args['reconnect_attempts']),
+                       int(float(self.args['reconnect_delay']) * 1000),
+                       int(float(self.args['max_reconnect_delay']) * 1000),
+                       int(float(self.args['reconnect_jitter']) * 1000))
+        return StompConfig(uri,
+                           self.args['apollo_user'],
+                           self.args['apollo_password'])
+
     def __enter__(self):
-        self.apollo_conn = Stomp(
-            StompConfig('tcp://{0}:{1}'.format(self.args['apollo_host'],
-                                               self.args['apollo_port']),
-                                               self.args['apollo_user'],
-                                               self.args['apollo_password']))
+        self.apollo_conn = SynchronizedStomp(self.stomp_config())
         self.apollo_conn.connect()
         if self.args.get('input_topic'):
             logging.info("Subscribing to {0}".format(self.args['input_topic']))
             self.apollo_conn.subscribe(self.args['input_topic'],
+                                       subscription_headers(self.args))
+        if self.args.get('shared_reply_queue'):
+            logging.info("Subscribing to {0}".format(self.args['reply_queue']))
+            self.apollo_conn.subscribe(self.args['reply_queue'],
                                        {StompSpec.ACK_HEADER:
                                         StompSpec.ACK_CLIENT_INDIVIDUAL})
+        if self.args.get('mutation_topic'):
+            logging.info("Subscribing to {0}".format(self.args['mutation_topic']))
+            self.apollo_conn.subscribe(self.args['mutation_topic'],
+                                       {StompSpec.ACK_HEADER: StompSpec.ACK_AUTO})
         return self.apollo_conn
 
     def __exit__(self, type, value, tb):
@@ -532,5 +1452,8 @@ class WetwareException(Exception):
 class ConfigException(WetwareException):
     pass
 
+class TimeoutException(WetwareException):
+    pass
+
 class FrameException(WetwareException):
     pass